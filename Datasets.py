@@ -579,9 +579,10 @@ class RealDataset(Dataset):
 
     def stream(self, n, add_noise=False):
 
-        d = np.take(self.data, range(self.pointer, self.pointer+n), mode="wrap", axis=0)
+        idx = np.arange(self.pointer, self.pointer+n)
+        d = np.take(self.data, idx, mode="wrap", axis=0)
         if self.nkde:
-            p = np.take(self.kde_logp, range(self.pointer, self.pointer+n), mode="wrap", axis=0)
+            p = np.take(self.kde_logp, idx, mode="wrap", axis=0)
         else:
             p = None
         self.increment_pointer(n)
@@ -591,12 +592,13 @@ class RealDataset(Dataset):
     def stream_two(self, n1, n2, add_noise=False):
         
         n = n1 + n2
-        d = np.take(self.data, range(self.pointer, self.pointer+n), mode="wrap", axis=0)
+        idx = np.arange(self.pointer, self.pointer+n)
+        d = np.take(self.data, idx, mode="wrap", axis=0)
         
         s1 = d[:n1]
         s2 = d[n1:]
         if self.nkde:
-            p = np.take(self.kde_logp, range(self.pointer, self.pointer+n), mode="wrap", axis=0)
+            p = np.take(self.kde_logp, idx, mode="wrap", axis=0)
             p1 = p[:n1]
             p2 = p[n1:]
         else:
@@ -606,6 +608,10 @@ class RealDataset(Dataset):
 
         return s1, s2, p1, p2
 
+    def cursor(self, seed=None):
+        
+        return StreamCursor(self, seed)
+
     def increment_pointer(self, n):
         
         self.pointer += n
@@ -616,6 +622,40 @@ class RealDataset(Dataset):
             if self.nkde:
                 self.kde_logp = self.kde_logp[idx]
 
+class StreamCursor(object):
+    '''
+    stream_two over a RealDataset with a pointer and a generator of its own, so that 
+    it can run in a background thread without moving the pointer of the dataset or 
+    drawing from the global np.random. The data are read in an order that is drawn 
+    again after each pass, as increment_pointer shuffles the data
+    '''
+
+    def __init__(self, dataset, seed=None):
+
+        self.dataset = dataset
+        self.rng     = np.random.RandomState(seed)
+        self.order   = np.arange(dataset.N)
+        self.pointer = 0
+        self.nround  = 0
+
+    def stream_two(self, n1, n2, add_noise=False):
+
+        n = n1 + n2
+        idx = np.take(self.order, np.arange(self.pointer, self.pointer+n), mode="wrap")
+        d = self.dataset.data[idx]
+        if self.dataset.nkde:
+            p = self.dataset.kde_logp[idx]
+            p1, p2 = p[:n1], p[n1:]
+        else:
+            p1, p2 = None, None
+
+        self.pointer += n
+        if self.pointer / self.dataset.N - self.nround > 0:
+            self.nround += 1
+            self.order = self.order[self.rng.permutation(self.dataset.N)]
+
+        return d[:n1], d[n1:], p1, p2
+
 class WhiteWine(RealDataset):
     
     def __init__(self, *args, **kwargs):
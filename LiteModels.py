@@ -1,18 +1,27 @@
 import numpy as np
 import tensorflow as tf
 from LiteNet import *
-from Utils import support_1d
+from Utils import support_1d, chol_update, batch_evaluate, effective_sample_size, get_grid, Prefetcher, \
+                  kmeans_pp, pivoted_cholesky, leverage_sample, seeded
 '''
 from kernel_hmc.mini_mcmc.mini_mcmc import mini_mcmc
 from kernel_hmc.densities.gaussian import IsotropicZeroMeanGaussian
 from kernel_hmc.proposals.kmc import KMCStatic
 '''
+from kernel_hmc.hamiltonian.leapfrog import leapfrog_no_storing
 from tqdm import tqdm_notebook, tqdm
 from collections import OrderedDict
 import warnings
-from scipy.stats import norm
+import os
+import hashlib
+import inspect
+import cPickle as pickle
+from multiprocessing import Pool
+from scipy.stats import norm, multivariate_normal
 from scipy.misc import logsumexp
-from sklearn.cluster import KMeans
+from scipy.linalg import cho_solve
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.mixture import GaussianMixture
 from nuts.emcee_nuts import NUTSSampler
 
 
@@ -38,6 +47,103 @@ def optimistic_restore(session, save_file):
     saver = tf.train.Saver(restore_vars)
     saver.restore(session, save_file)
 
+# names of the evaluation ops for each output of evaluate
+eval_ops = OrderedDict([("fun", "fv"), ("grad", "gv"), ("hess", "hv"), ("score", "sc")])
+
+def eval_batch_size(outputs, max_bytes, D, npoint, nkernel, width):
+    '''
+    number of rows per batch so that the kernel derivatives at each point,
+    [npoint + width] per kernel times 1, D or D*D per output, fit in max_bytes
+    '''
+    nd = 1
+    if set(outputs) & set(["grad", "hess", "score"]):
+        nd += D
+    if "score" in outputs:
+        nd += D
+    if "hess" in outputs:
+        nd += D*D
+    row_bytes = nkernel * (npoint + width) * nd * np.dtype(FDTYPE).itemsize
+    return max(1, int(max_bytes // row_bytes))
+
+def array_key(x):
+    x = np.ascontiguousarray(x)
+    h = hashlib.sha1(x.tostring())
+    h.update(str(x.shape) + x.dtype.str)
+    return h.hexdigest()
+
+def normaliser_matches(stats, settings):
+    # whether the logZ with normaliser_stats stats was estimated with exactly these settings
+    stored = (stats or {}).get("settings", {})
+    return sorted(stored.keys()) == sorted(settings.keys()) and \
+           all([np.all(stored[k] == v) for k, v in settings.items()])
+
+def grid_values(model, r, i, j, cond, outputs, kernel_points, max_bytes):
+    '''
+    evaluate_grid of DeepLite and TrainedDeepLite. Values are kept in model.grid_cache 
+    under the slice (i, j, cond), the resolution r and the output
+    '''
+    r = np.asarray(r, dtype=FDTYPE)
+    n = len(r)
+    slice_key = (i, j, array_key(r), array_key(np.asarray(cond, dtype=FDTYPE)))
+    keys = dict([(o, slice_key + (o, model.min_log_pdf)) for o in outputs if o != "kernel"])
+    if "kernel" in outputs:
+        keys["kernel"] = slice_key + ("kernel", array_key(np.asarray(kernel_points, dtype=FDTYPE)))
+
+    missing = [o for o in keys if keys[o] not in model.grid_cache]
+    if len(missing) > 0:
+        data = get_grid(r, i, j, cond).astype(FDTYPE)
+        if "kernel" in missing:
+            missing.remove("kernel")
+            batch_size = model._batch_size(["fun"], max_bytes, len(kernel_points))
+            value = batch_evaluate(lambda batch: [model._run_gram(kernel_points, batch).T], data, batch_size)[0]
+            model.grid_cache[keys["kernel"]] = value.T.reshape(-1, n, n)
+        if len(missing) > 0:
+            # the outputs that are not cached yet share one run per batch
+            for o, value in zip(missing, model.evaluate(data, missing, max_bytes=max_bytes)):
+                model.grid_cache[keys[o]] = value.reshape((n, n) + value.shape[1:])
+
+    return [model.grid_cache[keys[o]] for o in outputs]
+
+
+def nuts_chain(model, nsample, theta0, Madapt, delta):
+    '''
+    one NUTS chain on model.log_pdf_and_grad, returns the samples and
+    a dict of diagnostics: run time, number of model evaluations and effective sample size
+    '''
+    # NUTS asks for both at each node, log_pdf_and_grad runs once for the pair
+    nevals = [0, None]
+    def fun_grad(x):
+        x = np.ravel(x)
+        if nevals[1] is None or not np.array_equal(nevals[1], x):
+            nevals[0] += 1
+            nevals[1] = x.copy()
+        return model.log_pdf_and_grad(x)
+
+    def lnprobfn(x):
+        return fun_grad(x)[0]
+
+    def gradfn(x):
+        return fun_grad(x)[1]
+
+    t0 = time()
+    sampler = NUTSSampler(len(theta0), lnprobfn, gradfn)
+    samples = sampler.run_mcmc(theta0, nsample, Madapt, delta)
+
+    return samples, dict(time=time()-t0, nevals=nevals[0], ess=effective_sample_size(samples))
+
+# model of each nuts worker, loaded once by _nuts_init
+_nuts_model = None
+
+def _nuts_init(file_name):
+    global _nuts_model
+    from NumpyLite import NumpyLite
+    _nuts_model = NumpyLite(file_name, FDTYPE)
+
+def _nuts_run(args):
+    nsample, theta0, Madapt, delta, seed = args
+    np.random.seed(seed)
+    return nuts_chain(_nuts_model, nsample, theta0, Madapt, delta)
+
 
 class DeepLiteMixture(object):
     
@@ -61,7 +167,7 @@ class DeepLite(object):
                     seed=None, keep_prob = 1.0, mixture_kernel=False, base=True,
                     npoint=300, ntrain=300, nvalid=300, points_type="fixed", clip_score=False,
                     step_size=1e-2, niter=None, patience=None, kernel_type="gaussian",
-                    gpu_count=1
+                    gpu_count=1, chunk_size=None, nfeat=500, cg_iter=None
                     ):        
         
         self.target = target
@@ -81,7 +187,8 @@ class DeepLite(object):
                                     npoint = npoint,
                                     mixture_kernel = mixture_kernel,
                                     base           = base,
-                                    kernel_type    = kernel_type
+                                    kernel_type    = kernel_type,
+                                    nfeat          = nfeat
                                 )
         if nlayer == 0:
             self.model_params["ndims"] = [0,]
@@ -91,7 +198,9 @@ class DeepLite(object):
                                     nvalid = nvalid,
                                     patience=patience,
                                     points_type = points_type,
-                                    clip_score = clip_score
+                                    clip_score = clip_score,
+                                    chunk_size = chunk_size,
+                                    cg_iter = cg_iter
                                     )
         
         self.states = OrderedDict()
@@ -109,9 +218,35 @@ class DeepLite(object):
         else:
             self.niter = 0
 
-        self.build_model(gpu_count)
-
         self.logZ = None
+        self.normaliser_stats = None
+        # weights hash logZ was estimated for, and logZ and data log_pdf for each hash, see model_hash
+        self.logZ_hash  = None
+        self.eval_cache = {}
+        self.ckpt_name  = None
+
+        # cached factor of the alpha system for update_fit, and the data alpha was fitted on
+        self.online_fit  = None
+        self.alpha_ndata = None
+        # inference graph made by freeze
+        self.frozen = None
+        # compiled callable for log_pdf_and_grad and its last result
+        self.fun_grad = None
+        self.fun_grad_last = None
+        # parameters of the KMC sampler, set by setup_mcmc
+        self.mcmc_params = None
+        self.kmc = None
+        # run time, model evaluations and effective sample size of each chain of the last nuts run
+        self.nuts_diagnostics = None
+        # seconds the steps of the last fit waited for their data
+        self.input_wait = 0.0
+        # cursor the training batches are read from, see input_batch
+        self.stream = None
+        # values on 2-d slices from evaluate_grid, for the weights with hash grid_hash
+        self.grid_cache = {}
+        self.grid_hash  = None
+
+        self.build_model(gpu_count)
         
     def build_model(self, gpu_count=1):
         
@@ -171,6 +306,15 @@ class DeepLite(object):
             elif points_type == "kmeans":
                 kmeans  = KMeans(n_clusters=npoint, random_state=self.seed).fit(self.target.sample(min(5000, self.target.N)))
                 points  = tf.Variable(kmeans.cluster_centers_ + np.random.randn(npoint,target.D)*points_std, dtype=FDTYPE, name="points", trainable=False)
+            elif points_type == "minibatch_kmeans":
+                kmeans  = MiniBatchKMeans(n_clusters=npoint, random_state=self.seed, batch_size=max(1000, 3*npoint)).fit(self.target.data)
+                points  = tf.Variable(kmeans.cluster_centers_ + np.random.randn(npoint,target.D)*points_std, dtype=FDTYPE, name="points", trainable=False)
+            elif points_type == "kmeans++":
+                seeds   = self.target.data[kmeans_pp(self.target.data, npoint)]
+                points  = tf.Variable(seeds + np.random.randn(npoint,target.D)*points_std, dtype=FDTYPE, name="points", trainable=False)
+            elif points_type in ["pivoted", "leverage"]:
+                # chosen by select_points once the kernel is built
+                points  = tf.Variable(target.sample(npoint), dtype=FDTYPE, name="points", trainable=False)
             else:
                 raise NameError(points_type + " is not a valid points type")
                 
@@ -193,6 +337,10 @@ class DeepLite(object):
                 elif kernel_type == "linear":
                     kernel  = PolynomialKernel(1.0,0.0)
                     sigma   = tf.constant(0.0, dtype=FDTYPE)
+                elif kernel_type == "rff":
+                    kernel  = RandomFourierKernel(ndims[-1][0] if nlayer>0 else target.D, init_log_sigma[i], 
+                                                  nfeat=self.model_params["nfeat"], trainable=True)
+                    sigma   = kernel.sigma
                 else:
                     raise NameError("no such kernel type")
 
@@ -231,44 +379,69 @@ class DeepLite(object):
 
             kernel    = MixtureKernel( kernels, props )
             kn = LiteModel(kernel, points=points, init_log_lam=init_log_lam, log_lam_weights=log_lam_weights, 
-                            noise_std=noise_std, base=base)
-
-            kn.npoint = npoint
-            loss, score, _, _, r_norm, l_norm, curve, w_norm, k_loss, _, self.states["outlier"]= \
+                            noise_std=noise_std, base=base, chunk_size=self.train_params["chunk_size"],
+                            cg_iter=self.train_params["cg_iter"])
+
+            # alpha weighs the points, or the features of an rff kernel, see LiteModel.set_points
+            if not kernel.has_features():
+                kn.npoint = npoint
+            nalpha = kn.npoint
+            loss, score, noisy_train_data, _, r_norm, l_norm, curve, w_norm, k_loss, _, self.states["outlier"]= \
                 kn.val_score(train_data=train_data, valid_data=valid_data, train_kde=self.train_kde,
                              valid_kde=self.valid_kde, clip_score=clip_score)
+            # the optimal alpha of the training data, step computes it once and feeds it back
+            self.ops["alpha_opt"]  = kn.alpha
+            self.ops["noisy_train_data"] = noisy_train_data
 
             optimizer = tf.train.AdamOptimizer(self.train_params["step_size"])
-            raw_gradients, variables = zip(*optimizer.compute_gradients(loss))
-            gradients = [ tf.where(tf.is_nan(g), tf.zeros_like(g), g) for g in raw_gradients if g is not None]
-            gradients, self.states["grad_norm"] = tf.clip_by_global_norm(gradients, 100.0)
+            variables = tf.trainable_variables()
+            nan_to_zero = lambda g, v: tf.zeros_like(v) if g is None else tf.where(tf.is_nan(g), tf.zeros_like(g), g)
+
+            # gradient of the loss at fixed alpha and gradient with respect to alpha, 
+            # summed over the validation micro-batches with alpha fed
+            direct_gradients = tf.gradients(loss, variables, stop_gradients=[kn.alpha])
+            alpha_gradient   = tf.gradients(loss, kn.alpha)[0]
 
-            accum_gradients = [tf.Variable(tf.zeros_like(g), trainable=False) for g in gradients]
-            self.ops["zero_op"]  = [ag.assign(tf.zeros_like(ag)) for ag in accum_gradients]
+            accum_gradients = [tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype), trainable=False) for v in variables]
+            accum_alpha     = tf.Variable(tf.zeros(nalpha, dtype=FDTYPE), trainable=False)
+            self.ops["zero_op"]  = [ag.assign(tf.zeros_like(ag)) for ag in accum_gradients + [accum_alpha]]
 
             nbatch = tf.placeholder(FDTYPE, shape=[], name="nbatch")
             self.train_params["nbatch"] = nbatch
 
-            self.ops["accum_op"] = [accum_gradients[i].assign_add(g/nbatch) for i, g in enumerate(gradients)]
+            self.ops["accum_op"] = [ag.assign_add(nan_to_zero(g, v)/nbatch) 
+                                        for ag, g, v in zip(accum_gradients, direct_gradients, variables)] + \
+                                   [accum_alpha.assign_add(nan_to_zero(alpha_gradient, kn.alpha)/nbatch)]
+
+            # then the accumulated alpha gradient goes back through the solve for alpha once
+            alpha_path = tf.gradients(kn.alpha, variables, grad_ys=accum_alpha)
+            gradients  = [ag + nan_to_zero(g, v) for ag, g, v in zip(accum_gradients, alpha_path, variables)]
+            gradients, self.states["grad_norm"] = tf.clip_by_global_norm(gradients, 100.0)
             self.ops["train_step"] = optimizer.apply_gradients( zip(gradients, variables) )
             
             lambdas = [v for v in tf.trainable_variables() if "regularizers" in v.name]
             if len(lambdas)>0:
                 self.ops["train_lambdas"] = optimizer.minimize(loss, var_list = lambdas)
 
-            self.alpha   = tf.Variable(tf.zeros(npoint), dtype=FDTYPE, name="alpha_eval", trainable=False)
+            self.alpha   = tf.Variable(tf.zeros(nalpha), dtype=FDTYPE, name="alpha_eval", trainable=False)
 
             self.ops["alpha_assign"] = kn.opt_score(data=train_data, alpha=self.alpha, kde = self.train_kde,)
+            # groups of ops added by build_ops
+            self.built_ops = set()
+
             self.min_log_pdf = -np.inf
+            self.fun_variables = None
             hv, gv, fv = kn.evaluate_hess_grad_fun(test_data, alpha=self.alpha)
             sc         = kn.individual_score(test_data, alpha=self.alpha)[0]
             self.ops["hv"] = hv
             self.ops["gv"] = gv
             self.ops["fv"] = fv
             self.ops["sc"] = sc
+            self.ops["gram"] = kn.evaluate_gram(test_points, test_data)
             
             config = tf.ConfigProto(device_count={"GPU":gpu_count})
             config.gpu_options.allow_growth=True
+            self.config = config
 
             #Visualise the kernel with random initialization
 
@@ -286,6 +459,10 @@ class DeepLite(object):
             self.test_data  = test_data
             self.points     = points
             self.test_points= test_points
+
+            if points_type in ["pivoted", "leverage"]:
+                # alpha is left for fit_alpha, as for the other points types
+                self._choose_points(points_type)
             
             self.states["score"]   = score
             self.states["loss"]    = loss
@@ -307,29 +484,117 @@ class DeepLite(object):
                     self.state_hist[k] = []
             if "test_score" not in self.state_hist:
                 self.state_hist["test_score"] = []
+
+    def build_ops(self, group):
+        '''
+        ops that only some methods use are added to the graph by group the first time 
+        they are needed, so that a model that is only trained does not build them
+        "sums":   statistics summed over chunks of data and the alpha system from them,
+                  for fit_alpha_stream and update_fit, and alpha_set of set_alpha
+        "cv":     scores of cross_validate from the statistic sums of each fold
+        "points": points_set of select_points
+        '''
+        if group in self.built_ops:
+            return
+        if group not in ["sums", "cv", "points"]:
+            raise NameError(group + " is not a valid group of ops")
+        if group == "cv":
+            self.build_ops("sums")
+
+        kn = self.kn
+        with self.graph.as_default():
+
+            if group == "sums":
+                # statistics summed over chunks of data, used to fit alpha on datasets too large for one run
+                stat_sums = kn.statistic_sums(data=self.train_data, add_noise=True)
+                self.ops["stat_sums"] = list(stat_sums[:-1])
+                self.stat_sums  = [tf.placeholder(FDTYPE, shape=s.shape) for s in self.ops["stat_sums"]]
+                self.stat_ndata = tf.placeholder(FDTYPE, shape=[], name="stat_ndata")
+                if self.target.nkde:
+                    # the kde regulariser summed over the same chunks, on the same noisy data
+                    self.ops["kde_sums"] = list(kn.kde_sums(stat_sums[-1], self.train_kde))
+                    self.kde_sums = [tf.placeholder(FDTYPE, shape=s.shape) for s in self.ops["kde_sums"]]
+                else:
+                    self.kde_sums = None
+                alpha_sums = kn.opt_alpha_from_sums(self.stat_sums, self.stat_ndata, kde_sums=self.kde_sums)
+                self.ops["alpha_assign_sums"] = tf.assign(self.alpha, alpha_sums)
+
+                # alpha system in units of sums over data and its change from new points, used by update_fit
+                self.ops["alpha_system_sums"] = list(kn.alpha_system_sums(self.stat_sums, self.stat_ndata, 
+                                                                          kde_sums=self.kde_sums))
+                self.ops["stat_factors"] = list(kn.statistic_factors(self.train_data))
+                self.alpha_value = tf.placeholder(FDTYPE, shape=[kn.npoint], name="alpha_value")
+                self.ops["alpha_set"] = tf.assign(self.alpha, self.alpha_value)
+
+            elif group == "cv":
+                # cross-validation of the lambdas from the statistic sums of each fold
+                self.fold_sums  = [tf.placeholder(FDTYPE, shape=tf.TensorShape([None]).concatenate(s.shape)) 
+                                   for s in self.ops["stat_sums"]]
+                self.fold_ndata = tf.placeholder(FDTYPE, shape=[None], name="fold_ndata")
+                self.cv_lams    = [tf.placeholder(FDTYPE, shape=[None], name=n) for n in ["cv_lam_alpha", "cv_lam_curve"]]
+                self.ops["cv_scores"] = list(kn.cv_scores_from_sums(self.fold_sums, self.fold_ndata, *self.cv_lams))
+
+            else:
+                assert self.train_params["points_type"] != "tied", "points tied to the training data cannot be set"
+                self.points_value = tf.placeholder(FDTYPE, shape=[self.model_params["npoint"], self.target.D], 
+                                                   name="points_value")
+                self.ops["points_set"] = tf.assign(self.points, self.points_value)
+
+        self.built_ops.add(group)
         
-    def step(self, feed, ntest):
+    def input_batch(self):
+        '''
+        training data, validation data for the nbatch accumulation steps and their kde,
+        as FDTYPE arrays ready to feed. Run in the background by the Prefetcher of fit,
+        so they are read from the cursor self.stream rather than the target itself, 
+        see RealDataset.cursor
+        '''
+        nbatch = self.train_params["_nbatch"]
+        ntrain =self.train_params["ntrain"]
+        nvalid =self.train_params["nvalid"]
+
+        batch = self.stream.stream_two(ntrain, nvalid*nbatch)
+        return [None if b is None else np.asarray(b, dtype=FDTYPE) for b in batch]
+
+    def step(self, feed, ntest, batch=None):
         
 
         nbatch = self.train_params["_nbatch"]
-        ntrain =self.train_params["ntrain"]
         nvalid =self.train_params["nvalid"]
 
         self.sess.run(self.ops["zero_op"])
-        feed[self.train_data], valid_data, train_kde, valid_kde = self.target.stream_two(ntrain, nvalid*nbatch)
+        if batch is None:
+            if self.stream is None:
+                self.stream = self.target.cursor(np.random.randint(2**31))
+            batch = self.input_batch()
+        feed[self.train_data], valid_data, train_kde, valid_kde = batch
         
         if self.target.nkde:
             feed[self.train_kde] = train_kde
 
+        # the training side is run once: alpha for the micro-batches, 
+        # and at the end the gradient through alpha, on the same noisy training data
+        alpha, noisy_train_data = self.sess.run([self.ops["alpha_opt"], self.ops["noisy_train_data"]], feed_dict=feed)
+        batch_feed = dict(feed)
+        batch_feed[self.ops["alpha_opt"]] = alpha
+
+        names = [k for k in self.states.keys() if k != "grad_norm"]
         for i in range(nbatch):
-            feed[self.valid_data] = valid_data[i * nvalid : (i+1) * nvalid]
+            batch_feed[self.valid_data] = valid_data[i * nvalid : (i+1) * nvalid]
 
             if self.target.nkde:
-                feed[self.valid_kde] = valid_kde[i * nvalid : (i+1) * nvalid]
+                batch_feed[self.valid_kde] = valid_kde[i * nvalid : (i+1) * nvalid]
 
-            self.sess.run(self.ops["accum_op"], feed_dict=feed)
+            if i < nbatch-1:
+                self.sess.run(self.ops["accum_op"], feed_dict=batch_feed)
+            else:
+                states = self.sess.run([self.ops["accum_op"]] + [self.states[k] for k in names], feed_dict=batch_feed)[1:]
+        states = dict(zip(names, states))
 
-        res = self.sess.run([self.ops["train_step"]] + self.states.values(), feed_dict=feed)[1:]
+        step_feed = dict(feed)
+        step_feed[self.ops["noisy_train_data"]] = noisy_train_data
+        states["grad_norm"] = self.sess.run([self.ops["train_step"], self.states["grad_norm"]], feed_dict=step_feed)[1]
+        res = [states[k] for k in self.states.keys()]
 
         feed[self.valid_data] = self.target.valid_data[:ntest]
         if self.target.nkde:
@@ -342,13 +607,23 @@ class DeepLite(object):
 
     def fit(self, niter = None, ntrain = None, nvalid=None, ntest = 300, nbatch=1, patience=30,
             step_size=None, verbose = False, print_time_interval=10,
-           print_iteration_interval=200, true_grad_fun=None):
+           print_iteration_interval=200, true_grad_fun=None, prefetch=2):
+        '''
+        the next prefetch batches of data are prepared in a background thread while 
+        the current step runs, prefetch=0 prepares them in step. The time the steps 
+        waited for data is in input_wait. No more than niter+1 batches are drawn. 
+        The batches are read from a cursor of their own, seeded from np.random when 
+        the fit starts, so with a fixed seed they are the same for any prefetch and 
+        the stream of the target is not moved
+        '''
         
         train_data = self.train_data
         valid_data = self.valid_data
         
         sess = self.sess
         target = self.target
+
+        self.unfreeze()
         
         if ntrain is not None:
             self.train_params["ntrain"] = ntrain
@@ -373,15 +648,18 @@ class DeepLite(object):
         last_time = t0
         
         self.set_train()
+        self.stream = self.target.cursor(np.random.randint(2**31))
 
         last_epoch = 0
         best_score = np.inf
         wait_window = 0
-        with tqdm(range(niter+1), ncols=100, desc="trainining kernel", postfix=[dict(loss="%.3f" % 0.0, test="%.3f" % 0.0)]) as tr:    
+        with Prefetcher(self.input_batch, prefetch, niter+1) as prefetcher, \
+             tqdm(range(niter+1), ncols=100, desc="trainining kernel", postfix=[dict(loss="%.3f" % 0.0, test="%.3f" % 0.0)]) as tr:    
 
             for i in tr: 
 
-                res = self.step(feed, ntest)
+                res = self.step(feed, ntest, prefetcher.next())
+                self.input_wait = prefetcher.wait_time
 
                 for ki, k in enumerate(self.state_hist.keys()):
                     self.state_hist[k].append(res[ki])
@@ -436,6 +714,7 @@ class DeepLite(object):
 
                     tqdm.write( '==================' )
                     tqdm.write( 'Iteration %5d, score: %5.3g +- %5.3g, time taken %.2f' % (i, block_score_mean, block_score_std, time()-t0) )
+                    tqdm.write( 'time waiting for data %.2f' % self.input_wait )
 
                     if true_grad_fun is not None:
                         tg = true_grad_fun(feed[self.test_data])
@@ -478,8 +757,25 @@ class DeepLite(object):
             kde  = None
         return data, kde
     
-    def fit_alpha(self, ndata):
+    def fit_alpha(self, ndata=None, chunk_size=None):
+        '''
+        fit alpha on the first ndata training points, all of them if ndata is None.
+        If chunk_size is given, the score statistics are summed over chunks of 
+        chunk_size points and alpha is solved once at the end, so the memory used 
+        does not grow with ndata
+        '''
         
+        if ndata is None:
+            ndata = self.target.N
+
+        self.alpha_ndata = ndata
+        self.online_fit  = None
+        self.unfreeze()
+
+        if chunk_size is not None:
+            self.fit_alpha_stream(ndata, chunk_size)
+            return
+
         data, train_kde = self.final_train_data(ndata)
 
         if self.target.nkde:
@@ -487,6 +783,165 @@ class DeepLite(object):
         else:
             self.sess.run(self.ops["alpha_assign"], feed_dict={self.train_data:data})
 
+    def fit_alpha_stream(self, ndata, chunk_size=5000):
+
+        assert self.train_params["points_type"] != "tied", "points tied to the training data cannot be streamed"
+        
+        feed = self._statistic_feed(ndata, chunk_size)
+        self.sess.run(self.ops["alpha_assign_sums"], feed_dict=feed)
+
+    def _statistic_feed(self, ndata, chunk_size=5000):
+        # feed of the statistics summed over the first ndata training points
+        
+        self.build_ops("sums")
+        data, train_kde = self.final_train_data(ndata)
+        ndata = data.shape[0]
+
+        if self.target.nkde:
+            feed = dict(zip(self.stat_sums + self.kde_sums, self._sum_statistics(data, chunk_size, train_kde)))
+        else:
+            feed = dict(zip(self.stat_sums, self._sum_statistics(data, chunk_size)))
+        feed[self.stat_ndata] = ndata
+
+        return feed
+
+    def select_points(self, method="pivoted", ncand=5000, lam=1e-3, chunk_size=None):
+        '''
+        choose the points among ncand samples of the data by the current kernel.
+        "pivoted" takes the pivots of a greedy pivoted Cholesky of their gram matrix, 
+        each the sample least explained by the points before. "leverage" draws them
+        by their ridge leverage scores, with ridge lam times the mean kernel variance, 
+        computed from the same factor. Costs O(npoint^2 ncand) and npoint gram rows.
+        If alpha was fitted before, it is fitted again for the new points on the data 
+        of the last fit, in chunks of chunk_size points, train_params["chunk_size"] 
+        if not given, see fit_alpha
+        '''
+
+        self._choose_points(method, ncand, lam)
+
+        if self.alpha_ndata is not None:
+            if chunk_size is None:
+                chunk_size = self.train_params["chunk_size"]
+            self.fit_alpha(self.alpha_ndata, chunk_size)
+
+    def _choose_points(self, method, ncand=5000, lam=1e-3):
+        # set the points by select_points without fitting alpha
+
+        if method not in ["pivoted", "leverage"]:
+            raise NameError(method + " is not a valid selection method")
+        self.build_ops("points")
+
+        npoint = self.model_params["npoint"]
+        cand   = self.target.sample(min(ncand, self.target.N)).astype(FDTYPE)
+        diag   = np.concatenate([np.diag(self._run_gram(c, c)) for c in np.array_split(cand, max(len(cand)//500, 1))])
+        pivots, L = pivoted_cholesky(diag, lambda i: self._run_gram(cand[i:i+1], cand)[0], npoint)
+
+        if method == "leverage":
+            pivots = leverage_sample(L, lam * diag.mean(), npoint)
+        elif len(pivots) < npoint:
+            # the gram matrix has a lower rank, the other points are drawn at random
+            rest   = np.setdiff1d(np.arange(len(cand)), pivots)
+            pivots = np.concatenate([pivots, np.random.choice(rest, npoint-len(pivots), replace=False)])
+
+        self.sess.run(self.ops["points_set"], feed_dict={self.points_value: cand[pivots]})
+
+        # nothing computed for the old points is valid any more
+        self.online_fit = None
+        self.grid_cache = {}
+        self.grid_hash  = None
+        self.unfreeze()
+
+    def _sum_statistics(self, data, chunk_size=5000, kde=None):
+        # statistic sums over data in float64, chunk_size points per run,
+        # followed by the kde sums when kde is given
+
+        self.build_ops("sums")
+        ops = self.ops["stat_sums"]
+        if kde is not None:
+            ops = ops + self.ops["kde_sums"]
+
+        sums = None
+        for i in tqdm(range(0, data.shape[0], chunk_size), ncols=100, desc="alpha statistics"):
+            feed = {self.train_data: data[i:i+chunk_size]}
+            if kde is not None:
+                feed[self.train_kde] = kde[i:i+chunk_size]
+            chunk_sums = self.sess.run(ops, feed_dict=feed)
+            chunk_sums = [np.asarray(cs, dtype="float64") for cs in chunk_sums]
+            if sums is None:
+                sums = chunk_sums
+            else:
+                sums = [s + cs for s, cs in zip(sums, chunk_sums)]
+        return sums
+
+    def cross_validate(self, lam_alphas, lam_curves=None, ndata=None, nfold=5, chunk_size=5000):
+        '''
+        nfold cross-validation of lam_alpha and lam_curve on the first ndata training points,
+        without the kde regulariser. The statistic sums of each fold are taken in one pass over
+        the data and each fold is fitted on the total minus its own sums, so this costs about 
+        as much as fit_alpha_stream. The lambdas of the model are not changed
+
+        returns the scores (nlam_alpha x nlam_curve), the best lam_alpha and lam_curve.
+        lam_curves is [0.0] if not given
+        '''
+
+        assert self.train_params["points_type"] != "tied", "points tied to the training data cannot be cross-validated"
+        self.build_ops("cv")
+
+        lam_alphas = np.asarray(lam_alphas, dtype=FDTYPE)
+        lam_curves = np.asarray([0.0] if lam_curves is None else lam_curves, dtype=FDTYPE)
+
+        data  = self.final_train_data(ndata)[0]
+        folds = np.array_split(np.random.permutation(data.shape[0]), nfold)
+        fold_sums = [self._sum_statistics(data[fold], chunk_size) for fold in folds]
+
+        feed = dict(zip(self.fold_sums, [np.stack(s) for s in zip(*fold_sums)]))
+        feed[self.fold_ndata] = [len(fold) for fold in folds]
+        feed[self.cv_lams[0]] = lam_alphas
+        feed[self.cv_lams[1]] = lam_curves
+        scores = self.sess.run(self.ops["cv_scores"][0], feed_dict=feed)
+
+        ai, ci = np.unravel_index(np.argmin(scores), scores.shape)
+        return scores, lam_alphas[ai], lam_curves[ci]
+
+    def update_fit(self, z_new):
+        '''
+        online update of alpha with the new points z_new, used by kernel_hmc KMC.
+        The alpha system of the data alpha was last fitted on is kept as a Cholesky
+        factor, each new point adds a rank 2D term to it and alpha is solved again
+        from the factor, O(npoint^2 D) per point instead of a full refit.
+        The regularisers keep the weight they had for the data of the last fit
+        '''
+
+        assert self.train_params["points_type"] != "tied", "points tied to the training data cannot be updated"
+
+        self.unfreeze()
+        self.build_ops("sums")
+
+        if self.online_fit is None:
+            ndata = self.alpha_ndata if self.alpha_ndata is not None else self.target.N
+            quad, lin = self.sess.run(self.ops["alpha_system_sums"], feed_dict=self._statistic_feed(ndata))
+            self.online_fit = (np.linalg.cholesky(quad), lin)
+
+        V, dlin = self.sess.run(self.ops["stat_factors"], feed_dict={self.train_data: np.atleast_2d(z_new)})
+        # the curvature columns vanish unless lam_curve is used
+        V = V[:, np.any(V!=0, 0)]
+
+        L, lin = self.online_fit
+        L   = chol_update(L, V)
+        lin = lin + dlin
+        self.online_fit = (L, lin)
+
+        self.sess.run(self.ops["alpha_set"], feed_dict={self.alpha_value: cho_solve((L, True), lin)})
+
+    def set_alpha(self, alpha):
+        '''
+        set alpha to a value fitted elsewhere, e.g. by cross_validate or on another model
+        '''
+        self.unfreeze()
+        self.build_ops("sums")
+        self.online_fit = None
+        self.sess.run(self.ops["alpha_set"], feed_dict={self.alpha_value: alpha})
+
         
     def set_test(self, rebuild=False, gpu_count=None):
 
@@ -530,6 +985,8 @@ class DeepLite(object):
 
         if self.model_params["kernel_type"] == "linear":
             file_name += "_lin"
+        elif self.model_params["kernel_type"] == "rff":
+            file_name += "_rff%d" % self.model_params["nfeat"]
         
         if isinstance(self.seed, int) :
             file_name += "_s%02d" % self.seed
@@ -541,6 +998,8 @@ class DeepLite(object):
             file_name = self.default_file_name()
 
         save_path = self.saver.save(self.sess, "ckpts/"+file_name+".ckpt")
+        self.ckpt_name = file_name
+        self._write_cache()
         return file_name
 
     def load(self, file_name=None):
@@ -550,94 +1009,378 @@ class DeepLite(object):
         ckpt = "ckpts/"+file_name+".ckpt"
         with self.graph.as_default():
             optimistic_restore(self.sess, ckpt)
+        self.online_fit = None
+        self.unfreeze()
 
-    def grad(self, data):
-        return support_1d(lambda x: self.grad_multiple(x, batch_size=1), data)
+        self.ckpt_name = file_name
+        self.eval_cache = {}
+        if os.path.exists(self._cache_file()):
+            with open(self._cache_file(), "rb") as f:
+                self.eval_cache = pickle.load(f)
 
-    def log_pdf(self, data):
-        return support_1d(lambda x: self.fun_multiple(x, batch_size=1), data)
+    def _cache_file(self):
+        return "ckpts/"+self.ckpt_name+".cache.pkl"
 
-    def score_multiple(self, data, batch_size=100):
+    def _write_cache(self):
+        # eval_cache is kept next to the checkpoint once there is one
+        if self.ckpt_name is not None:
+            with open(self._cache_file(), "wb") as f:
+                pickle.dump(self.eval_cache, f, pickle.HIGHEST_PROTOCOL)
 
-        neval = data.shape[0]
-        nbatch = neval/batch_size
-
-        value = np.empty((neval))
-
-        for i in range(nbatch):
-            batch = data[i*batch_size:(i+1)*batch_size]
-            value[i*batch_size:(i+1)*batch_size] = \
-                self.sess.run(self.ops["sc"], feed_dict={self.test_data:batch})
+    def model_hash(self):
+        '''
+        sha1 of the values of the variables that fv depends on: network weights, points, 
+        kernel and base parameters and alpha. Keys eval_cache
+        '''
+        if self.fun_variables is None:
+            ops, stack = set(), [self.ops["fv"].op]
+            while stack:
+                op = stack.pop()
+                if op not in ops:
+                    ops.add(op)
+                    stack.extend([t.op for t in op.inputs] + list(op.control_inputs))
+            names = set([op.name for op in ops if op.type in ["Variable", "VariableV2"]])
+            self.fun_variables = sorted([v for v in self.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES) 
+                                         if v.op.name in names], key=lambda v: v.op.name)
+
+        h = hashlib.sha1()
+        for v, value in zip(self.fun_variables, self.sess.run(self.fun_variables)):
+            h.update(v.op.name)
+            h.update(np.ascontiguousarray(value).tostring())
+        return h.hexdigest()
+
+    def normaliser_settings(self, method, kwargs):
+        # every setting of the estimator of method called with kwargs, the defaults filled in,
+        # and min_log_pdf, below which fun_multiple is -inf
+        estimator = self.estimate_normaliser_ais if method == "ais" else self.estimate_normaliser
+        spec = inspect.getargspec(estimator)
+        settings = dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+        settings.update(kwargs)
+        settings["method"] = method
+        settings["min_log_pdf"] = self.min_log_pdf
+        return settings
+
+    def _store_normaliser(self, settings):
+        # logZ and how it was estimated, for the current weights
+        settings["min_log_pdf"] = self.min_log_pdf
+        self.normaliser_stats["settings"] = settings
+        self.logZ_hash = self.model_hash()
+        entry = self.eval_cache.setdefault(self.logZ_hash, {})
+        entry["logZ"] = self.logZ
+        entry["normaliser_stats"] = self.normaliser_stats
+        self._write_cache()
+
+    def freeze(self, cpu_only=False):
+        '''
+        inference mode for a trained model. fv, gv and hv are copied into a new graph
+        where the variables are constants and everything that does not depend on 
+        the test data, e.g. the network features of the points, is precomputed.
+        The training parts of the graph are left out. fun_multiple and grad_multiple 
+        use it until the model is changed by fit, fit_alpha, update_fit or load.
+        The frozen session has the config of the model, without GPUs if cpu_only
+        '''
 
-        return value
+        self.unfreeze()
 
-    def grad_multiple(self, data, batch_size=100):
+        names = [self.ops[k].op.name for k in ["fv", "gv", "hv"]]
+        with self.graph.as_default():
+            graph_def = tf.graph_util.convert_variables_to_constants(self.sess, self.graph.as_graph_def(), names)
+
+        op_name = lambda t: t.lstrip("^").split(":")[0]
+
+        # nodes that depend on the inputs of evaluation
+        inputs = [self.test_data]
+        test_nodes = set([t.op.name for t in inputs])
+        changed = True
+        while changed:
+            changed = False
+            for n in graph_def.node:
+                if n.name not in test_nodes and any([op_name(i) in test_nodes for i in n.input]):
+                    test_nodes.add(n.name)
+                    changed = True
+
+        # inputs of these that do not depend on the test data are computed now
+        ops = dict([(n.name, n.op) for n in graph_def.node])
+        control_flow = ["Const", "Enter", "Exit", "Merge", "Switch", "NextIteration", "LoopCond"]
+        fixed = set()
+        for n in graph_def.node:
+            if n.name in test_nodes:
+                for i in n.input:
+                    if not i.startswith("^") and op_name(i) not in test_nodes and ops[op_name(i)] not in control_flow:
+                        fixed.add(i if ":" in i else i + ":0")
+        fixed  = sorted(fixed)
+        values = self.sess.run(fixed)
+
+        for t, v in zip(fixed, values):
+            node = graph_def.node.add()
+            node.name = "frozen/" + t.replace(":", "_")
+            node.op   = "Const"
+            node.attr["dtype"].type = tf.as_dtype(v.dtype).as_datatype_enum
+            node.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(v))
+        fixed = dict([(t, "frozen/" + t.replace(":", "_")) for t in fixed])
+
+        for n in graph_def.node:
+            if n.name in test_nodes:
+                for j, i in enumerate(n.input):
+                    i = i if ":" in i or i.startswith("^") else i + ":0"
+                    if i in fixed:
+                        n.input[j] = fixed[i]
+
+        graph_def = tf.graph_util.extract_sub_graph(graph_def, names)
+
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        config = tf.ConfigProto()
+        config.CopyFrom(self.config)
+        if cpu_only:
+            config.device_count["GPU"] = 0
+        self.frozen = dict(sess = tf.Session(graph=graph, config=config),
+                           test_data = graph.get_tensor_by_name(self.test_data.name))
+        for k in ["fv", "gv", "hv"]:
+            self.frozen[k] = graph.get_tensor_by_name(self.ops[k].name)
+
+    def unfreeze(self):
+
+        if self.frozen is not None:
+            self.frozen["sess"].close()
+        self.frozen = None
+        self.fun_grad = None
+        self.fun_grad_last = None
+
+    def _run_test(self, names, data):
+        # ops[names] at data in one run, on the frozen graph if it has all of them
+        if self.frozen is not None and all([n in self.frozen for n in names]):
+            return self.frozen["sess"].run([self.frozen[n] for n in names], feed_dict={self.frozen["test_data"]:data})
+        return self.sess.run([self.ops[n] for n in names], feed_dict={self.test_data:data})
+
+    def export(self, file_name=None):
+        '''
+        write weights, points, alpha, sigmas, mixture props and the base measure to a single .npz
+        that NumpyLite evaluates without tensorflow
+        '''
+        if file_name is None:
+            file_name = self.default_file_name()
+        if self.model_params["kernel_type"] != "gaussian":
+            raise NameError("only gaussian kernels can be exported")
+        if self.train_params["points_type"] == "tied":
+            raise NameError("tied points depend on the training data and cannot be exported")
+
+        params = dict(points = self.points, alpha = self.alpha)
+        for ki, kernel in enumerate(self.kn.kernel.kernels):
+
+            params["prop_%d" % ki] = self.kn.kernel.props[ki]
+            if isinstance(kernel, CompositeKernel):
+                for li, layer in enumerate(kernel.network.layers):
+                    params["W_%d_%d" % (ki, li)] = layer.param["W"]
+                    params["b_%d_%d" % (ki, li)] = layer.param["b"]
+                if kernel.network.add_skip:
+                    for k, v in kernel.network.skip_layer.param.items():
+                        params["%s_%d_skip" % (k, ki)] = v
+                kernel = kernel.kernel
+            params["sigma_%d" % ki] = kernel.sigma
+
+        if self.kn.base:
+            params["base_mu"]    = self.kn.base.mu
+            params["base_sigma"] = self.kn.base.sigma
+
+        params = dict(zip(params.keys(), self.sess.run(params.values())))
+        params["nkernel"] = len(self.kn.kernel.kernels)
+        params["nlayer"]  = self.model_params["nlayer"]
+        params["base"]    = bool(self.kn.base)
+        params["min_log_pdf"] = self.min_log_pdf
+
+        np.savez("ckpts/"+file_name+".npz", **params)
+        return file_name
 
-        neval = data.shape[0]
-        nbatch = neval/batch_size
+    def log_pdf_and_grad(self, x):
+        '''
+        log_pdf and grad at a single point in one call, for the inner loops of samplers.
+        The callable is compiled once on fv and gv, and the last result is kept
+        since leapfrog and the acceptance step ask for both at the same point
+        '''
+        x = np.array(x, dtype=FDTYPE)
+        if self.fun_grad_last is None or not np.array_equal(self.fun_grad_last[0], x):
+            if self.fun_grad is None:
+                if self.frozen is not None:
+                    sess, fetches, feed = self.frozen["sess"], [self.frozen["fv"], self.frozen["gv"]], self.frozen["test_data"]
+                else:
+                    sess, fetches, feed = self.sess, [self.ops["fv"], self.ops["gv"]], self.test_data
+                self.fun_grad = sess.make_callable(fetches, [feed])
+            f, g = self.fun_grad(x[None,:])
+            self.fun_grad_last = (x, np.float64(f[0]), g[0].astype(np.float64))
 
-        value = np.empty((neval, self.target.D))
+        f, g = self.fun_grad_last[1:]
+        if f < self.min_log_pdf:
+            f = -np.inf
+        return f, g
 
-        for i in range(nbatch):
-            batch = data[i*batch_size:(i+1)*batch_size]
-            value[i*batch_size:(i+1)*batch_size,:] = \
-                self.sess.run(self.ops["gv"], feed_dict={self.test_data:batch})
+    def grad(self, data):
+        if data.ndim == 1:
+            return self.log_pdf_and_grad(data)[1]
+        return self.grad_multiple(data)
 
-        return value
+    def log_pdf(self, data):
+        if data.ndim == 1:
+            return self.log_pdf_and_grad(data)[0]
+        return self.fun_multiple(data)
 
-    def fun_multiple(self, data, batch_size=100):
+    def _batch_size(self, outputs, max_bytes, npoint=None):
 
-        neval = data.shape[0]
-        nbatch = neval/batch_size
+        if npoint is None:
+            # an rff kernel is evaluated through its features rather than the points
+            if self.model_params["kernel_type"] == "rff":
+                npoint = self.model_params["nfeat"]
+            else:
+                npoint = self.model_params["npoint"]
+        ndims = self.model_params["ndims"]
+        width = max([np.prod(d) for d in ndims]) if self.model_params["nlayer"]>0 else 0
+        return eval_batch_size(outputs, max_bytes, self.target.D, npoint, 
+                               len(self.model_params["init_log_sigma"]), width)
 
-        value = np.empty((neval))
+    def _run_gram(self, points, data):
+        return self.sess.run(self.ops["gram"], feed_dict={self.test_points:points, self.test_data:data})
 
-        for i in range(nbatch):
+    def evaluate(self, data, outputs=("fun", "grad", "hess", "score"), max_bytes=2**28, batch_size=None):
+        '''
+        outputs ("fun", "grad", "hess" or "score") at every row of data, all fetched by one sess.run per batch.
+        Without batch_size, the batch size is chosen so that the kernel derivatives take about max_bytes
+        '''
+        if batch_size is None:
+            batch_size = self._batch_size(outputs, max_bytes)
 
-            batch = data[i*batch_size:(i+1)*batch_size]
-            value[i*batch_size:(i+1)*batch_size] = \
-                self.sess.run(self.ops["fv"], feed_dict={self.test_data:batch})
-        value[value<self.min_log_pdf] = -np.inf
-        return value
+        names  = [eval_ops[o] for o in outputs]
+        values = batch_evaluate(lambda batch: self._run_test(names, batch), data, batch_size)
+        if "fun" in outputs:
+            value = values[list(outputs).index("fun")]
+            value[value<self.min_log_pdf] = -np.inf
+        return values
 
-    def hess_multiple(self, data, batch_size=100):
+    def evaluate_grid(self, r, i=0, j=1, cond=None, outputs=("fun",), kernel_points=None, max_bytes=2**28):
+        '''
+        outputs on the 2-d slice get_grid(r, i, j, cond), where cond (zeros by default) sets the other 
+        dimensions. Values are [len(r), len(r), ...] with dimension j on the first axis, so that
+        plt.pcolor(r, r, value) has dimension i on the x axis. The output "kernel" is the kernel 
+        between kernel_points and the grid, [len(kernel_points), len(r), len(r)].
+        Values are cached for each slice and resolution until the weights change, 
+        and are computed in batches of about max_bytes on placeholders, so the graph does not grow
+        '''
+        if cond is None:
+            cond = np.zeros(self.target.D)
+        h = self.model_hash()
+        if h != self.grid_hash:
+            self.grid_cache = {}
+            self.grid_hash  = h
+        return grid_values(self, r, i, j, cond, outputs, kernel_points, max_bytes)
 
-        neval = data.shape[0]
-        nbatch = neval/batch_size
+    def score_multiple(self, data, batch_size=100):
+        return self.evaluate(data, ["score"], batch_size=batch_size)[0]
 
-        value = np.empty((neval, self.target.D, self.target.D))
+    def grad_multiple(self, data, batch_size=100):
+        return self.evaluate(data, ["grad"], batch_size=batch_size)[0]
 
-        for i in range(nbatch):
-            batch = data[i*batch_size:(i+1)*batch_size]
-            value[i*batch_size:(i+1)*batch_size] = \
-                self.sess.run(self.ops["vv"], feed_dict={self.test_data:batch})
+    def fun_multiple(self, data, batch_size=100):
+        return self.evaluate(data, ["fun"], batch_size=batch_size)[0]
 
-        value = value.reshape(neval, np.prod(self.target.D), np.prod(self.target.D))
-        return value
+    def hess_multiple(self, data, batch_size=100):
+        return self.evaluate(data, ["hess"], batch_size=batch_size)[0]
 
     def setup_mcmc(self, sigma=1.0, num_steps_min=1, num_steps_max=10, step_size_min=0.01, step_size_max=0.1,
                     min_log_pdf=0.0):
 
-        momentum = IsotropicZeroMeanGaussian(sigma=sigma, D=np.prod(self.target.D))
-        self.kmc = KMCStatic(self, momentum, num_steps_min, num_steps_max,
-                            step_size_min, step_size_max)
+        self.mcmc_params = dict(sigma=sigma, num_steps_min=num_steps_min, num_steps_max=num_steps_max, 
+                                step_size_min=step_size_min, step_size_max=step_size_max)
         self.min_log_pdf = min_log_pdf
+        self.kmc = None
 
     def sample(self, N, nchain=1, thin=1, burn=0):
         
-        samples = []
-
         assert N % nchain == 0
 
-        for i in tqdm(range(nchain), ncols=100, desc="one chain"):
-            s = self.sample_one_chain(N/nchain*thin+burn, self.target.sample(1)[0])
-            samples.append(s["samples"][burn::thin])
+        s = self.sample_chains(N/nchain*thin+burn, self.target.sample(nchain))
+        samples = s["samples"][:,burn::thin]
 
-        return np.concatenate(samples, axis=0)
+        return samples.reshape(-1, samples.shape[-1])
+
+    def sample_chains(self, N, start):
+        '''
+        KMC with the surrogate as target, as KMCStatic in mini_mcmc, for all chains in start [nchain, D] at once.
+        Each leapfrog step evaluates fv and gv for the chains that are still moving in one run,
+        each chain draws its own momentum, step size and number of steps, and is accepted on its own.
+        Returns the outputs of sample_one_chain with chains along the first axis
+        '''
+        assert self.mcmc_params is not None
+        p = self.mcmc_params
+        sigma2 = p["sigma"]**2
+
+        def fun_grad(x):
+            f, g = self._run_test(["fv", "gv"], x)
+            f = f.astype(np.float64)
+            f[f<self.min_log_pdf] = -np.inf
+            return f, g.astype(np.float64)
+
+        current = np.array(start, dtype=np.float64)
+        nchain, D = current.shape
+        current_log_pdf, current_grad = fun_grad(current)
+
+        samples    = np.zeros((nchain, N, D))
+        proposals  = np.zeros((nchain, N, D))
+        accepted   = np.zeros((nchain, N))
+        acc_prob   = np.zeros((nchain, N))
+        log_pdf    = np.zeros((nchain, N))
+        times      = np.zeros(N)
+        step_sizes = np.tile([p["step_size_min"], p["step_size_max"]], [N, 1])
+
+        for it in tqdm(range(N), ncols=100, desc="chains"):
+            times[it] = time()
+
+            p0 = np.random.randn(nchain, D) * p["sigma"]
+            num_steps = np.random.randint(p["num_steps_min"], p["num_steps_max"]+1, size=nchain)
+            step_size = np.random.rand(nchain) * (p["step_size_max"] - p["step_size_min"]) + p["step_size_min"]
+            step_size = step_size[:,None]
+
+            # leapfrog, chains stop moving after their own number of steps
+            q = current.copy()
+            m = p0 + step_size / 2 * current_grad
+            q_log_pdf = current_log_pdf.copy()
+            q_grad    = current_grad.copy()
+            for i in range(num_steps.max()):
+                active = i < num_steps
+                q[active] += step_size[active] * m[active] / sigma2
+                q_log_pdf[active], q_grad[active] = fun_grad(q[active])
+                m[active] += step_size[active] / 2 * q_grad[active]
+                inner = i < num_steps - 1
+                m[inner] += step_size[inner] / 2 * q_grad[inner]
+
+            H0 = -current_log_pdf + 0.5 * np.sum(p0**2, 1) / sigma2
+            H  = -q_log_pdf + 0.5 * np.sum(m**2, 1) / sigma2
+            acc_prob[:,it]  = np.exp(np.minimum(0., H0 - H))
+            accepted[:,it]  = np.random.rand(nchain) < acc_prob[:,it]
+            proposals[:,it] = q
+
+            acc = accepted[:,it] == 1
+            current[acc] = q[acc]
+            current_log_pdf[acc] = q_log_pdf[acc]
+            current_grad[acc]    = q_grad[acc]
+
+            samples[:,it] = current
+            log_pdf[:,it] = current_log_pdf
 
+        return dict(samples=samples, proposals=proposals, accepted=accepted, acc_prob=acc_prob,
+            log_pdf=log_pdf, times=times, step_sizes=step_sizes)
 
     def sample_one_chain(self, N, start):
-        assert self.kmc is not None
+        # one chain through kernel_hmc, sample_chains does not need it
+        from kernel_hmc.mini_mcmc.mini_mcmc import mini_mcmc
+        from kernel_hmc.densities.gaussian import IsotropicZeroMeanGaussian
+        from kernel_hmc.proposals.kmc import KMCStatic
+
+        assert self.mcmc_params is not None
+        if self.kmc is None:
+            p = self.mcmc_params
+            momentum = IsotropicZeroMeanGaussian(sigma=p["sigma"], D=np.prod(self.target.D))
+            self.kmc = KMCStatic(self, momentum, p["num_steps_min"], p["num_steps_max"],
+                                p["step_size_min"], p["step_size_max"])
 
         samples, proposals, accepted, acc_prob, log_pdf, times, step_sizes = \
             mini_mcmc(self.kmc, start, N+1, np.prod(self.target.D))
@@ -645,51 +1388,193 @@ class DeepLite(object):
         return dict(samples=samples, proposals=proposals, accepted=accepted, acc_prob=acc_prob,
             log_pdf=log_pdf, times=times, step_sizes=step_sizes)
 
-    def nuts(self, N, thin=10, nchain=10, burn=1000, delta = 0.7):
-        
-        samples = []
-
+    def nuts(self, N, thin=10, nchain=10, burn=1000, delta = 0.7, n_workers=1):
+        '''
+        NUTS chains started from samples of the target, thinned and concatenated in chain order.
+        With n_workers>1 the chains run in a process pool, each worker loads the model 
+        exported by export once and runs its chains with NumpyLite in FDTYPE and its own seed,
+        so both modes evaluate the model in the same precision. NumpyLite needs a gaussian 
+        kernel and points that are not tied to the training data. Serial chains draw from 
+        their own seed too, and the global np.random is left as it was after drawing the seeds.
+        Diagnostics of each chain are kept in nuts_diagnostics
+        '''
         assert N % nchain == 0
+        if n_workers > 1 and (self.model_params["kernel_type"] != "gaussian" or 
+                              self.train_params["points_type"] == "tied"):
+            raise NameError("n_workers>1 runs NumpyLite, which needs a gaussian kernel and points not tied to the data")
+
+        nsample = N*thin/nchain
+        starts  = self.target.sample(nchain)
+        seeds   = np.random.randint(2**31, size=nchain)
+
+        if n_workers > 1:
+            file_name = self.export("nuts_%d" % os.getpid())
+            pool = Pool(n_workers, initializer=_nuts_init, initargs=(file_name,))
+            try:
+                out = pool.map(_nuts_run, [(nsample, starts[i], burn, delta, seeds[i]) for i in range(nchain)])
+            finally:
+                pool.close()
+                pool.join()
+                os.remove("ckpts/"+file_name+".npz")
+        else:
+            out = []
+            for i in tqdm(range(nchain), ncols=100, desc="one chain"):
+                with seeded(seeds[i]):
+                    out.append(nuts_chain(self, nsample, starts[i], burn, delta))
 
-        for i in tqdm(range(nchain), ncols=100, desc="one chain"):
-            s = self.nuts_one_chain(N*thin/nchain, self.target.sample(1)[0], burn, delta)
-            samples.append(s[::thin])
-
-        return np.concatenate(samples, axis=0)
+        self.nuts_diagnostics = [d for _, d in out]
+        return np.concatenate([s[::thin] for s, _ in out], axis=0)
 
     def nuts_one_chain(self, nsample, theta0, Madapt, delta):
         
-        def lnprobfn(x):
-            x = np.atleast_2d(x)
-            return self.fun_multiple(x, batch_size=1)[0]
+        return nuts_chain(self, nsample, theta0, Madapt, delta)[0]
 
-        def gradfn(x):
-            x = np.atleast_2d(x)
-            return self.grad_multiple(x, batch_size=1)[0]
-
-        sampler = NUTSSampler(self.target.D, lnprobfn, gradfn)
-        samples = sampler.run_mcmc(theta0, nsample, Madapt, delta)
-
-        return samples
+    def normaliser_proposal(self, proposal="normal", std=1.0, ncomponent=5, nfit=10**4):
+        '''
+        sampler and log density of an importance proposal
+        "normal":   isotropic N(0, std^2)
+        "gaussian": gaussian fitted to the training data, covariance scaled by std^2
+        "mixture":  GaussianMixture with ncomponent components fitted to the training data, covariances scaled by std^2
+        '''
+        D = self.target.D
+        if proposal == "normal":
+            sample = lambda n: np.random.randn(n, D) * std
+            logpdf = lambda x: norm.logpdf(x, loc=0, scale=std).sum(-1)
+        elif proposal == "gaussian":
+            data = self.target.sample(nfit)
+            q = multivariate_normal(data.mean(0), np.cov(data, rowvar=False) * std**2)
+            sample = lambda n: q.rvs(n).reshape(n, D)
+            logpdf = q.logpdf
+        elif proposal == "mixture":
+            q = GaussianMixture(ncomponent, covariance_type="full", random_state=self.seed).fit(self.target.sample(nfit))
+            q.covariances_ *= std**2
+            q.precisions_cholesky_ /= std
+            sample = lambda n: q.sample(n)[0][np.random.permutation(n)]
+            logpdf = q.score_samples
+        else:
+            raise NameError(proposal + " is not a valid proposal")
+        return sample, logpdf
 
-    def estimate_normaliser(self, n=10**5, batch_size=10**5, std=1.0):
-        
-        s = np.random.randn(n, self.target.D) * std
-        logq = norm.logpdf(s, loc=0, scale=std).sum(-1)
-        logp = self.fun_multiple(s, batch_size=batch_size)
-        self.logZ = logsumexp(logp-logq) - np.log(n)
+    def estimate_normaliser(self, n=10**5, batch_size=10**4, std=1.0, proposal="normal", 
+                            rel_se=None, min_ess=None, **kwargs):
+        '''
+        importance sampling estimate of log Z, drawn in chunks of batch_size with a running logsumexp.
+        Stops after n samples, or earlier once the relative standard error of Z is below rel_se
+        or the effective sample size is above min_ess. The proposal is chosen by normaliser_proposal.
+        ESS, relative standard error and number of samples are kept in self.normaliser_stats
+        '''
+        sample, logpdf = self.normaliser_proposal(proposal, std, **kwargs)
+
+        # running log sums of the weights and of their squares
+        log_sw  = -np.inf
+        log_sw2 = -np.inf
+        ndone   = 0
+
+        while ndone < n:
+            s = sample(min(batch_size, n-ndone))
+            logw = self.fun_multiple(s, batch_size=batch_size) - logpdf(s)
+            log_sw  = np.logaddexp(log_sw,  logsumexp(logw))
+            log_sw2 = np.logaddexp(log_sw2, logsumexp(2*logw))
+            ndone  += s.shape[0]
+
+            ess = np.exp(2*log_sw - log_sw2)
+            se  = np.sqrt(max(1.0/ess - 1.0/ndone, 0))
+            if (rel_se is not None and se < rel_se) or (min_ess is not None and ess > min_ess):
+                break
+
+        self.logZ = log_sw - np.log(ndone)
         self.Z = np.exp(self.logZ)
+        self.normaliser_stats = dict(ess=ess, rel_se=se, n=ndone, proposal=proposal)
+        self._store_normaliser(dict(method="is", n=n, batch_size=batch_size, std=std, proposal=proposal, 
+                                    rel_se=rel_se, min_ess=min_ess, **kwargs))
         return self.logZ
 
     
-    def estimate_data_lik(self, data, batch_size = 1000, **kwargs):
-        if self.logZ is None:
-            self.estimate_normaliser(**kwargs)
+    def estimate_normaliser_ais(self, nparticle=1000, ntemp=100, num_steps=5, step_size=0.1, std=1.0, batch_size=1000):
+        '''
+        annealed importance sampling estimate of log Z.
+        Particles start from the normalised base measure, N(mu, sigma^2) of GaussianBase, 
+        or N(0, std^2) without base, and are moved through log q0 + beta (f - log q0) for 
+        beta from 0 to 1 by HMC with kernel_hmc's leapfrog on grad_multiple of all particles at once.
+        The step size is adapted between temperatures towards an acceptance rate of about 0.65
+        '''
+        D = self.target.D
+        if self.kn.base:
+            mu, sigma = self.sess.run([self.kn.base.mu, self.kn.base.sigma])
+            mu, sigma = float(mu[0]), float(sigma[0])
+        else:
+            mu, sigma = 0.0, std
+
+        logq0  = lambda x: norm.logpdf(x, loc=mu, scale=sigma).sum(-1)
+        dlogq0 = lambda x: -(x - mu) / sigma**2
+        fun    = lambda x: self.fun_multiple(x, batch_size=batch_size)
+
+        # more temperatures close to the base measure, where the density changes fastest
+        betas = np.linspace(0, 1, ntemp+1)**4
+        init_step_size = step_size
+
+        x = mu + np.random.randn(nparticle, D) * sigma
+        f = fun(x)
+        q = logq0(x)
+        logw = np.zeros(nparticle)
+        nevals = 1
+
+        for t in tqdm(range(1, ntemp+1), ncols=100, desc="ais"):
+            beta = betas[t]
+            logw += (beta - betas[t-1]) * (f - q)
+
+            dlogp = lambda y: (1-beta) * dlogq0(y) + beta * self.grad_multiple(y, batch_size=batch_size)
+            p0 = np.random.randn(nparticle, D)
+            x1, p1 = leapfrog_no_storing(x, dlogp, p0, lambda p: -p, step_size, num_steps)
+            f1 = fun(x1)
+            q1 = logq0(x1)
+            nevals += num_steps + 2
+
+            H0 = -((1-beta)*q  + beta*f ) + 0.5*np.sum(p0**2, 1)
+            H1 = -((1-beta)*q1 + beta*f1) + 0.5*np.sum(p1**2, 1)
+            acc_prob = np.exp(np.minimum(0., H0 - H1))
+            acc = np.random.rand(nparticle) < acc_prob
+            x[acc], f[acc], q[acc] = x1[acc], f1[acc], q1[acc]
+
+            step_size *= np.exp(np.mean(acc_prob) - 0.65)
+
+        self.logZ = logsumexp(logw) - np.log(nparticle)
+        self.Z = np.exp(self.logZ)
+        ess = np.exp(2*logsumexp(logw) - logsumexp(2*logw))
+        self.normaliser_stats = dict(ess=ess, rel_se=np.sqrt(max(1.0/ess - 1.0/nparticle, 0)), 
+                                     n=nparticle*nevals, proposal="ais", step_size=step_size)
+        self._store_normaliser(dict(method="ais", nparticle=nparticle, ntemp=ntemp, num_steps=num_steps, 
+                                    step_size=init_step_size, std=std, batch_size=batch_size))
+        return self.logZ
+
+    def estimate_data_lik(self, data, batch_size = 1000, method="is", **kwargs):
+        '''
+        normalised log likelihood of data. logZ and the unnormalised log_pdf of data are taken 
+        from eval_cache when they were computed for the current weights, logZ only if it was 
+        estimated by method with the given kwargs and the defaults of the others, see 
+        normaliser_settings, and are estimated and stored there otherwise
+        '''
+        h = self.model_hash()
+        entry = self.eval_cache.setdefault(h, {})
+        settings = self.normaliser_settings(method, kwargs)
+        if self.logZ is None or self.logZ_hash != h or not normaliser_matches(self.normaliser_stats, settings):
+            if "logZ" in entry and normaliser_matches(entry["normaliser_stats"], settings):
+                self.logZ, self.normaliser_stats = entry["logZ"], entry["normaliser_stats"]
+                self.Z = np.exp(self.logZ)
+                self.logZ_hash = h
+            elif method == "ais":
+                self.estimate_normaliser_ais(**kwargs)
+            else:
+                self.estimate_normaliser(**kwargs)
         
         n = data.shape[0]
         assert self.target.D == data.shape[1]
-        logp = self.fun_multiple(data, batch_size = batch_size)
-        logp -= self.logZ
+        key = (array_key(data), self.min_log_pdf)
+        lik = entry.setdefault("lik", {})
+        if key not in lik:
+            lik[key] = self.fun_multiple(data, batch_size = batch_size)
+            self._write_cache()
+        logp = lik[key] - self.logZ
         return logp
 
 
@@ -716,8 +1601,10 @@ class TrainedDeepLite(object):
             assert points_type in ["train", "opt"]
         else:   
             self.npoint = npoint
+        self.points_type = points_type
 
         self.test_data  = tf.placeholder(FDTYPE, shape=(None, self.D), name="test_data")
+        self.test_points = tf.placeholder(FDTYPE, shape=(None, self.D), name="test_points")
         
         if points_type == "train":
             self.rand_train_data = rand_train_data[:self.npoint]
@@ -757,7 +1644,19 @@ class TrainedDeepLite(object):
         self.kn.npoint = self.npoint
         
         self.hv, self.gv, self.fv = self.kn.evaluate_hess_grad_fun(self.test_data)
+        self.sc = self.kn.individual_score(self.test_data, alpha=self.alpha)[0]
+        self.gram = self.kn.evaluate_gram(self.test_points, self.test_data)
         self.alpha_assign_op = self.kn.opt_score(data=self.train_data)
+
+        # alpha system of the training data and its change from new points, used by update_fit
+        self.update_data = tf.placeholder(FDTYPE, shape=(None, self.D), name="update_data")
+        ndata = tf.cast(tf.shape(self.train_data)[0], FDTYPE)
+        self.alpha_system_op = self.kn.alpha_system_sums(self.kn.statistic_sums(data=self.train_data)[:-1], ndata)
+        self.stat_factors_op = self.kn.statistic_factors(self.update_data)
+        self.alpha_value  = tf.placeholder(FDTYPE, shape=[self.npoint], name="alpha_value")
+        self.alpha_set_op = tf.assign(self.alpha, self.alpha_value)
+        self.online_fit = None
+        self.fit_feed   = {}
         
         init = tf.global_variables_initializer()
         
@@ -775,6 +1674,10 @@ class TrainedDeepLite(object):
         self.sess.run(self.alpha_assign_op)
             
         self.min_log_pdf = -np.inf
+
+        self.fun_grad = self.sess.make_callable([self.fv, self.gv], [self.test_data])
+        self.fun_grad_last = None
+        self.grid_cache = {}
         
     
     def __enter__(self):
@@ -784,53 +1687,108 @@ class TrainedDeepLite(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.sess.close()
 
+    def log_pdf_and_grad(self, x):
+        '''
+        log_pdf and grad at a single point in one call, see DeepLite.log_pdf_and_grad
+        '''
+        x = np.array(x, dtype=FDTYPE)
+        if self.fun_grad_last is None or not np.array_equal(self.fun_grad_last[0], x):
+            f, g = self.fun_grad(x[None,:])
+            self.fun_grad_last = (x, np.float64(f[0]), g[0].astype(np.float64))
+
+        f, g = self.fun_grad_last[1:]
+        if f < self.min_log_pdf:
+            f = -np.inf
+        return f, g
+
     def grad(self, data):
-        return support_1d(lambda x: self.grad_multiple(x, batch_size=1), data)
+        if data.ndim == 1:
+            return self.log_pdf_and_grad(data)[1]
+        return self.grad_multiple(data)
 
     def log_pdf(self, data):
-        return support_1d(lambda x: self.fun_multiple(x, batch_size=1), data)
+        if data.ndim == 1:
+            return self.log_pdf_and_grad(data)[0]
+        return self.fun_multiple(data)
     
-    def grad_multiple(self, data, batch_size=100):
-        
-        neval = data.shape[0]
-        nbatch = neval/batch_size
-        value = np.empty((neval, self.D))
+    def _batch_size(self, outputs, max_bytes, npoint=None):
 
-        for i in range(nbatch):
-            batch = data[i*batch_size:(i+1)*batch_size]
-            value[i*batch_size:(i+1)*batch_size,:] = \
-                self.sess.run(self.gv, feed_dict={self.test_data:batch})   
-        return value
+        if npoint is None:
+            npoint = self.npoint
+        width = max([np.prod(d) for d in self.ndims]) if self.nlayer>0 else 0
+        return eval_batch_size(outputs, max_bytes, self.D, npoint, 1+(self.nlayer>0), width)
+
+    def _run_gram(self, points, data):
+        return self.sess.run(self.gram, feed_dict={self.test_points:points, self.test_data:data})
+
+    def evaluate(self, data, outputs=("fun", "grad", "hess", "score"), max_bytes=2**28, batch_size=None):
+        '''
+        outputs at every row of data in one sess.run per batch, see DeepLite.evaluate
+        '''
+        if batch_size is None:
+            batch_size = self._batch_size(outputs, max_bytes)
+
+        fetches = [getattr(self, eval_ops[o]) for o in outputs]
+        values  = batch_evaluate(lambda batch: self.sess.run(fetches, feed_dict={self.test_data:batch}), 
+                                 data, batch_size)
+        if "fun" in outputs:
+            value = values[list(outputs).index("fun")]
+            value[value<self.min_log_pdf] = -np.inf
+        return values
+
+    def evaluate_grid(self, r, i=0, j=1, cond=None, outputs=("fun",), kernel_points=None, max_bytes=2**28):
+        '''
+        outputs on a 2-d slice, cached until retrain or update_fit, see DeepLite.evaluate_grid
+        '''
+        if cond is None:
+            cond = np.zeros(self.D)
+        return grid_values(self, r, i, j, cond, outputs, kernel_points, max_bytes)
+
+    def score_multiple(self, data, batch_size=100):
+        return self.evaluate(data, ["score"], batch_size=batch_size)[0]
+
+    def grad_multiple(self, data, batch_size=100):
+        return self.evaluate(data, ["grad"], batch_size=batch_size)[0]
         
     def fun_multiple(self, data, batch_size=100):
-        
-        neval = data.shape[0]
-        nbatch = neval/batch_size
-        value = np.empty((neval))
-        
-        for i in range(nbatch):
-
-            batch = data[i*batch_size:(i+1)*batch_size]
-            value[i*batch_size:(i+1)*batch_size] = \
-                self.sess.run(self.fv, feed_dict={self.test_data:batch}) 
-        value[value<self.min_log_pdf] = -np.inf
-        return value
+        return self.evaluate(data, ["fun"], batch_size=batch_size)[0]
         
     def hess_multiple(self, data, batch_size=100):
-        
-        neval = data.shape[0]
-        nbatch = neval/batch_size
-        value = np.empty((neval, self.D, self.D))
-
-        for i in range(nbatch):
-            batch = data[i*batch_size:(i+1)*batch_size]
-            value[i*batch_size:(i+1)*batch_size] = \
-                self.sess.run(self.hv, feed_dict={self.test_data:batch}) 
-        return value
+        return self.evaluate(data, ["hess"], batch_size=batch_size)[0]
     
     def retrain(self, rand_train_data):
         
-        self.sess.run(self.alpha_assign_op, feed_dict={self.train_data:rand_train_data})
+        self.fit_feed = {self.train_data:rand_train_data}
+        self.online_fit = None
+        self.fun_grad_last = None
+        self.grid_cache = {}
+        self.sess.run(self.alpha_assign_op, feed_dict=self.fit_feed)
+
+    def update_fit(self, z_new):
+        '''
+        online update of alpha with the new points z_new, see DeepLite.update_fit
+        '''
+
+        assert self.points_type != "train", "points tied to the training data cannot be updated"
+
+        if self.online_fit is None:
+            quad, lin = self.sess.run(self.alpha_system_op, feed_dict=self.fit_feed)
+            self.online_fit = (np.linalg.cholesky(quad), lin)
+
+        # the factors are taken at the points of the cached system
+        feed = dict(self.fit_feed)
+        feed[self.update_data] = np.atleast_2d(z_new)
+        V, dlin = self.sess.run(self.stat_factors_op, feed_dict=feed)
+        V = V[:, np.any(V!=0, 0)]
+
+        L, lin = self.online_fit
+        L   = chol_update(L, V)
+        lin = lin + dlin
+        self.online_fit = (L, lin)
+
+        self.fun_grad_last = None
+        self.grid_cache = {}
+        self.sess.run(self.alpha_set_op, feed_dict={self.alpha_value: cho_solve((L, True), lin)})
 
     def setup_mcmc(self, sigma=1.0, num_steps_min=1, num_steps_max=10, step_size_min=0.01, step_size_max=0.1,
                     min_log_pdf=0.0):
@@ -1,6 +1,7 @@
 import tensorflow as tf
 import numpy as np
 from collections import OrderedDict
+from contextlib import contextmanager
 import operator
 import itertools
 from time import time
@@ -40,6 +41,96 @@ def pow_10(x, name, **kwargs):
 
     return tf.pow(np.array(10,dtype=FDTYPE), var, name=name)
 
+# depth of no_memoise scopes
+memo_off   = [0]
+
+def memo_cache(graph):
+    # outputs of memoised kernel methods in graph, kept on the graph so that they go with it
+    if not hasattr(graph, "_memo_cache"):
+        graph._memo_cache = {}
+    return graph._memo_cache
+
+def memoise(method):
+    '''
+    cache the output of a kernel method on its input tensors, so that a graph
+    computes e.g. the network features of the points only once however many
+    kernel methods use them. Each graph has its own cache, dropped by reset_memo.
+    Inside no_memoise nothing is cached or reused
+    '''
+    def wrapper(self, *args):
+        if memo_off[0] or not all([isinstance(a, (tf.Tensor, tf.Variable)) for a in args]):
+            return method(self, *args)
+        cache = memo_cache(tf.get_default_graph())
+        key = (self, method.__name__) + args
+        if key not in cache:
+            cache[key] = method(self, *args)
+        return cache[key]
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__  = method.__doc__
+    return wrapper
+
+def reset_memo(graph=None):
+    '''
+    drop the memoised outputs of graph, the default graph if None
+    '''
+    if graph is None:
+        graph = tf.get_default_graph()
+    graph._memo_cache = {}
+
+@contextmanager
+def no_memoise():
+    '''
+    build without memoise, for while loop bodies and tf.device scopes
+    whose outputs cannot be reused outside them
+    '''
+    memo_off[0] += 1
+    try:
+        yield
+    finally:
+        memo_off[0] -= 1
+
+def conjugate_gradient(matvec, b, x0, diag, niter, tol):
+    '''
+    solve A x = b for a symmetric positive definite A given by matvec(v) = A v,
+    preconditioned by the diagonal of A. Starts from x0 and stops after niter 
+    iterations or when the residual is below tol * |b|
+    '''
+    r  = b - matvec(x0)
+    z  = r / diag
+    rz = tf.reduce_sum(r * z)
+    bound = tf.square(tol) * tf.reduce_sum(tf.square(b))
+
+    def cond(i, x, r, p, rz):
+        return tf.logical_and(i < niter, tf.reduce_sum(tf.square(r)) > bound)
+
+    def body(i, x, r, p, rz):
+        Ap = matvec(p)
+        a  = rz / tf.reduce_sum(p * Ap)
+        x  = x + a * p
+        r  = r - a * Ap
+        z  = r / diag
+        rz_new = tf.reduce_sum(r * z)
+        p  = z + rz_new / rz * p
+        return i+1, x, r, p, rz_new
+
+    return tf.while_loop(cond, body, (tf.constant(0), x0, r, z, rz))[1]
+
+@tf.custom_gradient
+def spd_solve(quad, lin):
+    '''
+    solve quad x = lin for a symmetric positive definite quad with one Cholesky factorisation.
+    The backward pass reuses the factor: for a loss with gradient g at x, 
+    lin gets lam = quad^-1 g and quad gets the outer product -lam x^T
+    '''
+    L = tf.cholesky(quad)
+    x = tf.cholesky_solve(L, lin[:,None])[:,0]
+
+    def grad(dx):
+        lam = tf.cholesky_solve(L, dx[:,None])[:,0]
+        return -lam[:,None] * x[None,:], lam
+
+    return x, grad
+
 # =====================            
 # Kernel related
 # =====================            
@@ -49,10 +140,21 @@ class LiteModel:
 
     def __init__(self, kernel, alpha = None, points = None, 
                 init_log_lam = 0.0, log_lam_weights=-3, noise_std=0.0, 
-                simple_lite=False, lam = None, base=False):
+                simple_lite=False, lam = None, base=False, chunk_size=None, cg_iter=None, cg_tol=1e-5):
         
         self.kernel = kernel
         self.base   = base
+        # kernel outputs of an earlier model in the graph are not reused
+        reset_memo()
+        # number of data points whose kernel derivatives are held in memory at once
+        # None computes the statistics of all data in one go
+        self.chunk_size = chunk_size
+        # opt_alpha solves for alpha by at most cg_iter conjugate gradient iterations 
+        # instead of forming and factorising quad, None uses spd_solve.
+        # chunk_size also bounds the memory of each conjugate gradient matvec
+        self.cg_iter = cg_iter
+        self.cg_tol  = cg_tol
+        self.alpha_warm = None
 
         if alpha is None:
             self.alpha = tf.zeros([1], dtype=FDTYPE)
@@ -78,12 +180,24 @@ class LiteModel:
         if points is not None:
             self.set_points(points)
 
+        # alpha of the last conjugate gradient solve, starting point of the next,
+        # only for points with a static number of rows
+        if cg_iter is not None and points is not None:
+            nalpha = self.npoint if self.kernel.has_features() else points.shape[0].value
+            if nalpha is not None:
+                self.alpha_warm = tf.Variable(tf.zeros([nalpha], dtype=FDTYPE), 
+                                              trainable=False, name="alpha_warm")
+
         if base:
             self.base = GaussianBase(self.ndim_in[0], 2)
     def _score_statistics(self, data=None, add_noise=False, take_mean=True):
         
         ''' compute the vector b and matrix C
             Y: the input data to the lite model to fit
+
+            take_mean=True returns the statistics averaged over data, contracted
+            directly to npoint x npoint. take_mean=False keeps one copy per data
+            point, i.e. npoint x npoint x ndata tensors for G2 and H2
         '''
         if data is None: 
             data = tf.placeholder(FDTYPE, shape = (None,) + self.ndim_in)
@@ -91,8 +205,13 @@ class LiteModel:
         if self.noise_std > 0 and add_noise:
             data = data + self.noise_std * tf.random_normal(tf.shape(data))
 
-        d2kdx2, dkdx = self.kernel.get_sec_grad(self.X, data)
-        npoint = tf.shape(self.X)[0]
+        if take_mean:
+            ndata = tf.cast(tf.shape(data)[0], FDTYPE)
+            stats = self._accumulate_statistics(data)[0]
+            return tuple([s / ndata for s in stats]) + (data,)
+
+        d2kdx2, dkdx = self._basis_sec_grad(data)
+        npoint = tf.shape(d2kdx2)[0]
         ndata  = tf.shape(data)[0]
         
         
@@ -108,11 +227,6 @@ class LiteModel:
         H2 = tf.einsum('ikl,jkl->ijk',
                       d2kdx2, d2kdx2)
 
-        if take_mean:
-            H = tf.reduce_mean(H,1)
-            G2 = tf.reduce_mean(G2,2)
-            H2 = tf.reduce_mean(H2,2)
-
         if self.base:
 
             d2qdx2, dqdx = self.base.get_sec_grad(data)
@@ -133,27 +247,241 @@ class LiteModel:
             HqH= tf.zeros([npoint, ndata], dtype=FDTYPE)
             qH2 = tf.zeros([1], dtype=FDTYPE)
             
-        if take_mean:
+        return H, G2, H2, GqG, qG2, qH, HqH, qH2, data
 
-            GqG  = tf.reduce_mean(GqG, -1)
-            qG2 = tf.reduce_mean(qG2)
-            qH = tf.reduce_mean(qH)
+    def _statistic_sums(self, data, alpha=None):
+        '''
+        sums over data of H, G2, H2, GqG, qG2, qH, HqH, qH2
 
-            HqH= tf.reduce_mean(HqH,-1)
-            qH2 = tf.reduce_mean(qH2)
+        the data and input dimensions are folded into one axis so that G2 and H2
+        are single npoint x (ndata*D) matmuls and nothing of size
+        npoint x npoint x ndata is built.
+        If alpha is given, also returns the score of each data point
 
-        return H, G2, H2, GqG, qG2, qH, HqH, qH2, data
+        with an explicit feature kernel the sums are taken over the features,
+        the statistics of the feature weights
+        '''
+
+        if self._gaussian_kernels() is not None:
+            return self._gaussian_statistic_sums(data, alpha)
+
+        d2kdx2, dkdx = self._basis_sec_grad(data)
+        # number of points, or of features
+        npoint = tf.shape(d2kdx2)[0]
+        ndata  = tf.shape(data)[0]
+
+        d2kdx2 = tf.reshape(d2kdx2, [npoint, ndata, -1])
+        dkdx   = tf.reshape(dkdx,   [npoint, ndata, -1])
+
+        d2kdx2_flat = tf.reshape(d2kdx2, [npoint, -1])
+        dkdx_flat   = tf.reshape(dkdx,   [npoint, -1])
+
+        H  = tf.reduce_sum(d2kdx2_flat, 1)
+        G2 = tf.matmul(dkdx_flat,   dkdx_flat,   transpose_b=True)
+        H2 = tf.matmul(d2kdx2_flat, d2kdx2_flat, transpose_b=True)
+
+        if self.base:
+
+            d2qdx2, dqdx = self.base.get_sec_grad(data)
+            d2qdx2 = tf.reshape(d2qdx2, [ndata, -1])
+            dqdx   = tf.reshape(dqdx,   [ndata, -1])
+
+            GqG = tf.reduce_sum(dkdx * dqdx[None,:,:], [1,2])
+            qG2 = tf.reduce_sum(tf.square(dqdx))
+            qH  = tf.reduce_sum(d2qdx2)
+
+            HqH = tf.reduce_sum(d2kdx2 * d2qdx2[None,:,:], [1,2])
+            qH2 = tf.reduce_sum(tf.square(d2qdx2))
+
+        else:
+
+            GqG = tf.zeros([npoint], dtype=FDTYPE)
+            qG2 = tf.zeros([], dtype=FDTYPE)
+            qH  = tf.zeros([], dtype=FDTYPE)
+
+            HqH = tf.zeros([npoint], dtype=FDTYPE)
+            qH2 = tf.zeros([], dtype=FDTYPE)
+
+        stats = (H, G2, H2, GqG, qG2, qH, HqH, qH2)
+
+        if alpha is None:
+            return stats, None
+
+        # score of each point = sum_d d2f/dx_d^2 + 0.5 * (df/dx_d)^2
+        # contracted with alpha first to stay linear in ndata
+        grad = tf.tensordot(alpha, dkdx,   [[0],[0]])
+        sec  = tf.tensordot(alpha, d2kdx2, [[0],[0]])
+        if self.base:
+            grad = grad + dqdx
+            sec  = sec  + d2qdx2
+        score = tf.reduce_sum(sec, -1) + 0.5 * tf.reduce_sum(tf.square(grad), -1)
+
+        return stats, score
+
+    def _gaussian_kernels(self):
+        # (kernel, prop) pairs if the kernel is a bare GaussianKernel or a mixture of them
+        if isinstance(self.kernel, GaussianKernel):
+            return [(self.kernel, 1.0)]
+        if isinstance(self.kernel, MixtureKernel) and \
+                all([isinstance(k, GaussianKernel) for k in self.kernel.kernels]):
+            return list(zip(self.kernel.kernels, self.kernel.props))
+        return None
+
+    def _gaussian_weights(self, data):
+        '''
+        for bare Gaussian kernels, with a = x - y
+        dk/dy = Kw * a  and  d2k/dy2 = K2w * a^2 - Kw
+        Kw = sum prop*k/sigma, K2w = sum prop*k/sigma^2, both npoint x ndata
+        returns K2w, Kw, the gram matrix and the squared distances
+        '''
+
+        kernels = self._gaussian_kernels()
+        pdist2  = kernels[0][0].get_pdist2(self.X, data)
+
+        K2w  = tf.zeros([], dtype=FDTYPE)
+        Kw   = tf.zeros([], dtype=FDTYPE)
+        gram = tf.zeros([], dtype=FDTYPE)
+
+        for kernel, prop in kernels:
+            k    = tf.exp(-0.5/kernel.sigma*pdist2) * prop
+            gram = gram + k
+            Kw   = Kw   + k / kernel.sigma
+            K2w  = K2w  + k / tf.square(kernel.sigma)
+
+        return K2w, Kw, gram, pdist2
+
+    def _gaussian_grad(self, Kw, data, alpha):
+        # sum_m alpha_m Kw_mn (x_m - y_n)
+        aK = alpha[:,None] * Kw
+        return tf.matmul(aK, self.X, transpose_a=True) - tf.reduce_sum(aK, 0)[:,None] * data
+
+    def _gaussian_statistic_sums(self, data, alpha=None):
+        '''
+        _statistic_sums for bare Gaussian kernels in closed form, from matmuls of 
+        the points and data so that nothing of size npoint x ndata x D is built.
+        H2 is summed one input dimension at a time
+        '''
+
+        X = self.X
+        K2w, Kw, _, pdist2 = self._gaussian_weights(data)
+        npoint = tf.shape(X)[0]
+        ndim   = tf.cast(tf.shape(data)[1], FDTYPE)
+
+        # sum_d d2k/dy_d^2 = K2w * |x-y|^2 - D * Kw
+        sec = K2w * pdist2 - ndim * Kw
+
+        H  = tf.reduce_sum(sec, 1)
+
+        # G2_ml = sum_n Kw_mn Kw_ln (x_m - y_n).(x_l - y_n)
+        KXY = Kw * tf.matmul(X, data, transpose_b=True)
+        G2  = tf.matmul(X, X, transpose_b=True) * tf.matmul(Kw, Kw, transpose_b=True) \
+              - tf.matmul(KXY, Kw, transpose_b=True) - tf.matmul(Kw, KXY, transpose_b=True) \
+              + tf.matmul(Kw * tf.reduce_sum(tf.square(data), 1)[None,:], Kw, transpose_b=True)
+
+        def add_dim(H2, xy):
+            d2k = K2w * tf.square(xy[:npoint,None] - xy[None,npoint:]) - Kw
+            return H2 + tf.matmul(d2k, d2k, transpose_b=True)
+
+        H2 = tf.foldl(add_dim, tf.transpose(tf.concat([X, data], 0)), 
+                      initializer=tf.zeros([npoint, npoint], dtype=FDTYPE))
+
+        if self.base:
+
+            d2qdx2, dqdx = self.base.get_sec_grad(data)
+
+            GqG = tf.reduce_sum(Kw * (tf.matmul(X, dqdx, transpose_b=True) - 
+                                      tf.reduce_sum(data * dqdx, 1)[None,:]), 1)
+            qG2 = tf.reduce_sum(tf.square(dqdx))
+            qH  = tf.reduce_sum(d2qdx2)
+
+            HqH = tf.reduce_sum(K2w * (tf.matmul(tf.square(X), d2qdx2, transpose_b=True) -
+                                       2 * tf.matmul(X, data * d2qdx2, transpose_b=True) + 
+                                       tf.reduce_sum(tf.square(data) * d2qdx2, 1)[None,:]) - 
+                                Kw * tf.reduce_sum(d2qdx2, 1)[None,:], 1)
+            qH2 = tf.reduce_sum(tf.square(d2qdx2))
+
+        else:
+
+            GqG = tf.zeros([npoint], dtype=FDTYPE)
+            qG2 = tf.zeros([], dtype=FDTYPE)
+            qH  = tf.zeros([], dtype=FDTYPE)
+
+            HqH = tf.zeros([npoint], dtype=FDTYPE)
+            qH2 = tf.zeros([], dtype=FDTYPE)
+
+        stats = (H, G2, H2, GqG, qG2, qH, HqH, qH2)
+
+        if alpha is None:
+            return stats, None
+
+        grad = self._gaussian_grad(Kw, data, alpha)
+        sec  = tf.tensordot(alpha, sec, [[0],[0]])
+        if self.base:
+            grad = grad + dqdx
+            sec  = sec  + tf.reduce_sum(d2qdx2, -1)
+        score = sec + 0.5 * tf.reduce_sum(tf.square(grad), -1)
+
+        return stats, score
+
+    def _accumulate_statistics(self, data, alpha=None):
+        '''
+        sums of the score statistics over data, computed self.chunk_size data 
+        points at a time when chunk_size is set. Returns the sums and, if alpha 
+        is given, the score of each data point
+        '''
+
+        if self.chunk_size is None:
+            return self._statistic_sums(data, alpha)
+
+        chunk_size = self.chunk_size
+        npoint = self.npoint
+        ndata  = tf.shape(data)[0]
+        nchunk = (ndata + chunk_size - 1) // chunk_size
+
+        init = (tf.zeros([npoint], dtype=FDTYPE), 
+                tf.zeros([npoint, npoint], dtype=FDTYPE), 
+                tf.zeros([npoint, npoint], dtype=FDTYPE),
+                tf.zeros([npoint], dtype=FDTYPE), 
+                tf.zeros([], dtype=FDTYPE), 
+                tf.zeros([], dtype=FDTYPE), 
+                tf.zeros([npoint], dtype=FDTYPE), 
+                tf.zeros([], dtype=FDTYPE))
+        invariants = tuple([tf.TensorShape([None]*len(s.shape)) for s in init])
+
+        scores = tf.TensorArray(FDTYPE, size=nchunk, infer_shape=False, 
+                                element_shape=tf.TensorShape([None]))
+
+        def body(i, stats, scores):
+            chunk = data[i*chunk_size:(i+1)*chunk_size]
+            with no_memoise():
+                chunk_stats, chunk_score = self._statistic_sums(chunk, alpha)
+            stats = tuple([s + cs for s, cs in zip(stats, chunk_stats)])
+            if alpha is not None:
+                scores = scores.write(i, chunk_score)
+            return i+1, stats, scores
+
+        _, stats, scores = tf.while_loop(lambda i, stats, scores: i < nchunk, body, 
+                                        (tf.constant(0), init, scores), 
+                                        shape_invariants=(tf.TensorShape([]), invariants, 
+                                                          tf.TensorShape(None)))
+        if alpha is None:
+            return stats, None
+        return stats, scores.concat()
     
     def individual_score(self, data, alpha=None, add_noise=False):
-        
-        H, G2, H2, GqG, qG2, qH, HqH, qH2, data = self._score_statistics(data=data, add_noise=add_noise, take_mean=False)
+        '''
+        score of each data point, the statistics returned are averaged over data
+        '''
 
         if alpha is None:
             alpha = self.alpha
 
-        s2 = tf.einsum('i,ij->j', alpha, H) + qH
-        s1 = 0.5 * (tf.einsum('i,ijk,j->k', alpha, G2, alpha) + qG2) + tf.einsum("i,ij->j", alpha , GqG)
-        score  =  s1 + s2
+        if self.noise_std > 0 and add_noise:
+            data = data + self.noise_std * tf.random_normal(tf.shape(data))
+
+        ndata = tf.cast(tf.shape(data)[0], FDTYPE)
+        stats, score = self._accumulate_statistics(data, alpha)
+        H, G2, H2, GqG, qG2, qH, HqH, qH2 = [s / ndata for s in stats]
 
         return score, H, G2, H2, GqG, qG2, qH, HqH, qH2, data
 
@@ -171,47 +499,406 @@ class LiteModel:
         return score, H, G2, H2, GqG, qG2, qH, HqH, qH2, data
 
     def kde_loss(self, data, kde):
-
-        kde_delta = kde[:,None] - kde[None,:]
-        delta = self.evaluate_gram(self.X, data)[:,:]
-        delta = tf.einsum("i,ijk->jk", self.alpha, delta[:,:,None] - delta[:,None,:])
+        '''
+        mean over pairs (i, j) of ((f_i - f_j) - (kde_i - kde_j))^2, which is 2 var(f - kde)
+        '''
+        r = tf.tensordot(self.alpha, self._basis_gram(data), [[0],[0]]) - kde
         if self.base:
-            q0 = self.base.get_fun(data)
-            delta = delta + (q0[:,None] - q0[None,:])
-        loss = tf.reduce_sum(tf.square(delta - kde_delta)) / tf.cast((tf.reduce_prod(tf.shape(kde_delta))), FDTYPE)
+            r = r + self.base.get_fun(data)
+        loss = 2 * (tf.reduce_mean(tf.square(r)) - tf.square(tf.reduce_mean(r)))
         return loss
 
 
+    def _alpha_system(self, H, G2, H2, GqG, HqH, data=None, kde=None, lam_alpha=None, lam_curve=None, 
+                      lam_norm=None):
+        '''
+        quadratic and linear terms of the regularised score as a function of alpha, 
+        the optimal alpha solves quad * alpha = lin
+        '''
+
+        if lam_alpha is None:
+            lam_alpha = self.lam_alpha
+        if lam_curve is None:
+            lam_curve = self.lam_curve
+        if lam_norm is None:
+            lam_norm = self.lam_norm
+
+        quad =  (G2 + 
+                self.K*lam_norm+
+                tf.eye(self.npoint, dtype=FDTYPE)*lam_alpha+
+                H2 * lam_curve)
+        
+        lin  =  -(H + GqG + 
+                HqH * lam_curve)
+        
+        if kde is not None:
+            # the mean over pairs (i, j) of the squared differences (k_i - k_j) (k_i - k_j)^T
+            # is 2 times the covariance over data, so the pairs are never formed
+            ndata = tf.cast(tf.shape(kde)[0], FDTYPE)
+            quad_kde, lin_kde = self._kde_system(self.kde_sums(data, kde), ndata)
+            quad  = quad + quad_kde
+            lin   = lin  + lin_kde
+
+        return quad, lin
+
     def opt_alpha(self, data=None, kde=None):
         # score     = (alpha * H + qH) + [ (0.5 * alpha * G2 * alpha) + (alpha * G * qG) + (0.5*qG2) ]
         # curvature = (0.5 * alpha * H2 * alpha) + (alpha * H * qH)  + (0.5 * qH2)
 
+        if self.cg_iter is not None:
+            # no statistics are built, they are returned as None
+            if data is None: 
+                data = tf.placeholder(FDTYPE, shape = (None,) + self.ndim_in)
+            if self.noise_std > 0:
+                data = data + self.noise_std * tf.random_normal(tf.shape(data))
+            alpha, alpha_step = self.cg_alpha(data, kde)
+            return (alpha,) + (None,) * 8 + (data, alpha_step)
+
         H, G2, H2, GqG, qG2, qH, HqH, qH2, data = self._score_statistics(data=data, add_noise=True)
 
-        quad =  (G2 + 
-                self.K*self.lam_norm+
-                tf.eye(self.npoint, dtype=FDTYPE)*self.lam_alpha+
-                H2 * self.lam_curve)
+        quad, lin = self._alpha_system(H, G2, H2, GqG, HqH, data, kde)
         
-        lin  =  -(H + GqG + 
-                HqH * self.lam_curve)
+        alpha = spd_solve(quad, lin)
+        alpha_step = lambda a: (tf.matmul(quad, a[:,None]) - lin[:,None])[:,0]
+        return alpha,H, G2, H2, GqG, qG2, qH, HqH, qH2, data, alpha_step
+
+    def alpha_path(self, lams, train_data=None, valid_data=None, train_kde=None, norm_path=False):
+        '''
+        optimal alpha and validation score for every lam_alpha in lams, with lam_norm 
+        taking the same values if norm_path, as lam does for simple_lite.
+        The rest of the quadratic term is eigendecomposed once, after which each
+        lam costs O(npoint^2) instead of a new solve. The validation scores are
+        only built if valid_data is given.
+
+        returns alphas (nlam x npoint), validation scores (nlam) or None, train_data, valid_data
+        '''
+
+        lams = tf.convert_to_tensor(lams, dtype=FDTYPE)
+
+        H, G2, H2, GqG, qG2, qH, HqH, qH2, train_data = self._score_statistics(data=train_data, add_noise=True)
+        if norm_path:
+            quad, lin = self._alpha_system(H, G2, H2, GqG, HqH, train_data, train_kde, lam_alpha=0.0, lam_norm=0.0)
+            # quad + lam (K + I) = C (C^-1 quad C^-T + lam I) C^T  with  C C^T = K + I
+            C = tf.cholesky(self.K + tf.eye(self.npoint, dtype=FDTYPE))
+            quad = tf.matrix_triangular_solve(C, tf.transpose(tf.matrix_triangular_solve(C, quad)))
+            lin  = tf.matrix_triangular_solve(C, lin[:,None])[:,0]
+        else:
+            quad, lin = self._alpha_system(H, G2, H2, GqG, HqH, train_data, train_kde, lam_alpha=0.0)
+
+        # quad = U diag(e) U^T  =>  alpha(lam) = U diag(1/(e+lam)) U^T lin
+        e, U = tf.self_adjoint_eig(quad)
+        coef = tf.matmul(U, lin[:,None], transpose_a=True)
+        alphas = tf.matmul(U, coef / (e[:,None] + lams[None,:]))
+        if norm_path:
+            alphas = tf.matrix_triangular_solve(C, alphas, adjoint=True)
+        alphas = tf.transpose(alphas)
+
+        if valid_data is None:
+            return alphas, None, train_data, valid_data
+
+        #  ====== validation ======
+        H, G2, H2, GqG, qG2, qH, HqH, qH2, valid_data = self._score_statistics(data=valid_data, add_noise=True)
+
+        s2 = tf.matmul(alphas, H[:,None])[:,0] + qH
+        s1 = 0.5 * (tf.reduce_sum(tf.matmul(alphas, G2) * alphas, 1) + qG2) + tf.matmul(alphas, GqG[:,None])[:,0]
+        scores = s1 + s2
+
+        return alphas, scores, train_data, valid_data
+
+    def cross_validate(self, lam_alphas, lam_curves, data=None, nfold=5):
+        '''
+        nfold cross-validation score for every lam_alpha in lam_alphas and lam_curve in lam_curves,
+        the data are split into nfold contiguous folds, see cv_scores_from_sums
+
+        returns scores (nlam_alpha x nlam_curve), scores of each fold, data
+        '''
+
+        if data is None: 
+            data = tf.placeholder(FDTYPE, shape = (None,) + self.ndim_in)
+
+        ndata  = tf.shape(data)[0]
+        bounds = [ndata * i // nfold for i in range(nfold+1)]
+        folds  = [data[bounds[i]:bounds[i+1]] for i in range(nfold)]
+
+        fold_sums  = zip(*[self._accumulate_statistics(fold)[0] for fold in folds])
+        fold_sums  = [tf.stack(s) for s in fold_sums]
+        fold_ndata = tf.cast(tf.stack([bounds[i+1] - bounds[i] for i in range(nfold)]), FDTYPE)
+
+        return self.cv_scores_from_sums(fold_sums, fold_ndata, lam_alphas, lam_curves) + (data,)
+
+    def cv_scores_from_sums(self, fold_sums, fold_ndata, lam_alphas, lam_curves):
+        '''
+        cross-validation scores from the statistic sums of each fold, see statistic_sums, 
+        stacked along a first axis of nfold, and the number of data in each fold.
+        The statistics of the data outside a fold are the total minus the fold,
+        so each fold and pair of lams costs one solve and no pass over the data.
+
+        returns scores (nlam_alpha x nlam_curve) averaged over the data, 
+        and the validation score of each fold (nfold x nlam_alpha x nlam_curve)
+        '''
+
+        lam_alphas = tf.convert_to_tensor(lam_alphas, dtype=FDTYPE)
+        lam_curves = tf.convert_to_tensor(lam_curves, dtype=FDTYPE)
+
+        total  = [tf.reduce_sum(s, 0) for s in fold_sums]
+        ntotal = tf.reduce_sum(fold_ndata)
+
+        def fold_score(args):
+            sums, ndata = args[:-1], args[-1]
+            H, G2, H2, GqG, _, _, HqH, _ = [(t - s) / (ntotal - ndata) for t, s in zip(total, sums)]
+            quad, lin = self._alpha_system(H, G2, H2, GqG, HqH, lam_alpha=0.0, lam_curve=0.0)
+
+            # systems for all pairs of lams, nlam_alpha x nlam_curve x npoint (x npoint)
+            eye  = tf.eye(self.npoint, dtype=FDTYPE)
+            quad = quad + lam_alphas[:,None,None,None] * eye + lam_curves[None,:,None,None] * H2
+            lin  = lin - lam_curves[:,None] * HqH
+            lin  = tf.tile(lin[None,:,:,None], [tf.shape(lam_alphas)[0], 1, 1, 1])
+            alphas = tf.cholesky_solve(tf.cholesky(quad), lin)[...,0]
+
+            # as in alpha_path
+            H, G2, H2, GqG, qG2, qH, HqH, qH2 = [s / ndata for s in sums]
+            return tf.tensordot(alphas, H, [[2],[0]]) + qH + \
+                   0.5 * (tf.reduce_sum(tf.tensordot(alphas, G2, [[2],[0]]) * alphas, 2) + qG2) + \
+                   tf.tensordot(alphas, GqG, [[2],[0]])
+
+        fold_scores = tf.map_fn(fold_score, tuple(fold_sums) + (fold_ndata,), dtype=FDTYPE)
+        scores = tf.tensordot(fold_ndata, fold_scores, [[0],[0]]) / ntotal
+
+        return scores, fold_scores
+
+    def statistic_sums(self, data=None, add_noise=False):
+        '''
+        sums over data of H, G2, H2, GqG, qG2, qH, HqH, qH2. 
+        These can be added up over chunks of a dataset too large for one run 
+        and passed to opt_alpha_from_sums
+        '''
+        if data is None: 
+            data = tf.placeholder(FDTYPE, shape = (None,) + self.ndim_in)
         
+        if self.noise_std > 0 and add_noise:
+            data = data + self.noise_std * tf.random_normal(tf.shape(data))
+
+        return self._accumulate_statistics(data)[0] + (data,)
+
+    def kde_sums(self, data, kde):
+        '''
+        sums over data of the gram k(X, y), of its outer products, of the gram times kde 
+        and of kde, from which _kde_system finds the kde regulariser. 
+        These add up over chunks like statistic_sums
+        '''
+
+        if self.base:
+            kde = kde - self.base.get_fun(data)
+        gram = self._basis_gram(data)
+
+        return tf.reduce_sum(gram, 1), tf.matmul(gram, gram, transpose_b=True), \
+               tf.tensordot(gram, kde, [[1],[0]]), tf.reduce_sum(kde)
+
+    def _kde_system(self, kde_sums, ndata):
+        # the kde terms of quad and lin in _alpha_system from kde_sums over ndata points,
+        # the covariances over data are the mean products less the products of the means
+        gram, gram2, gram_kde, kde = kde_sums
+        gram_mean = gram / ndata
+        quad = self.lam_kde * 2 * (gram2 / ndata - gram_mean[:,None] * gram_mean[None,:])
+        lin  = self.lam_kde * 2 * (gram_kde / ndata - gram_mean * kde / ndata)
+        return quad, lin
+
+    def opt_alpha_from_sums(self, sums, ndata, kde_sums=None):
+        '''
+        optimal alpha from statistics summed over ndata points, see statistic_sums,
+        and for the kde regulariser the kde_sums of the same points
+        '''
+
+        H, G2, H2, GqG, qG2, qH, HqH, qH2 = [s / ndata for s in sums]
+        quad, lin = self._alpha_system(H, G2, H2, GqG, HqH)
+        if kde_sums is not None:
+            quad_kde, lin_kde = self._kde_system(kde_sums, ndata)
+            quad, lin = quad + quad_kde, lin + lin_kde
+        alpha = spd_solve(quad, lin)
+        return alpha
+
+    def alpha_system_sums(self, sums, ndata, kde_sums=None):
+        '''
+        quad and lin of the alpha system from statistics summed over ndata points,
+        multiplied by ndata so that new points simply add to them, see statistic_factors.
+        kde_sums of the same points add the kde regulariser
+        '''
+
+        H, G2, H2, GqG, qG2, qH, HqH, qH2 = [s / ndata for s in sums]
+        quad, lin = self._alpha_system(H, G2, H2, GqG, HqH)
+        if kde_sums is not None:
+            quad_kde, lin_kde = self._kde_system(kde_sums, ndata)
+            quad, lin = quad + quad_kde, lin + lin_kde
+        return quad * ndata, lin * ndata
+
+    def _score_curvature(self, data, alpha):
+        '''
+        mean over data of the score and of the curvature 0.5 * |d2f/dx2|^2 at alpha, 
+        in one pass over data that builds nothing of size npoint x npoint
+        '''
+
+        def fn(d):
+            d2kdx2, dkdx = self._basis_sec_grad(d)
+            npoint = tf.shape(d2kdx2)[0]
+            ndata  = tf.shape(d)[0]
+            grad = tf.tensordot(alpha, tf.reshape(dkdx,   [npoint, ndata, -1]), [[0],[0]])
+            sec  = tf.tensordot(alpha, tf.reshape(d2kdx2, [npoint, ndata, -1]), [[0],[0]])
+            if self.base:
+                d2qdx2, dqdx = self.base.get_sec_grad(d)
+                grad = grad + tf.reshape(dqdx,   [ndata, -1])
+                sec  = sec  + tf.reshape(d2qdx2, [ndata, -1])
+            return [tf.reduce_sum(sec) + 0.5 * tf.reduce_sum(tf.square(grad)), 0.5 * tf.reduce_sum(tf.square(sec))]
+
+        ndata = tf.cast(tf.shape(data)[0], FDTYPE)
+        score, curve = self._chunk_sum(fn, [[], []], data)
+        return score / ndata, curve / ndata
+
+    def statistic_factors(self, data):
+        '''
+        change of the system of alpha_system_sums when data are added,
+        quad += V V^T and lin += dlin, V is npoint x (2 * ndata * D)
+        '''
+
+        dkdx, d2kdx2, dlin = self._data_factors(data)
+        V = tf.concat([dkdx, d2kdx2 * tf.sqrt(self.lam_curve)], 1)
+        return V, dlin
+
+    def _data_factors(self, data):
+        '''
+        kernel derivatives at data flattened to npoint x (ndata * D), dkdx and d2kdx2, 
+        and the sum over data of their terms in lin
+        '''
+
+        d2kdx2, dkdx = self._basis_sec_grad(data)
+        npoint = tf.shape(d2kdx2)[0]
+
+        d2kdx2 = tf.reshape(d2kdx2, [npoint, -1])
+        dkdx   = tf.reshape(dkdx,   [npoint, -1])
+
+        dlin = -tf.reduce_sum(d2kdx2, 1)
+        if self.base:
+            d2qdx2, dqdx = self.base.get_sec_grad(data)
+            dlin = dlin - tf.tensordot(dkdx, tf.reshape(dqdx, [-1]), [[1],[0]]) \
+                        - tf.tensordot(d2kdx2, tf.reshape(d2qdx2, [-1]), [[1],[0]]) * self.lam_curve
+
+        return dkdx, d2kdx2, dlin
+
+    def _chunk_sum(self, fn, shapes, *tensors):
+        '''
+        sums of the outputs of fn(*chunks), of the given shapes, over chunks of 
+        self.chunk_size rows of the tensors, all rows at once when chunk_size is None
+        '''
+
+        if self.chunk_size is None:
+            return fn(*tensors)
+
+        chunk_size = self.chunk_size
+        ndata  = tf.shape(tensors[0])[0]
+        nchunk = (ndata + chunk_size - 1) // chunk_size
+
+        def body(i, sums):
+            with no_memoise():
+                outs = fn(*[t[i*chunk_size:(i+1)*chunk_size] for t in tensors])
+            return i+1, [s + o for s, o in zip(sums, outs)]
+
+        init = [tf.zeros(s, dtype=FDTYPE) for s in shapes]
+        invariants = [tf.TensorShape([None]*len(s)) for s in shapes]
+        return tf.while_loop(lambda i, sums: i < nchunk, body, (tf.constant(0), init), 
+                             shape_invariants=(tf.TensorShape([]), invariants))[1]
+
+    def _alpha_operator(self, data, kde=None):
+        '''
+        the system quad * alpha = lin of _alpha_system without forming quad:
+        quad = sum_k weights[k] F_k F_k^T + lam_norm K + lam_alpha I, 
+        the factors F_k of the data are npoint x (ndata * D) or npoint x ndata.
+        Returns matvec(v) = quad v, the diagonal of quad and lin.
+        With chunk_size set the factors are computed again for chunk_size data at 
+        a time on every matvec, else they are held for all data at once
+        '''
+
+        npoint = self.npoint
+        ndata  = tf.cast(tf.shape(data)[0], FDTYPE)
+        tensors = [data]
+
         if kde is not None:
-            kde  = kde[:100]
-            kde_delta = kde[:,None] - kde[None,:]
+            # see _alpha_system, the gram is centred by its mean over all data
             if self.base:
-                q0 = self.base.get_fun(data[:100])
-                kde_delta = kde_delta - (q0[:,None] - q0[None,:])
-            delta = self.evaluate_gram(self.X, data[:100])
-            delta = delta[:,:,None] - delta[:,None,:]
-            npair = tf.cast(tf.reduce_prod(tf.shape(kde_delta)), FDTYPE)
-            quad  = quad + self.lam_kde * tf.einsum("mij,nij->mn", delta, delta) / npair
-            lin   = lin  + self.lam_kde * tf.einsum("mij,ij->m", delta, kde_delta) / npair
-        
-        alpha = tf.matrix_solve(quad, lin[:,None])[:,0]
-        alpha_step = lambda a: (tf.matmul(quad, a[:,None]) - lin[:,None])[:,0]
-        return alpha,H, G2, H2, GqG, qG2, qH, HqH, qH2, data, alpha_step
+                kde = kde - self.base.get_fun(data)
+            kde = kde - tf.reduce_mean(kde)
+            gram_mean = self._chunk_sum(lambda d: [tf.reduce_sum(self._basis_gram(d), 1)], 
+                                        [[npoint]], data)[0] / ndata
+            tensors.append(kde)
+
+        def factors(d, k=None):
+            dkdx, d2kdx2, dlin = self._data_factors(d)
+            F = [dkdx, d2kdx2]
+            w = [1.0 / ndata, self.lam_curve / ndata]
+            if k is not None:
+                delta = self._basis_gram(d) - gram_mean[:,None]
+                F.append(delta)
+                w.append(self.lam_kde * 2 / ndata)
+                dlin = dlin + self.lam_kde * 2 * tf.tensordot(delta, k, [[1],[0]])
+            return F, w, dlin / ndata
+
+        def apply(F, w, v):
+            return tf.add_n([wk * tf.tensordot(Fk, tf.tensordot(Fk, v, [[0],[0]]), [[1],[0]]) 
+                             for Fk, wk in zip(F, w)])
+
+        def square(F, w):
+            return tf.add_n([wk * tf.reduce_sum(tf.square(Fk), 1) for Fk, wk in zip(F, w)])
+
+        if self.chunk_size is None:
+            F, w, lin = factors(*tensors)
+            data_matvec = lambda v: apply(F, w, v)
+            data_diag   = square(F, w)
+        else:
+            def lin_diag(*chunks):
+                F, w, dlin = factors(*chunks)
+                return [dlin, square(F, w)]
+            def data_matvec(v):
+                def chunk_matvec(*chunks):
+                    F, w, _ = factors(*chunks)
+                    return [apply(F, w, v)]
+                return self._chunk_sum(chunk_matvec, [[npoint]], *tensors)[0]
+            lin, data_diag = self._chunk_sum(lin_diag, [[npoint], [npoint]], *tensors)
+
+        matvec = lambda v: data_matvec(v) + self.lam_norm * tf.tensordot(self.K, v, [[1],[0]]) + self.lam_alpha * v
+        diag   = data_diag + self.lam_norm * tf.diag_part(self.K) + self.lam_alpha
+        return matvec, diag, lin
+
+    def cg_alpha(self, data, kde=None):
+        '''
+        optimal alpha by preconditioned conjugate gradient on the operator of _alpha_operator,
+        each iteration costs O(npoint * ndata * D) and quad is never formed. 
+        The solve starts from the alpha of the previous run. 
+        Its gradient is taken by implicit differentiation: the residual quad alpha - lin
+        is zero at the solution, and a loss with gradient g at alpha sends -quad^-1 g
+        back through it, found by a second solve.
+        Returns alpha and the residual as a function of alpha
+        '''
+
+        matvec, diag, lin = self._alpha_operator(data, kde)
+        niter, tol = self.cg_iter, self.cg_tol
+
+        if self.alpha_warm is None:
+            x0 = tf.zeros([self.npoint], dtype=FDTYPE)
+        else:
+            x0 = self.alpha_warm.read_value()
+        x = tf.stop_gradient(conjugate_gradient(matvec, lin, x0, diag, niter, tol))
+
+        @tf.custom_gradient
+        def implicit(residual):
+            def grad(g):
+                return -conjugate_gradient(matvec, g, tf.zeros_like(g), diag, niter, tol)
+            return tf.zeros_like(residual), grad
 
+        alpha_step = lambda a: matvec(a) - lin
+        alpha = x + implicit(alpha_step(x))
+
+        if self.alpha_warm is not None:
+            with tf.control_dependencies([tf.assign(self.alpha_warm, x)]):
+                alpha = tf.identity(alpha)
+        return alpha, alpha_step
 
     def opt_score(self, data=None, alpha=None, kde=None):
         '''
@@ -223,15 +910,20 @@ class LiteModel:
         alpha_opt, H, G2, H2, GqG, qG2, qH, HqH, qH2, data,_  = self.opt_alpha(data, kde)
         alpha_assign_op = tf.assign(alpha, alpha_opt)
 
-        s2     =  tf.einsum('i,i->', alpha, H) + qH
-        s1     =  0.5 * (tf.einsum('i,ij,j', alpha, G2, alpha) + qG2) + tf.einsum("i,i->", alpha, GqG)
+        if H is None:
+            # conjugate gradient, see opt_alpha
+            s, curve = self._score_curvature(data, alpha)
+        else:
+            s2     =  tf.einsum('i,i->', alpha, H) + qH
+            s1     =  0.5 * (tf.einsum('i,ij,j', alpha, G2, alpha) + qG2) + tf.einsum("i,i->", alpha, GqG)
+            s      =  s1 + s2
+            curve  =  0.5 * (tf.einsum('i,ij,j', alpha, H2, alpha) + qH2) + tf.einsum("i,i->", alpha, HqH)
 
         r_norm =  self.get_fun_rkhs_norm()
         l_norm =  self.get_fun_l2_norm()
-        curve  =  0.5 * (tf.einsum('i,ij,j', alpha, H2, alpha) + qH2) + tf.einsum("i,i->", alpha, HqH)
         w_norm =  self.get_weights_norm()
 
-        score  =  s1 + s2 + 0.5 * (self.lam_norm  * r_norm + 
+        score  =  s + 0.5 * (self.lam_norm  * r_norm + 
                                    self.lam_alpha * l_norm+
                                    self.lam_curve * curve
                                    )
@@ -267,7 +959,7 @@ class LiteModel:
 
         r_norm =  self.get_fun_rkhs_norm()
         l_norm =  self.get_fun_l2_norm()
-        curve  =  0.5 * (tf.einsum('i,ij,j', self.alpha, tf.reduce_mean(H2,2), self.alpha) + tf.reduce_mean(qH2)) + tf.einsum("i,i->", self.alpha, tf.reduce_mean(HqH,1))
+        curve  =  0.5 * (tf.einsum('i,ij,j', self.alpha, H2, self.alpha) + qH2) + tf.einsum("i,i->", self.alpha, HqH)
         w_norm =  self.get_weights_norm()
         loss   =  score + 0.5 * (  w_norm * self.lam_weights )
         if valid_kde is not None:
@@ -310,7 +1002,7 @@ class LiteModel:
 
         r_norm =  self.get_fun_rkhs_norm()
         l_norm =  self.get_fun_l2_norm()
-        curve  =  0.5 * (tf.einsum('i,ij,j', self.alpha, tf.reduce_mean(H2,2), self.alpha) + tf.reduce_mean(qH2)) + tf.einsum("i,i->", self.alpha, tf.reduce_mean(HqH,1))
+        curve  =  0.5 * (tf.einsum('i,ij,j', self.alpha, H2, self.alpha) + qH2) + tf.einsum("i,i->", self.alpha, HqH)
         w_norm =  self.get_weights_norm()
         loss   =  score + 0.5 * (  w_norm * self.lam_weights)
         if valid_kde is not None:
@@ -326,9 +1018,26 @@ class LiteModel:
     def set_points(self, points):
         
         self.X = points
-        self.npoint = tf.shape(points)[0]
         self.ndim_in = tuple( points.shape[1:].as_list() )
-        self.K = self.kernel.get_gram_matrix(self.X, self.X)
+        if self.kernel.has_features():
+            # alpha weighs the features, f(y) = alpha . phi(y) with rkhs norm |alpha|^2
+            self.npoint = self.kernel.get_nfeat()
+            self.K = tf.eye(self.npoint, dtype=FDTYPE)
+        else:
+            self.npoint = tf.shape(points)[0]
+            self.K = self.kernel.get_gram_matrix(self.X, self.X)
+
+    def _basis_sec_grad(self, data):
+        # d2k/dx2 and dk/dx of the functions alpha weighs, the kernel at the points or the features
+        if self.kernel.has_features():
+            return self.kernel.get_feature_sec_grad(data)[:2]
+        return self.kernel.get_sec_grad(self.X, data)
+
+    def _basis_gram(self, data):
+        # values of the functions alpha weighs at data, npoint (or nfeat) x ndata
+        if self.kernel.has_features():
+            return tf.transpose(self.kernel.get_features(data))
+        return self.kernel.get_gram_matrix(self.X, data)
 
     def evaluate_gram(self, X, Y):
         return self.kernel.get_gram_matrix(X, Y)
@@ -337,9 +1046,7 @@ class LiteModel:
 
         if alpha is None:
             alpha = self.alpha
-        gram = self.kernel.get_gram_matrix(self.X, data)
-        
-        fv = tf.tensordot(alpha, gram, [[0],[0]])
+        fv = tf.tensordot(alpha, self._basis_gram(data), [[0],[0]])
 
         if self.base:
             fv = fv + self.base.get_fun(data)
@@ -350,8 +1057,14 @@ class LiteModel:
 
         if alpha is None:
             alpha = self.alpha
-        grad = self.kernel.get_grad(self.X, data)
-        gv   = tf.tensordot(alpha, grad, axes=[[0],[0]])
+        if self._gaussian_kernels() is not None:
+            gv = self._gaussian_grad(self._gaussian_weights(data)[1], data, alpha)
+        elif self.kernel.has_features():
+            grad  = self.kernel.get_feature_grad(data)[0]
+            gv    = tf.tensordot(alpha, grad, axes=[[0],[0]])
+        else:
+            grad = self.kernel.get_grad(self.X, data)
+            gv   = tf.tensordot(alpha, grad, axes=[[0],[0]])
 
         if self.base:
             gv = gv + self.base.get_grad(data)
@@ -362,7 +1075,10 @@ class LiteModel:
         
         if alpha is None:
             alpha = self.alpha
-        hess = self.kernel.get_hess(self.X, data)
+        if self.kernel.has_features():
+            hess  = self.kernel.get_feature_hess_grad(data)[0]
+        else:
+            hess = self.kernel.get_hess(self.X, data)
         hv   = tf.tensordot(alpha, hess, axes=[[0],[0]])
 
         if self.base:
@@ -373,8 +1089,16 @@ class LiteModel:
         
         if alpha is None:
             alpha = self.alpha
-        grad, gram = self.kernel.get_grad_gram(self.X, data)
-        grad = tf.tensordot(alpha, grad, axes=[[0],[0]])
+        if self._gaussian_kernels() is not None:
+            _, Kw, gram, _ = self._gaussian_weights(data)
+            grad = self._gaussian_grad(Kw, data, alpha)
+        else:
+            if self.kernel.has_features():
+                grad, gram = self.kernel.get_feature_grad(data)
+                gram = tf.transpose(gram)
+            else:
+                grad, gram = self.kernel.get_grad_gram(self.X, data)
+            grad = tf.tensordot(alpha, grad, axes=[[0],[0]])
         fun  = tf.tensordot(alpha, gram, axes=[[0],[0]])
 
         if self.base:
@@ -388,7 +1112,11 @@ class LiteModel:
 
         if alpha is None:
             alpha = self.alpha
-        hess, grad, gram = self.kernel.get_hess_grad_gram(self.X, data)
+        if self.kernel.has_features():
+            hess, grad, gram = self.kernel.get_feature_hess_grad(data)
+            gram = tf.transpose(gram)
+        else:
+            hess, grad, gram = self.kernel.get_hess_grad_gram(self.X, data)
         hess = tf.tensordot(alpha, hess, axes=[[0],[0]])
         grad = tf.tensordot(alpha, grad, axes=[[0],[0]])
         fun  = tf.tensordot(alpha, gram, axes=[[0],[0]])
@@ -525,6 +1253,15 @@ class Kernel:
     def get_two_grad_cross_hess(self, X, Y):
         raise(NotImplementedError)
 
+    def has_features(self):
+        # explicit finite dimensional features phi with k(x,y) = phi(x).phi(y)
+        # the get_feature_* methods return derivatives of phi(Y) and phi(Y) last
+        return False
+
+    def get_nfeat(self):
+        # number of explicit features
+        raise(NotImplementedError)
+
 class MixtureKernel(Kernel):
     
     def __init__(self, kernels, props):
@@ -614,6 +1351,32 @@ class MixtureKernel(Kernel):
             out = out + self.kernels[ki].get_weights_norm()
         return out
         
+    def has_features(self):
+        return all([k.has_features() for k in self.kernels])
+
+    def get_nfeat(self):
+        return sum([k.get_nfeat() for k in self.kernels])
+
+    def _stack_features(self, outs):
+        # features of the kernels are stacked, each scaled by sqrt(prop)
+        outs   = list(zip(*outs))
+        scales = [tf.sqrt(tf.cast(p, FDTYPE)) for p in self.props]
+        derivs = [tf.concat([o * s for o, s in zip(d, scales)], 0) for d in outs[:-1]]
+        phi    = tf.concat([o * s for o, s in zip(outs[-1], scales)], 1)
+        return tuple(derivs) + (phi,)
+
+    def get_features(self, X):
+        return self._stack_features([(k.get_features(X),) for k in self.kernels])[0]
+
+    def get_feature_grad(self, Y):
+        return self._stack_features([k.get_feature_grad(Y) for k in self.kernels])
+
+    def get_feature_sec_grad(self, Y):
+        return self._stack_features([k.get_feature_sec_grad(Y) for k in self.kernels])
+
+    def get_feature_hess_grad(self, Y):
+        return self._stack_features([k.get_feature_hess_grad(Y) for k in self.kernels])
+
 
 class NetworkKernel(Kernel):
     
@@ -706,6 +1469,7 @@ class CompositeKernel(Kernel):
         self.kernel = kernel
         self.network = network
 
+    @memoise
     def _net_forward(self, data):
 
         X = self.network.forward_tensor(data)
@@ -826,6 +1590,63 @@ class CompositeKernel(Kernel):
 
         return d2kdx2, dkdx, gram
 
+    def has_features(self):
+        return self.kernel.has_features()
+
+    def get_nfeat(self):
+        return self.kernel.get_nfeat()
+
+    def get_features(self, X):
+        return self.kernel.get_features(self._net_forward(X))
+
+    def get_feature_grad(self, Y):
+
+        dydx, Y, _ = self.network.get_grad_data(data=Y)
+        dphi, phi = self.kernel.get_feature_grad(Y)
+
+        input_idx = construct_index(self.network.ndim_in)
+
+        dphidx = tf.einsum('ijk,kj'+input_idx+'->ij'+input_idx,
+                        dphi, dydx)
+
+        return dphidx, phi
+
+    def get_feature_sec_grad(self, Y):
+
+        d2ydx2, dydx, Y, _ = self.network.get_sec_grad_data(data=Y)
+        hphi, dphi, phi = self.kernel.get_feature_hess_grad(Y)
+
+        input_idx = construct_index(self.network.ndim_in)
+
+        dphidx = tf.einsum('ijk,kj'+input_idx+'->ij'+input_idx,
+                        dphi, dydx)
+
+        s2 = tf.einsum('ijkl,kj'+input_idx + '->ijl'+input_idx,
+                            hphi, dydx)
+        s2 = tf.einsum('ijl'+input_idx+',lj'+input_idx + '->ij'+input_idx,
+                            s2, dydx)
+        s1 = tf.einsum('ijk,kj'+input_idx + '->ij'+input_idx,
+                            dphi, d2ydx2)
+
+        return s1 + s2, dphidx, phi
+
+    def get_feature_hess_grad(self, Y):
+
+        d2ydx2, dydx, Y, _ = self.network.get_hess_grad_data(data=Y)
+        hphi, dphi, phi = self.kernel.get_feature_hess_grad(Y)
+
+        input_idx = construct_index(self.network.ndim_in, n=2)
+        input_idx_1 = input_idx[:len(self.network.ndim_in)]
+        input_idx_2 = input_idx[len(self.network.ndim_in):]
+
+        dphidx = tf.einsum('ijk,kj'+input_idx_1+'->ij'+input_idx_1,
+                        dphi, dydx)
+
+        d2phidx2 = tf.einsum('ijkl,kj'+input_idx_1+',lj'+input_idx_2+'->ij'+input_idx,
+                        hphi, dydx, dydx) + \
+                   tf.einsum('ijk,kj'+input_idx+"->ij"+input_idx, dphi, d2ydx2)
+
+        return d2phidx2, dphidx, phi
 
     def get_weights_norm(self):
         return self.network.get_weights_norm()
@@ -848,6 +1669,7 @@ class GaussianKernel(Kernel):
             raise NameError("sigma should be a float or tf.Tensor")
         self.pdist2 = None
 
+    @memoise
     def get_pdist2(self, X, Y):
         
         if X.shape.ndims==1:
@@ -861,6 +1683,7 @@ class GaussianKernel(Kernel):
         self.pdist2 = pdist2
         return pdist2
 
+    @memoise
     def get_gram_matrix(self, X, Y):
 
         pdist2 = self.get_pdist2(X, Y)
@@ -1012,7 +1835,119 @@ class GaussianKernel(Kernel):
 
         return K1, K2, K3, gram
 
-class RationalQuadraticKernel:
+class RandomFourierKernel(Kernel):
+
+    '''
+    Random Fourier feature approximation of GaussianKernel
+    k(x,y) = exp(-0.5/sigma*|x-y|^2) ~ phi(x).phi(y)
+    phi(x) = sqrt(2/nfeat) cos(W x / sqrt(sigma) + b), W ~ N(0,I), b ~ U(0,2pi)
+    all derivatives are taken through the nfeat features, so a LiteModel using
+    this kernel fits alpha as the nfeat feature weights and costs O(nfeat) 
+    per evaluation point whatever the number of points
+    ndim: dimension of the input to the kernel
+    '''
+
+    def __init__(self, ndim, sigma = 1.0, nfeat = 500, trainable=True):
+        with tf.name_scope("RandomFourierKernel"):
+            if isinstance(sigma, float):
+                self.sigma  = pow_10(sigma, "sigma", trainable=trainable)
+            elif type(sigma)==tf.Tensor:
+                self.sigma = sigma
+            else:
+                raise NameError("sigma should be a float or tf.Tensor")
+            # variables rather than constants so that the features are saved with the model
+            self.W = tf.Variable(np.random.randn(nfeat, ndim), dtype=FDTYPE, name="W", trainable=False)
+            self.b = tf.Variable(np.random.rand(nfeat)*2*np.pi, dtype=FDTYPE, name="b", trainable=False)
+        self.nfeat = nfeat
+        self.scale = np.sqrt(2.0/nfeat)
+
+    def has_features(self):
+        return True
+
+    def get_nfeat(self):
+        return self.nfeat
+
+    def _project(self, Y):
+
+        if Y.shape.ndims==1:
+            Y = Y[None,:]
+        W = self.W / tf.sqrt(self.sigma)
+        return tf.matmul(Y, W, transpose_b=True) + self.b, W
+
+    @memoise
+    def get_features(self, X):
+
+        u, _ = self._project(X)
+        return self.scale * tf.cos(u)
+
+    def get_feature_grad(self, Y):
+
+        u, W = self._project(Y)
+        phi  = self.scale * tf.cos(u)
+        dphi = - self.scale * tf.transpose(tf.sin(u))[:,:,None] * W[:,None,:]
+        return dphi, phi
+
+    def get_feature_sec_grad(self, Y):
+
+        dphi, phi = self.get_feature_grad(Y)
+        W = self.W / tf.sqrt(self.sigma)
+        d2phi = - tf.transpose(phi)[:,:,None] * tf.square(W)[:,None,:]
+        return d2phi, dphi, phi
+
+    def get_feature_hess_grad(self, Y):
+
+        dphi, phi = self.get_feature_grad(Y)
+        W = self.W / tf.sqrt(self.sigma)
+        hphi = - tf.transpose(phi)[:,:,None,None] * (W[:,:,None] * W[:,None,:])[:,None,:,:]
+        return hphi, dphi, phi
+
+    def get_gram_matrix(self, X, Y):
+
+        return tf.matmul(self.get_features(X), self.get_features(Y), transpose_b=True)
+
+    def get_grad(self, X, Y):
+
+        dphi, _ = self.get_feature_grad(Y)
+        return tf.tensordot(self.get_features(X), dphi, [[1],[0]])
+
+    def get_hess(self, X, Y):
+
+        hphi, _, _ = self.get_feature_hess_grad(Y)
+        return tf.tensordot(self.get_features(X), hphi, [[1],[0]])
+
+    def get_sec_grad(self, X, Y):
+
+        d2phi, dphi, _ = self.get_feature_sec_grad(Y)
+        phiX = self.get_features(X)
+        return tf.tensordot(phiX, d2phi, [[1],[0]]), tf.tensordot(phiX, dphi, [[1],[0]])
+
+    def get_grad_gram(self, X, Y):
+
+        dphi, phi = self.get_feature_grad(Y)
+        phiX = self.get_features(X)
+        return tf.tensordot(phiX, dphi, [[1],[0]]), tf.matmul(phiX, phi, transpose_b=True)
+
+    def get_sec_grad_gram(self, X, Y):
+
+        d2phi, dphi, phi = self.get_feature_sec_grad(Y)
+        phiX = self.get_features(X)
+        return  tf.tensordot(phiX, d2phi, [[1],[0]]), tf.tensordot(phiX, dphi, [[1],[0]]), \
+                tf.matmul(phiX, phi, transpose_b=True)
+
+    def get_hess_grad(self, X, Y):
+
+        hphi, dphi, _ = self.get_feature_hess_grad(Y)
+        phiX = self.get_features(X)
+        return tf.tensordot(phiX, hphi, [[1],[0]]), tf.tensordot(phiX, dphi, [[1],[0]])
+
+    def get_hess_grad_gram(self, X, Y):
+
+        hphi, dphi, phi = self.get_feature_hess_grad(Y)
+        phiX = self.get_features(X)
+        return  tf.tensordot(phiX, hphi, [[1],[0]]), tf.tensordot(phiX, dphi, [[1],[0]]), \
+                tf.matmul(phiX, phi, transpose_b=True)
+
+class RationalQuadraticKernel(Kernel):
 
     def __init__(self, sigma, power=2, trainable=True):
         
@@ -0,0 +1,284 @@
+import numpy as np
+import os
+import threading
+import socket
+import json
+import time
+import httplib
+import BaseHTTPServer
+import SocketServer
+from Queue import Queue, Empty
+from LiteNet import FDTYPE
+
+'''
+local inference server for a trained model, e.g. a DeepLite after load or a TrainedDeepLite.
+The checkpoint is loaded and the graph is built once, and concurrent requests from worker
+processes are coalesced into batches that model.evaluate runs in one sess.run
+
+    model = DeepLite(target, **params); model.load(file_name)
+    serve(model, ("localhost", 8000))       # or serve(model, "/tmp/lite.sock")
+
+    client = LiteClient(("localhost", 8000))
+    f, g = client.evaluate(data, ["fun", "grad"])
+'''
+
+class BatchEvaluator(object):
+    '''
+    runs the evaluate calls of several threads in batches on one model. A batch is closed when it
+    has max_batch rows or when its first request has waited max_latency seconds, its outputs are
+    the union of the requested ones, and each caller gets back its own rows
+    '''
+
+    def __init__(self, model, max_batch=1000, max_latency=0.005):
+
+        self.model = model
+        self.max_batch   = max_batch
+        self.max_latency = max_latency
+        self.queue   = Queue()
+        # request taken from the queue that did not fit in the last batch
+        self.pending = None
+
+        self.lock  = threading.Lock()
+        self.start_time = time.time()
+        self.stats = dict(nrequest=0, nrow=0, nbatch=0, nerror=0, busy_time=0.0, wait_time=0.0)
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def evaluate(self, data, outputs=("fun",)):
+
+        data = np.asarray(data, dtype=FDTYPE)
+        if data.ndim != 2:
+            raise ValueError("data should be [N, D]")
+        request = dict(data=data, outputs=list(outputs), time=time.time(), done=threading.Event())
+        self.queue.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["values"]
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def health(self):
+        '''
+        request and row counts, batches run, mean rows per batch, rows per second of model time,
+        fraction of the uptime spent in the model and mean time from request to result
+        '''
+        with self.lock:
+            stats = dict(self.stats)
+        uptime = time.time() - self.start_time
+        stats["status"] = "ok" if self.thread.is_alive() else "stopped"
+        stats["uptime"] = uptime
+        stats["queue"]  = self.queue.qsize()
+        stats["batch_rows"] = stats["nrow"] / float(max(stats["nbatch"], 1))
+        stats["rows_per_second"] = stats["nrow"] / max(stats["busy_time"], 1e-12)
+        stats["busy"] = stats["busy_time"] / uptime
+        stats["latency"] = stats["wait_time"] / max(stats["nrequest"], 1)
+        return stats
+
+    def _next_batch(self):
+
+        if self.pending is not None:
+            request, self.pending = self.pending, None
+        else:
+            request = self.queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        nrow  = request["data"].shape[0]
+        deadline = request["time"] + self.max_latency
+
+        while nrow < self.max_batch:
+            try:
+                request = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except Empty:
+                break
+            if request is None:
+                self.queue.put(None)
+                break
+            if nrow + request["data"].shape[0] > self.max_batch:
+                self.pending = request
+                break
+            batch.append(request)
+            nrow += request["data"].shape[0]
+        return batch
+
+    def _evaluate(self, batch):
+
+        outputs = []
+        for request in batch:
+            outputs += [o for o in request["outputs"] if o not in outputs]
+        data = np.concatenate([request["data"] for request in batch])
+        values = self.model.evaluate(data, outputs, batch_size=max(self.max_batch, data.shape[0]))
+
+        i = 0
+        for request in batch:
+            n = request["data"].shape[0]
+            request["values"] = [values[outputs.index(o)][i:i+n] for o in request["outputs"]]
+            i += n
+
+    def _run(self):
+
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            t = time.time()
+            try:
+                self._evaluate(batch)
+            except Exception:
+                # a bad request should not fail the others in its batch
+                for request in batch:
+                    try:
+                        self._evaluate([request])
+                    except Exception as e:
+                        request["error"] = e
+            done = time.time()
+
+            with self.lock:
+                self.stats["nbatch"]   += 1
+                self.stats["busy_time"] += done - t
+                for request in batch:
+                    self.stats["nrequest"] += 1
+                    self.stats["nrow"]     += request["data"].shape[0]
+                    self.stats["nerror"]   += "error" in request
+                    self.stats["wait_time"] += done - request["time"]
+            for request in batch:
+                request["done"].set()
+
+
+class LiteRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    GET /health returns BatchEvaluator.health, POST /evaluate takes {"data": [[...]], "outputs": [...]}
+    and returns a value for each output
+    '''
+
+    def do_GET(self):
+
+        if self.path == "/health":
+            self._reply(200, self.server.evaluator.health())
+        else:
+            self._reply(404, dict(error="no such path " + self.path))
+
+    def do_POST(self):
+
+        if self.path != "/evaluate":
+            self._reply(404, dict(error="no such path " + self.path))
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            outputs = request.get("outputs", ["fun"])
+            values  = self.server.evaluator.evaluate(request["data"], outputs)
+        except Exception as e:
+            self._reply(400, dict(error="%s: %s" % (type(e).__name__, e)))
+            return
+        self._reply(200, dict(zip(outputs, [v.tolist() for v in values])))
+
+    def _reply(self, code, body):
+
+        body = json.dumps(body)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # many workers connect at once, a full backlog fails their connect on unix sockets
+    request_queue_size = 128
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(model, address=("localhost", 0), max_batch=1000, max_latency=0.005):
+    '''
+    server for model on a localhost (host, port) or a unix socket path, not started yet.
+    The port of ("localhost", 0) is chosen by the system and is in server.server_address
+    '''
+    if isinstance(address, tuple):
+        server = ThreadingHTTPServer(address, LiteRequestHandler)
+    else:
+        server = ThreadingUnixHTTPServer(address, LiteRequestHandler)
+    server.evaluator = BatchEvaluator(model, max_batch, max_latency)
+    return server
+
+def serve(model, address=("localhost", 8000), max_batch=1000, max_latency=0.005):
+
+    server = make_server(model, address, max_batch, max_latency)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.evaluator.close()
+        if not isinstance(address, tuple):
+            os.remove(address)
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class LiteClient(object):
+    '''
+    client for a server from make_server or serve, with the evaluation methods of DeepLite
+    '''
+
+    def __init__(self, address, timeout=60):
+
+        self.address = address
+        self.timeout = timeout
+
+    def _request(self, method, path, body=None):
+
+        if isinstance(self.address, tuple):
+            conn = httplib.HTTPConnection(*self.address, timeout=self.timeout)
+        else:
+            conn = UnixHTTPConnection(self.address, timeout=self.timeout)
+        try:
+            conn.request(method, path, body, {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            result = json.loads(response.read())
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise RuntimeError(result["error"])
+        return result
+
+    def health(self):
+        return self._request("GET", "/health")
+
+    def evaluate(self, data, outputs=("fun",)):
+
+        body = json.dumps(dict(data=np.asarray(data).tolist(), outputs=list(outputs)))
+        result = self._request("POST", "/evaluate", body)
+        return [np.array(result[o]) for o in outputs]
+
+    def fun_multiple(self, data):
+        return self.evaluate(data, ["fun"])[0]
+
+    def grad_multiple(self, data):
+        return self.evaluate(data, ["grad"])[0]
+
+    def score_multiple(self, data):
+        return self.evaluate(data, ["score"])[0]
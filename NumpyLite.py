@@ -0,0 +1,239 @@
+import numpy as np
+from Utils import support_1d
+
+'''
+numpy version of a trained DeepLite model, loaded from the .npz written by DeepLite.export
+it does not import tensorflow so it starts in milliseconds, e.g. for scoring workers
+only gaussian kernels (or mixture of them) on LinearSoftNetwork layers with skip are supported
+'''
+
+c = 30
+
+def nl(x):
+    return np.where(x<c, np.logaddexp(0, x), x)
+
+def dnl(x):
+    return np.where(x<-c, 0.0, 1/(1+np.exp(-x)))
+
+def d2nl(x):
+    e = np.exp(-np.clip(x, -c, c))
+    return np.where(np.logical_and(-c<x, x<c), e/np.square(1+e), 0.0)
+
+
+class NumpyNetwork(object):
+    '''
+    LinearSoftNetwork layers followed by an optional skip layer, as in DeepNetwork
+    layers: list of (W, b)
+    skip:   (W0, W1, b) or None
+    '''
+
+    def __init__(self, layers, skip=None):
+
+        self.layers = layers
+        self.skip   = skip
+
+    def forward(self, data):
+
+        h = data
+        for W, b in self.layers:
+            h = nl(h.dot(W.T) + b)
+
+        if self.skip is not None:
+            W0, W1, b = self.skip
+            h = nl(data.dot(W0.T) + h.dot(W1.T) + b)
+        return h
+
+    def get_hess_grad(self, data):
+        '''
+        output h [N, d], jacobian J [N, d, D] and second derivatives S [N, d, D, D]
+        '''
+        N, D = data.shape
+        h = data
+        J = np.tile(np.eye(D, dtype=data.dtype)[None], [N,1,1])
+        S = np.zeros((N, D, D, D), dtype=data.dtype)
+
+        for W, b in self.layers:
+            h, J, S = self._layer(h.dot(W.T) + b, np.einsum("oj,njd->nod", W, J), np.einsum("oj,njde->node", W, S))
+
+        if self.skip is not None:
+            W0, W1, b = self.skip
+            h, J, S = self._layer(data.dot(W0.T) + h.dot(W1.T) + b,
+                                  W0[None] + np.einsum("oj,njd->nod", W1, J), np.einsum("oj,njde->node", W1, S))
+        return S, J, h
+
+    @staticmethod
+    def _layer(lin, WJ, WS):
+
+        d1 = dnl(lin)
+        d2 = d2nl(lin)
+        S = d2[:,:,None,None] * WJ[:,:,:,None] * WJ[:,:,None,:] + d1[:,:,None,None] * WS
+        J = d1[:,:,None] * WJ
+        return nl(lin), J, S
+
+
+class NumpyLite(object):
+    '''
+    dtype of the parameters and of the computations, FDTYPE to match the tensorflow model
+    '''
+
+    def __init__(self, file_name, dtype="float64"):
+
+        if not file_name.endswith(".npz"):
+            file_name = "ckpts/"+file_name+".npz"
+        params = np.load(file_name)
+        self.dtype = dtype
+
+        self.alpha  = params["alpha"].astype(dtype)
+        self.points = params["points"].astype(dtype)
+        self.D      = self.points.shape[1]
+        self.min_log_pdf = float(params["min_log_pdf"])
+        self.last = None
+
+        self.base = bool(params["base"])
+        if self.base:
+            self.base_mu    = params["base_mu"].astype(dtype)
+            self.base_sigma = params["base_sigma"].astype(dtype)
+
+        nkernel = int(params["nkernel"])
+        nlayer  = int(params["nlayer"])
+
+        self.sigmas   = []
+        self.props    = []
+        self.networks = []
+        self.features = []
+
+        for ki in range(nkernel):
+
+            self.sigmas.append(float(params["sigma_%d" % ki]))
+            self.props.append(float(params["prop_%d" % ki]))
+
+            if nlayer>0:
+                layers = []
+                li = 0
+                while "W_%d_%d" % (ki, li) in params:
+                    layers.append((params["W_%d_%d" % (ki, li)].astype(dtype),
+                                   params["b_%d_%d" % (ki, li)].astype(dtype)))
+                    li += 1
+                if "W0_%d_skip" % ki in params:
+                    skip = tuple(params[k % ki].astype(dtype) for k in ["W0_%d_skip", "W1_%d_skip", "b_%d_skip"])
+                else:
+                    skip = None
+                network = NumpyNetwork(layers, skip)
+                Z = network.forward(self.points)
+            else:
+                network = None
+                Z = self.points
+            self.networks.append(network)
+            # features of the points and their outer products, fixed after export
+            self.features.append((Z, np.sum(Z**2,1), (Z[:,:,None]*Z[:,None,:]).reshape(Z.shape[0], -1)))
+
+    def _kernel_weights(self, ki, h):
+        # alpha * prop * k(X, h), [N, npoint]
+        Z, Z2 = self.features[ki][:2]
+        pdist2 = np.sum(h**2,1)[:,None] + Z2[None,:] - 2*h.dot(Z.T)
+        return self.props[ki] * self.alpha[None,:] * np.exp(-0.5/self.sigmas[ki]*pdist2)
+
+    def _hess_grad_fun(self, data, order):
+
+        N, D = data.shape
+        f = np.zeros(N, dtype=self.dtype)
+        g = np.zeros((N,D), dtype=self.dtype)
+        H = np.zeros((N,D,D), dtype=self.dtype)
+
+        for ki in range(len(self.sigmas)):
+
+            network = self.networks[ki]
+            sigma   = self.sigmas[ki]
+            Z, _, ZZ = self.features[ki]
+
+            if network is None:
+                h = data
+            elif order == 0:
+                h = network.forward(data)
+            else:
+                S, J, h = network.get_hess_grad(data)
+
+            w  = self._kernel_weights(ki, h)
+            sw = w.sum(1)
+            wZ = w.dot(Z)
+            f += sw
+            if order == 0:
+                continue
+
+            # derivatives w.r.t. the features h
+            gh = -(sw[:,None]*h - wZ) / sigma
+            if network is None:
+                g += gh
+            else:
+                g += np.einsum("no,nod->nd", gh, J)
+            if order == 1:
+                continue
+
+            d = h.shape[1]
+            rr = sw[:,None,None]*h[:,:,None]*h[:,None,:] - h[:,:,None]*wZ[:,None,:] - wZ[:,:,None]*h[:,None,:] \
+                 + w.dot(ZZ).reshape(N, d, d)
+            Hh = rr / sigma**2 - sw[:,None,None]*np.eye(d, dtype=self.dtype)[None] / sigma
+            if network is None:
+                H += Hh
+            else:
+                H += np.einsum("nod,noe,nef->ndf", J, Hh, J) + np.einsum("no,node->nde", gh, S)
+
+        if self.base:
+            sigma2 = self.base_sigma**2
+            diff = data - self.base_mu
+            f += -0.5 * np.sum(diff**2 / sigma2, -1)
+            g += -diff / sigma2
+            H += -np.eye(D, dtype=self.dtype)[None] / sigma2
+
+        return H, g, f
+
+    def _multiple(self, data, order, batch_size):
+
+        data = np.asarray(data, dtype=self.dtype)
+        out = [self._hess_grad_fun(data[i:i+batch_size], order) for i in range(0, data.shape[0], batch_size)]
+        return [np.concatenate(v) for v in zip(*out)]
+
+    def evaluate(self, data, outputs=("fun", "grad", "hess"), batch_size=1000):
+        '''
+        outputs ("fun", "grad" or "hess") at every row of data, as DeepLite.evaluate
+        '''
+        order = max([["fun", "grad", "hess"].index(o) for o in outputs])
+        H, g, f = self._multiple(data, order, batch_size)
+        f[f<self.min_log_pdf] = -np.inf
+        values = dict(fun=f, grad=g, hess=H)
+        return [values[o] for o in outputs]
+
+    def fun_multiple(self, data, batch_size=1000):
+
+        value = self._multiple(data, 0, batch_size)[2]
+        value[value<self.min_log_pdf] = -np.inf
+        return value
+
+    def grad_multiple(self, data, batch_size=1000):
+        return self._multiple(data, 1, batch_size)[1]
+
+    def hess_multiple(self, data, batch_size=1000):
+        return self._multiple(data, 2, batch_size)[0]
+
+    def log_pdf_and_grad(self, x):
+        '''
+        log_pdf and grad at a single point, the last result is kept as in DeepLite.log_pdf_and_grad
+        '''
+        x = np.array(x, dtype=self.dtype)
+        if self.last is None or not np.array_equal(self.last[0], x):
+            _, g, f = self._hess_grad_fun(x[None,:], 1)
+            self.last = (x, np.float64(f[0]), g[0].astype(np.float64))
+
+        f, g = self.last[1:]
+        if f < self.min_log_pdf:
+            f = -np.inf
+        return f, g
+
+    def grad(self, data):
+        return support_1d(lambda x: self.grad_multiple(x), data)
+
+    def log_pdf(self, data):
+        return support_1d(lambda x: self.fun_multiple(x), data)
+
+    def hess(self, data):
+        return support_1d(lambda x: self.hess_multiple(x), data)
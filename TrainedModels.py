@@ -1,7 +1,7 @@
 import numpy as np
 import tensorflow as tf
 from LiteNet import *
-from Utils import support_1d
+from Utils import support_1d, batch_evaluate
 from kernel_hmc.mini_mcmc.mini_mcmc import mini_mcmc
 from kernel_hmc.densities.gaussian import IsotropicZeroMeanGaussian
 from kernel_hmc.proposals.kmc import KMCStatic
@@ -133,43 +133,22 @@ class TrainedDeepLite(object):
     def log_pdf(self, data):
         return support_1d(lambda x: self.fun_multiple(x, batch_size=1), data)
     
+    def _run_test(self, op, data, batch_size):
+        # op at every row of data, including the last partial batch
+        return batch_evaluate(lambda batch: self.sess.run([op], feed_dict={self.test_data:batch, self.train_data: self.rand_train_data}),
+                              data, batch_size)[0]
+
     def grad_multiple(self, data, batch_size=100):
-        
-        neval = data.shape[0]
-        nbatch = neval/batch_size
-        value = np.empty((neval, self.D))
-
-        for i in range(nbatch):
-            batch = data[i*batch_size:(i+1)*batch_size]
-            value[i*batch_size:(i+1)*batch_size,:] = \
-                self.sess.run(self.gv, feed_dict={self.test_data:batch, self.train_data: self.rand_train_data})   
-        return value
+        return self._run_test(self.gv, data, batch_size)
         
     def fun_multiple(self, data, batch_size=100):
         
-        neval = data.shape[0]
-        nbatch = neval/batch_size
-        value = np.empty((neval))
-        
-        for i in range(nbatch):
-
-            batch = data[i*batch_size:(i+1)*batch_size]
-            value[i*batch_size:(i+1)*batch_size] = \
-                self.sess.run(self.fv, feed_dict={self.test_data:batch, self.train_data: self.rand_train_data}) 
+        value = self._run_test(self.fv, data, batch_size)
         value[value<self.min_log_pdf] = -np.inf
         return value
         
     def hess_multiple(self, data, batch_size=100):
-        
-        neval = data.shape[0]
-        nbatch = neval/batch_size
-        value = np.empty((neval, self.D, self.D))
-
-        for i in range(nbatch):
-            batch = data[i*batch_size:(i+1)*batch_size]
-            value[i*batch_size:(i+1)*batch_size] = \
-                self.sess.run(self.hv, feed_dict={self.test_data:batch, self.train_data: self.rand_train_data}) 
-        return value
+        return self._run_test(self.hv, data, batch_size)
     
     def retrain(self, rand_train_data):
         
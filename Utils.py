@@ -1,22 +1,232 @@
 import numpy as np
+import threading
+import time
+from Queue import Queue, Full
+from contextlib import contextmanager
 
 def support_1d(fun, x):
     assert 1<=x.ndim<=2
     return fun(x) if x.ndim == 2 else fun(x[None,:])[0]
 
+@contextmanager
+def seeded(seed):
+    '''
+    run code that draws from the global np.random, e.g. a third party sampler, 
+    from seed and give the caller back the state it had before
+    '''
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
+
 def get_grid(r, i, j, cond):
+    '''
+    points where dimensions i and j take every pair of values in r and the others are cond,
+    [len(r)**2, D] with dimension i varying fastest, as in np.meshgrid(r, r)
+    '''
+    n = len(r)
+    grid_cond = np.empty((n*n, len(cond)), dtype=np.result_type(r, cond))
+    grid_cond[:] = cond
+    grid_cond[:,i] = np.tile(r, n)
+    grid_cond[:,j] = np.repeat(r, n)
+    return grid_cond
 
 
-    grid = np.meshgrid(r,r)
+def chol_update(L, V):
+    '''
+    lower Cholesky factor of L L^T + V V^T, one rank one update per column of V
+    costs O(n^2) per column instead of O(n^3) for a new factorisation
+    '''
 
-    grid = np.stack(grid,2)
-    grid = grid.reshape(-1,2)
-    
-    num_point = len(grid)
-    grid_cond = np.tile(cond[None,:], [num_point, 1])
-    
-    grid_cond[:,i] = grid[:,0]
-    grid_cond[:,j] = grid[:,1]
-    return grid_cond
+    L = L.copy()
+    n = L.shape[0]
+
+    for v in V.T:
+        v = v.copy()
+        for k in range(n):
+            r = np.sqrt(L[k,k]**2 + v[k]**2)
+            c = r / L[k,k]
+            s = v[k] / L[k,k]
+            L[k,k] = r
+            L[k+1:,k] = (L[k+1:,k] + s*v[k+1:]) / c
+            v[k+1:]   = c*v[k+1:] - s*L[k+1:,k]
+    return L
+
+
+def kmeans_pp(data, n, rng=np.random):
+    '''
+    k-means++ seeding, n rows of data each drawn with probability proportional to 
+    its squared distance to the closest row drawn before, O(n N D). Once every row 
+    is a copy of one drawn before, the rest are drawn uniformly
+    '''
+
+    idx  = [rng.randint(data.shape[0])]
+    dist = np.sum((data - data[idx[0]])**2, 1)
+    for _ in range(n-1):
+        total = dist.sum()
+        i = rng.choice(data.shape[0], p=dist/total) if total > 0 else rng.randint(data.shape[0])
+        idx.append(i)
+        dist = np.minimum(dist, np.sum((data - data[i])**2, 1))
+    return np.array(idx)
+
+
+def pivoted_cholesky(diag, column, n, tol=1e-8):
+    '''
+    greedy pivoted Cholesky of a kernel matrix given its diagonal and column(i), its i-th column.
+    Each pivot is the index with the largest residual variance given the ones before,
+    it stops after n pivots or when the residual variances are below tol * max(diag).
+    Returns the pivots and the factor L (npivot x N), K ~ L^T L, in O(n^2 N)
+    '''
+
+    d = np.asarray(diag, dtype="float64").copy()
+    L = np.zeros((n, d.shape[0]))
+    pivots = []
+    tol = tol * d.max()
+
+    for m in range(n):
+        i = np.argmax(d)
+        if d[i] <= tol:
+            break
+        pivots.append(i)
+        L[m] = (column(i) - L[:m,i].dot(L[:m])) / np.sqrt(d[i])
+        d -= L[m]**2
+        d[pivots] = -np.inf
+    return np.array(pivots, dtype=int), L[:len(pivots)]
+
+
+def ridge_leverage(L, lam):
+    '''
+    ridge leverage scores diag(K (K + lam I)^-1) of K = L^T L
+    '''
+    A = L.dot(L.T) + lam * np.eye(L.shape[0])
+    return np.sum(L * np.linalg.solve(A, L), 0)
+
+
+def leverage_sample(L, lam, n, rng=np.random):
+    '''
+    n distinct indices drawn with probability proportional to the ridge leverage scores 
+    of K = L^T L. Indices without leverage, e.g. rows of a rank deficient K that L does
+    not reach, are drawn uniformly once the others are used up
+    '''
+    p = np.maximum(ridge_leverage(L, lam), 0)
+    nlev = min(n, np.sum(p > 0))
+    idx  = rng.choice(len(p), nlev, replace=False, p=p/p.sum()) if nlev > 0 else np.zeros(0, dtype=int)
+    if nlev < n:
+        rest = np.setdiff1d(np.arange(len(p)), idx)
+        idx  = np.concatenate([idx, rng.choice(rest, n-nlev, replace=False)])
+    return idx
+
+
+def batch_evaluate(run, data, batch_size):
+    '''
+    run(batch) returns a list of arrays with the batch along the first axis,
+    stack them over all rows of data, the last batch may be smaller than batch_size.
+    For data without rows, one row of zeros is run to get the shapes and types
+    '''
+
+    n = data.shape[0]
+    if n == 0:
+        return [np.asarray(v)[:0] for v in run(np.zeros((1,) + data.shape[1:], dtype=data.dtype))]
+
+    out = None
+    for i in range(0, n, batch_size):
+        values = [np.asarray(v) for v in run(data[i:i+batch_size])]
+        if out is None:
+            out = [np.empty((n,) + v.shape[1:], dtype=v.dtype) for v in values]
+        for o, v in zip(out, values):
+            o[i:i+batch_size] = v
+    return out
+
+
+def effective_sample_size(x):
+    '''
+    effective sample size of each column of the chain x [n, D],
+    from the autocorrelation summed up to its first negative lag
+    '''
+
+    n = x.shape[0]
+    # a constant column has no autocorrelation to correct for, its ess is n
+    const = np.all(x == x[:1], 0)
+    x = x - x.mean(0)
+    f = np.fft.rfft(x, 2*n, axis=0)
+    acf = np.fft.irfft(f * np.conj(f), axis=0)[:n]
+    acf = acf / np.where(const, 1, acf[0])[None]
+
+    ess = np.empty(x.shape[1])
+    for d in range(x.shape[1]):
+        rho = acf[1:,d]
+        k = np.argmax(rho<0) if np.any(rho<0) else len(rho)
+        ess[d] = n / (1 + 2*np.sum(rho[:k])) if not const[d] else n
+    return ess
+
+
+class Prefetcher(object):
+    '''
+    calls fun() in a background thread and keeps up to depth results ready, so that next() only
+    waits when fun is slower than the work done between calls. wait_time is the total time spent
+    waiting in next(). With depth 0, next() calls fun itself. fun is called at most nitem times,
+    results not taken by next() before close are dropped
+    '''
+
+    def __init__(self, fun, depth=2, nitem=None):
+
+        self.fun   = fun
+        self.depth = depth
+        self.nitem = nitem
+        self.ncall = 0
+        self.wait_time = 0.0
+        self.nbatch = 0
+        self.stopped = threading.Event()
+
+        if depth > 0:
+            self.queue  = Queue(maxsize=depth)
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+
+        while not self.stopped.is_set() and (self.nitem is None or self.ncall < self.nitem):
+            self.ncall += 1
+            try:
+                item = (self.fun(), None)
+            except Exception as e:
+                item = (None, e)
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except Full:
+                    pass
+            if item[1] is not None:
+                return
+
+    def next(self):
+
+        if self.nitem is not None and self.nbatch >= self.nitem:
+            raise StopIteration
+        t = time.time()
+        if self.depth > 0:
+            value, error = self.queue.get()
+            if error is not None:
+                raise error
+        else:
+            self.ncall += 1
+            value = self.fun()
+        self.wait_time += time.time() - t
+        self.nbatch += 1
+        return value
+
+    def close(self):
+
+        self.stopped.set()
+        if self.depth > 0:
+            self.thread.join()
 
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,15 +1,12 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from LiteNet import FDTYPE
-import tensorflow as tf
+from Utils import get_grid
 
 def plot_dataset(p, plot_size, ngrid, n=500, sample_params=dict(), dlogpdf_params = dict(), quiver_params=dict()):
 
     eval_grid = np.linspace(-plot_size/2,plot_size/2,ngrid) 
 
-    eval_points = np.array([[xv,yv] + [0.01]*(p.D-2)
-        for xv in eval_grid
-                for yv in eval_grid])
+    eval_points = get_grid(eval_grid, 1, 0, np.full(p.D, 0.01))
     #eval_points = np.random.randn(ngrid, D)
 
 
@@ -53,22 +50,11 @@ def plot_dataset(p, plot_size, ngrid, n=500, sample_params=dict(), dlogpdf_param
 def visualize_kernel(kn_model, grid_one, N, points = np.array([[0,0.0]]),**kwargs):
     
     '''
-    Plot effective kernels 
+    Plot effective kernels, evaluated by kn_model.evaluate_grid on the first two dimensions
     '''
-    ngrid = len(grid_one)
     npoint = points.shape[0]
-    D = points.shape[1]
-    grid_one = grid_one.astype(FDTYPE)
-    
-    points = tf.constant(points, dtype=FDTYPE)
-    
-    grid = np.meshgrid(grid_one,grid_one)
-    grid = np.stack(grid, 2).reshape(-1,2)
-
-    grid = tf.constant(np.c_[grid, np.zeros((grid.shape[0],D-2), dtype="float32")])
 
-    K = kn_model.kn.evaluate_gram(points, grid)
-    K_eval = kn_model.sess.run(K).reshape(npoint, ngrid,ngrid)
+    K_eval = kn_model.evaluate_grid(grid_one, 0, 1, outputs=["kernel"], kernel_points=points)[0]
     
     for i in range(npoint):
         
@@ -32,17 +32,18 @@ for D in [2,4,6,8,10,12,14,16,18]:
     np.random.seed(1)
 
     sigma = tf.placeholder("float32", shape=[])
-    lam   = tf.placeholder("float32", shape=[])
-    alpha = tf.Variable(np.zeros(ntrain, dtype="float32"))
+    lams  = tf.placeholder("float32", shape=[None])
     points = tf.placeholder(shape=(ntrain, D),  dtype="float32")
     test_data = tf.placeholder("float32", shape=(test_batch_size, D), name="1")
 
     kernel = GaussianKernel(sigma)
 
-    kn = KernelModel(kernel, alpha = alpha)
-    kn.set_points(points)
-    alpha_opt, _, score, train_data = kn.opt_score(lam=lam, lam2=lam)[:4]
-    gv = kn.evaluate_grad(test_data)
+    kn = LiteModel(kernel, points=points)
+    # alphas for the whole lambda grid from one eigendecomposition, 
+    # lam_norm and lam_alpha both take each value of lams
+    alphas = kn.alpha_path(lams, train_data=points, norm_path=True)[0]
+    grad = kn.kernel.get_grad(points, test_data)
+    gvs  = tf.tensordot(alphas, grad, [[1],[0]])
 
     nX = len(X)
     nY = len(Y)
@@ -63,31 +64,25 @@ for D in [2,4,6,8,10,12,14,16,18]:
         sess.run(init)
 
         for xi in trange(len(X), desc="x loop", leave=True):
-            for yi in trange(len(Y), desc="y loop", leave=True):
-                np.random.seed(1)
-                for r in trange(nrep, desc="r loop", leave=True):
-                    x = X[xi]
-                    y = Y[yi]
-
-                    #print "\r xi=%2d yi=%2d ri=%2d" % (xi, yi, r),
-
-                    rand_train_data = gen_data(ntrain)
-                    feed = {train_data: rand_train_data.astype("float32"), 
-                            points:rand_train_data.astype("float32"),
-                            sigma: 10**(x), lam:10**(y)}
-                    
-                    sess.run(alpha_opt, feed_dict=feed)
-
-                    nbatch = ntest/test_batch_size
-                    
-                    for i in range(nbatch):
-                        d = gen_data(test_batch_size)
-                        feed[test_data] = d
-                        gt = p.grad_multiple(d)
-                        ge = gv.eval(feed_dict=feed)
-                        scores[xi,yi,r] += 0.5 * np.mean(np.sum((gt-ge)**2,1))
-                    scores[xi,yi,r] /= nbatch
-        alpha_val = alpha.eval()
+            np.random.seed(1)
+            for r in trange(nrep, desc="r loop", leave=True):
+                x = X[xi]
+
+                #print "\r xi=%2d ri=%2d" % (xi, r),
+
+                rand_train_data = gen_data(ntrain)
+                feed = {points:rand_train_data.astype("float32"),
+                        sigma: 10**(x), lams:10**(Y)}
+
+                nbatch = ntest/test_batch_size
+                
+                for i in range(nbatch):
+                    d = gen_data(test_batch_size)
+                    feed[test_data] = d
+                    gt = p.grad_multiple(d)
+                    ge = gvs.eval(feed_dict=feed)
+                    scores[xi,:,r] += 0.5 * np.mean(np.sum((gt[None]-ge)**2,2),1)
+                scores[xi,:,r] /= nbatch
     
     all_scores = scores.copy()
     scores = scores.mean(2)
@@ -0,0 +1,51 @@
+import numpy as np
+import sys
+from time import time
+from LiteModels import DeepLite
+from Datasets import RealToy
+
+'''
+test score against npoint for each points_type of DeepLite. The kernel is a fixed gaussian
+(nlayer=0) and alpha is fitted on the same ntrain points, so only the choice of points differs.
+Lower scores are better
+
+    python points_benchmark.py [dataset] [D]
+'''
+
+data_name = sys.argv[1] if len(sys.argv) > 1 else "ring"
+D         = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+ntrain  = 5000
+ntest   = 2000
+nrep    = 3
+npoints = [10, 25, 50, 100, 200]
+points_types = ["fixed", "kmeans", "minibatch_kmeans", "kmeans++", "pivoted", "leverage"]
+
+target = RealToy(data_name, D, n=ntrain+ntest, seed=0, ntest=ntest)
+
+scores = np.zeros((len(points_types), len(npoints), nrep))
+times  = np.zeros((len(points_types), len(npoints), nrep))
+
+for pi, points_type in enumerate(points_types):
+    for ni, npoint in enumerate(npoints):
+        for r in range(nrep):
+
+            np.random.seed(r)
+            t = time()
+            model = DeepLite(target, nlayer=0, npoint=npoint, points_type=points_type, points_std=0.0,
+                             init_log_sigma=[0.0], init_log_lam=-3.0, seed=r)
+            model.fit_alpha(ntrain)
+            times[pi, ni, r]  = time() - t
+            scores[pi, ni, r] = np.mean(model.score_multiple(target.test_data))
+            model.sess.close()
+
+        print "%-18s npoint %4d  score %8.4f +- %.4f  time %.1fs" % (points_type, npoint,
+                scores[pi, ni].mean(), scores[pi, ni].std(), times[pi, ni].mean())
+
+print
+print "%-18s" % "npoint" + "".join(["%10d" % n for n in npoints])
+for pi, points_type in enumerate(points_types):
+    print "%-18s" % points_type + "".join(["%10.4f" % s for s in scores[pi].mean(-1)])
+
+np.savez("points_benchmark_%s_D%d.npz" % (data_name, D), scores=scores, times=times,
+         npoints=npoints, points_types=points_types)
@@ -0,0 +1,450 @@
+import numpy as np
+import tensorflow as tf
+import matplotlib as mpl
+mpl.use('Agg')
+import unittest
+from LiteModels import *
+from Datasets import ArrayDataset
+from Visualise import visualize_kernel
+from NumpyLite import NumpyLite
+from LiteServer import make_server, LiteClient
+import threading
+
+class test_array_key(unittest.TestCase):
+
+    def test_array_key(self):
+
+        x = np.arange(12, dtype="float32")
+        assert array_key(x) == array_key(x.copy())
+        assert array_key(x) != array_key(x.reshape(3, 4))
+        assert array_key(x) != array_key(x.view("int32"))
+
+class test_DeepLite(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        np.random.seed(0)
+        cls.target = ArrayDataset(np.random.randn(600, 3), "toy", ntest=100)
+
+    def setUp(self):
+
+        # each test has its own model, several of them change it
+        self.model = DeepLite(self.target, nlayer=1, nneuron=10, npoint=30, ntrain=50, nvalid=30, seed=1)
+        self.model.fit_alpha(300)
+
+    def tearDown(self):
+        self.model.unfreeze()
+        self.model.sess.close()
+
+    def set_base_only(self):
+        # with alpha 0 the model is its base measure N(0, 2^2 I), returns its log Z
+        model = self.model
+        model.set_alpha(np.zeros(model.model_params["npoint"]))
+        return self.target.D / 2.0 * np.log(2 * np.pi * 2.0**2)
+
+    def test_cross_validate(self):
+
+        model, nfold = self.model, 3
+        lam_alpha = model.sess.run(model.kn.lam_alpha)
+
+        np.random.seed(2)
+        scores, best_alpha, best_curve = model.cross_validate([lam_alpha, 1.0], nfold=nfold)
+        assert scores.shape == (2, 1) and best_curve == 0.0
+        assert best_alpha == [lam_alpha, 1.0][np.argmin(scores[:,0])]
+
+        # the same folds, each fitted on the rest of the data and scored on itself
+        np.random.seed(2)
+        data  = self.target.data
+        folds = np.array_split(np.random.permutation(data.shape[0]), nfold)
+        sums  = [model._sum_statistics(data[fold]) for fold in folds]
+        total = [np.sum(s, 0) for s in zip(*sums)]
+
+        score = 0.0
+        for fold, fold_sums in zip(folds, sums):
+            feed = dict(zip(model.stat_sums, [t - s for t, s in zip(total, fold_sums)]))
+            feed[model.stat_ndata] = data.shape[0] - len(fold)
+            quad, lin = model.sess.run(model.ops["alpha_system_sums"], feed_dict=feed)
+            model.set_alpha(np.linalg.solve(quad, lin))
+            score += np.sum(model.score_multiple(data[fold]))
+
+        assert np.allclose(scores[0,0], score / data.shape[0], rtol=1e-3, atol=1e-3), (scores[0,0], score / data.shape[0])
+
+    def test_step_gradient(self):
+
+        model, nvalid = self.model, 20
+        model.train_params["_nbatch"] = 2
+        model.train_params["nvalid"]  = nvalid
+        train_data = self.target.data[:50].astype(FDTYPE)
+        valid_data = self.target.data[50:50+2*nvalid].astype(FDTYPE)
+
+        # gradient of the loss of all the validation data through the solve for alpha
+        with model.graph.as_default():
+            variables = tf.trainable_variables()
+            grads = [g for g in tf.gradients(model.states["loss"], variables) if g is not None]
+        grads = model.sess.run(grads, feed_dict={model.train_data: train_data, model.valid_data: valid_data})
+        grad_norm = np.sqrt(np.sum([np.sum(g.astype("float64")**2) for g in grads]))
+
+        # step accumulates it over two micro-batches, with a zero step size nothing changes
+        feed = {model.train_params["step_size"]: 0.0, model.train_params["nbatch"]: 2.0}
+        res  = model.step(feed, 10, (train_data, valid_data, None, None))
+        step_norm = res[model.states.keys().index("grad_norm")]
+
+        assert np.allclose(step_norm, grad_norm, rtol=1e-3), (step_norm, grad_norm)
+
+    def test_freeze(self):
+
+        model = self.model
+        data  = self.target.test_data[:20]
+        outputs = ["fun", "grad", "hess"]
+        values  = model.evaluate(data, outputs)
+
+        model.freeze()
+        assert model.frozen is not None
+        # on the devices of the model
+        assert model.frozen["sess"]._config == model.config
+        frozen = model.evaluate(data, outputs)
+        # fewer nodes than the training graph
+        assert len(model.frozen["sess"].graph.get_operations()) < len(model.graph.get_operations())
+
+        model.freeze(cpu_only=True)
+        assert model.frozen["sess"]._config.device_count["GPU"] == 0
+        cpu = model.evaluate(data, outputs)
+        for f, c in zip(frozen, cpu):
+            assert np.allclose(f, c, atol=1e-5, rtol=1e-4), np.max(np.abs(f-c))
+
+        model.unfreeze()
+        assert model.frozen is None
+        unfrozen = model.evaluate(data, outputs)
+
+        for v, f, u in zip(values, frozen, unfrozen):
+            assert np.allclose(v, f, atol=1e-5, rtol=1e-4), np.max(np.abs(v-f))
+            assert np.array_equal(v, u)
+
+    def test_normaliser_cache(self):
+
+        model = self.model
+        data  = self.target.test_data
+        lik   = model.estimate_data_lik(data, method="is", n=2000, batch_size=1000)
+        assert model.normaliser_stats["settings"]["n"] == 2000
+        logZ_first = model.logZ
+
+        # other settings are estimated again, the same ones are taken from the cache
+        model.estimate_data_lik(data, method="is", n=4000, batch_size=1000)
+        assert model.normaliser_stats["settings"]["n"] == 4000
+        logZ = model.logZ
+        assert np.allclose(model.estimate_data_lik(data, method="is", n=4000), lik + logZ_first - logZ)
+        assert model.logZ == logZ
+        model.estimate_data_lik(data, method="is", n=4000, std=1.0)
+        assert model.logZ == logZ
+
+        # settings left out are their defaults, not whatever was used last
+        assert model.normaliser_stats["settings"] == model.normaliser_settings("is", dict(n=4000))
+        assert not normaliser_matches(model.normaliser_stats, model.normaliser_settings("is", {}))
+        model.estimate_data_lik(data, method="is", n=4000, std=2.0)
+        assert model.normaliser_stats["settings"]["std"] == 2.0
+
+        # fun_multiple depends on min_log_pdf, a logZ for another one is estimated again
+        logZ = model.logZ
+        model.min_log_pdf = -1e10
+        model.estimate_data_lik(data, method="is", n=4000, std=2.0)
+        assert model.normaliser_stats["settings"]["min_log_pdf"] == -1e10
+        assert model.logZ != logZ
+
+    def test_select_points(self):
+
+        model, data = self.model, self.target.data
+        npoint = model.model_params["npoint"]
+        rows = dict([(tuple(d.astype(FDTYPE)), i) for i, d in enumerate(data)])
+
+        for method in ["pivoted", "leverage"]:
+            model.select_points(method, ncand=data.shape[0])
+            points = model.sess.run(model.points)
+            idx = [rows[tuple(p)] for p in points]
+            assert len(set(idx)) == npoint
+
+        # with every row a candidate, each pivot is the row with the largest residual variance given the ones before
+        model.select_points("pivoted", ncand=data.shape[0])
+        idx = [rows[tuple(p)] for p in model.sess.run(model.points)]
+        K = model._run_gram(data.astype(FDTYPE), data.astype(FDTYPE)).astype("float64")
+        for m in range(1, npoint):
+            P = idx[:m]
+            resid = np.diag(K) - np.sum(K[:,P] * np.linalg.solve(K[np.ix_(P, P)], K[P]).T, 1)
+            assert resid[idx[m]] >= resid.max() - 1e-3 * np.diag(K).max(), (m, resid[idx[m]], resid.max())
+
+        self.assertRaises(NameError, model.select_points, "random")
+
+        # alpha is fitted again for the new points
+        fun = model.fun_multiple(self.target.test_data)
+        assert np.all(np.isfinite(fun))
+        model.fit_alpha(300)
+        assert np.allclose(fun, model.fun_multiple(self.target.test_data))
+
+    def test_select_points_build(self):
+
+        # the points are chosen when the model is built, alpha is left for fit_alpha
+        model = DeepLite(self.target, nlayer=0, npoint=10, points_type="pivoted", seed=1)
+        assert model.alpha_ndata is None
+        model.select_points("leverage")
+        assert model.alpha_ndata is None
+        assert np.all(model.sess.run(model.alpha) == 0)
+        model.sess.close()
+
+
+    def test_estimate_normaliser(self):
+
+        model, logZ = self.model, self.set_base_only()
+        np.random.seed(3)
+
+        # proposals wider than the base measure, the error is within the reported standard error
+        for proposal in ["normal", "gaussian"]:
+            est = model.estimate_normaliser(n=20000, batch_size=5000, std=2.5, proposal=proposal)
+            stats = model.normaliser_stats
+            assert stats["n"] == 20000 and stats["proposal"] == proposal
+            assert abs(est - logZ) < 4 * stats["rel_se"], (proposal, est, logZ, stats["rel_se"])
+
+        # stops at the first batch where the relative standard error is below rel_se
+        np.random.seed(4)
+        est = model.estimate_normaliser(n=10**6, batch_size=1000, std=2.5, rel_se=0.005)
+        stats = model.normaliser_stats
+        assert stats["rel_se"] < 0.005 and 1000 < stats["n"] < 10**6 and stats["n"] % 1000 == 0
+        assert abs(est - logZ) < 4 * 0.005, (est, logZ)
+        # the same draws one batch earlier have not reached it
+        np.random.seed(4)
+        model.estimate_normaliser(n=stats["n"]-1000, batch_size=1000, std=2.5)
+        assert model.normaliser_stats["rel_se"] >= 0.005
+
+        model.estimate_normaliser(n=10**6, batch_size=1000, std=2.5, min_ess=5000)
+        assert model.normaliser_stats["ess"] > 5000 and model.normaliser_stats["n"] < 10**6
+
+        self.assertRaises(NameError, model.estimate_normaliser, proposal="uniform")
+
+
+    def test_estimate_normaliser_ais(self):
+
+        model = self.model
+        np.random.seed(5)
+
+        # on the fitted model AIS agrees with importance sampling
+        ais = model.estimate_normaliser_ais(nparticle=500, ntemp=50, num_steps=5, step_size=0.2)
+        assert model.normaliser_stats["proposal"] == "ais" and model.normaliser_stats["settings"]["method"] == "ais"
+        est = model.estimate_normaliser(n=50000, batch_size=10000, std=2.5)
+        assert abs(ais - est) < 0.15 + 4 * model.normaliser_stats["rel_se"], (ais, est)
+
+        # the particles start from the base measure, the base-only model is recovered exactly
+        logZ = self.set_base_only()
+        ais = model.estimate_normaliser_ais(nparticle=200, ntemp=10)
+        assert np.allclose(ais, logZ, atol=1e-3), (ais, logZ)
+
+
+    def test_sample_chains(self):
+
+        model = self.model
+        self.set_base_only()
+        model.setup_mcmc(sigma=1.0, num_steps_min=5, num_steps_max=10, step_size_min=0.3, step_size_max=0.6,
+                         min_log_pdf=-np.inf)
+        np.random.seed(6)
+        nchain, N, D = 20, 400, self.target.D
+        s = model.sample_chains(N, self.target.sample(nchain))
+
+        for k in ["samples", "proposals"]:
+            assert s[k].shape == (nchain, N, D)
+        for k in ["accepted", "acc_prob", "log_pdf"]:
+            assert s[k].shape == (nchain, N)
+        assert np.all((s["acc_prob"] >= 0) & (s["acc_prob"] <= 1))
+        assert 0 < s["accepted"].mean() <= 1
+        assert np.allclose(s["log_pdf"], model.fun_multiple(s["samples"].reshape(-1, D)).reshape(nchain, N), 
+                           atol=1e-4, rtol=1e-4)
+
+        # the chains sample the base measure N(0, 2^2 I)
+        samples = s["samples"][:,100:].reshape(-1, D)
+        assert np.allclose(samples.mean(0), 0, atol=0.2), samples.mean(0)
+        assert np.allclose(samples.var(0), 4, rtol=0.15), samples.var(0)
+
+
+    def test_log_pdf_and_grad(self):
+
+        model = self.model
+        data  = self.target.test_data[:5].astype(FDTYPE)
+        fun, grad = model.fun_multiple(data), model.grad_multiple(data)
+
+        eps = 1e-2
+        for x, f, g in zip(data, fun, grad):
+            lp, lg = model.log_pdf_and_grad(x)
+            assert np.allclose(lp, f, atol=1e-5, rtol=1e-5) and np.allclose(lg, g, atol=1e-5, rtol=1e-5)
+            assert model.log_pdf_and_grad(x)[0] == lp
+            # central differences of fun_multiple
+            dx = eps * np.eye(len(x), dtype=FDTYPE)
+            fd = (model.fun_multiple(x + dx) - model.fun_multiple(x - dx)) / (2 * eps)
+            assert np.allclose(lg, fd, atol=1e-2, rtol=1e-2), np.max(np.abs(lg-fd))
+
+        # values below min_log_pdf are -inf, as for fun_multiple
+        model.min_log_pdf = fun.max() + 1
+        assert model.log_pdf_and_grad(data[0])[0] == -np.inf
+        assert np.all(model.fun_multiple(data) == -np.inf)
+
+
+    def test_evaluate_grid(self):
+
+        model, n = self.model, 7
+        r    = np.linspace(-2, 2, n)
+        cond = np.array([0.0, 0.5, 0.0])
+        grid = get_grid(r, 0, 2, cond).astype(FDTYPE)
+        assert grid.shape == (n*n, self.target.D) and np.all(grid[:,1] == 0.5)
+
+        fun, grad = model.evaluate_grid(r, 0, 2, cond=cond, outputs=["fun", "grad"])
+        assert fun.shape == (n, n) and grad.shape == (n, n, self.target.D)
+        assert np.allclose(fun, model.fun_multiple(grid).reshape(n, n), atol=1e-5, rtol=1e-5)
+        assert np.allclose(grad, model.grad_multiple(grid).reshape(n, n, -1), atol=1e-5, rtol=1e-5)
+        # dimension j along the first axis
+        x = np.array([[r[1], 0.5, r[3]]], dtype=FDTYPE)
+        assert np.allclose(fun[3,1], model.fun_multiple(x)[0], atol=1e-5, rtol=1e-5)
+
+        kernel = model.evaluate_grid(r, 0, 2, cond=cond, outputs=["kernel"], kernel_points=grid[:2])[0]
+        assert kernel.shape == (2, n, n)
+        assert np.allclose(kernel, model._run_gram(grid[:2], grid).reshape(2, n, n), atol=1e-5, rtol=1e-5)
+
+        # cached for the weights of grid_hash, dropped when they change
+        h = model.grid_hash
+        assert h == model.model_hash()
+        assert model.evaluate_grid(r, 0, 2, cond=cond)[0] is fun
+        model.fit_alpha(200)
+        assert model.evaluate_grid(r, 0, 2, cond=cond)[0] is not fun and model.grid_hash != h
+
+        K = visualize_kernel(model, r, 5, points=grid[:2])
+        assert np.allclose(K, model.evaluate_grid(r, 0, 1, outputs=["kernel"], kernel_points=grid[:2])[0])
+
+
+    def test_nuts(self):
+
+        model, nchain, N = self.model, 4, 40
+        np.random.seed(7)
+        samples = model.nuts(N, thin=2, nchain=nchain, burn=20, n_workers=2)
+        assert samples.shape == (N, self.target.D) and np.all(np.isfinite(samples))
+        assert len(model.nuts_diagnostics) == nchain
+        assert not os.path.exists("ckpts/nuts_%d.npz" % os.getpid())
+
+        # serial chains leave the global state as it was after the starts and seeds were drawn
+        np.random.seed(7)
+        model.nuts(N, thin=2, nchain=nchain, burn=20)
+        after = np.random.rand()
+        np.random.seed(7)
+        self.target.sample(nchain)
+        np.random.randint(2**31, size=nchain)
+        assert np.random.rand() == after
+
+        # the workers cannot run an rff kernel
+        rff = DeepLite(self.target, nlayer=0, npoint=10, kernel_type="rff", nfeat=20, seed=1)
+        self.assertRaises(NameError, rff.nuts, N, 2, nchain, 20, 0.7, 2)
+        rff.sess.close()
+
+
+    def test_export(self):
+
+        model = self.model
+        data  = self.target.test_data[:10].astype(FDTYPE)
+        outputs = ["fun", "grad", "hess"]
+
+        file_name = model.export("test_export")
+        numpy_model = NumpyLite(file_name)
+        os.remove("ckpts/" + file_name + ".npz")
+
+        for v, n in zip(model.evaluate(data, outputs), numpy_model.evaluate(data, outputs)):
+            assert v.shape == n.shape
+            assert np.allclose(v, n, atol=1e-4, rtol=1e-4), np.max(np.abs(v-n))
+        assert numpy_model.min_log_pdf == model.min_log_pdf
+
+
+    def test_update_fit(self):
+
+        model, ndata = self.model, 300
+        new = self.target.test_data[:5].astype(FDTYPE)
+        for z in new:
+            model.update_fit(z)
+        alpha = model.sess.run(model.alpha)
+
+        # a full fit on the data of the last fit and the new points, with the regularisers
+        # weighted for the data of the last fit, as update_fit keeps them
+        data = np.concatenate([self.target.data[:ndata].astype(FDTYPE), new])
+        feed = dict(zip(model.stat_sums, model._sum_statistics(data)))
+        feed[model.stat_ndata] = ndata
+        quad, lin = model.sess.run(model.ops["alpha_system_sums"], feed_dict=feed)
+        refit = np.linalg.solve(quad.astype("float64"), lin.astype("float64"))
+
+        scale = np.max(np.abs(refit))
+        assert np.allclose(alpha, refit, atol=1e-3*scale, rtol=1e-3), np.max(np.abs(alpha-refit)) / scale
+
+
+    def test_input_batch(self):
+
+        model = self.model
+        model.train_params["_nbatch"] = 2
+        pointer = self.target.pointer
+
+        # several passes over the data, the same batches with and without prefetch
+        batches = []
+        for prefetch in [0, 3]:
+            np.random.seed(8)
+            model.stream = self.target.cursor(np.random.randint(2**31))
+            with Prefetcher(model.input_batch, prefetch, 20) as prefetcher:
+                # while the main thread draws from np.random
+                batches.append([(prefetcher.next(), np.random.rand())[0] for _ in range(20)])
+
+        for b0, b1 in zip(*batches):
+            for x0, x1 in zip(b0, b1):
+                assert (x0 is None and x1 is None) or np.array_equal(x0, x1)
+        assert self.target.pointer == pointer
+
+
+    def test_build_ops(self):
+
+        # a model that has only been fitted has none of the ops of the other methods
+        model = self.model
+        assert model.built_ops == set()
+        assert all([k not in model.ops for k in ["stat_sums", "cv_scores", "alpha_set", "points_set"]])
+
+        nop = len(model.graph.get_operations())
+        model.cross_validate([0.1, 1.0], nfold=2)
+        assert model.built_ops == set(["sums", "cv"])
+        nop_cv = len(model.graph.get_operations())
+        assert nop_cv > nop
+
+        # built once
+        model.update_fit(self.target.test_data[0])
+        model.cross_validate([0.1, 1.0], nfold=2)
+        assert len(model.graph.get_operations()) == nop_cv
+        self.assertRaises(NameError, model.build_ops, "train")
+
+
+    def test_server(self):
+
+        model = self.model
+        server = make_server(model, ("localhost", 0), max_latency=0.05)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # float64 rows from json from several workers at once, batched on the tensorflow model
+        client = LiteClient(server.server_address)
+        datas  = [self.target.test_data[i:i+n] for i, n in [(0, 1), (1, 4), (5, 3), (8, 6)]]
+        results = [None] * len(datas)
+        def work(i):
+            results[i] = client.evaluate(datas[i], ["fun", "grad"])
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(len(datas))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for data, (fun, grad) in zip(datas, results):
+            data = data.astype(FDTYPE)
+            assert np.allclose(fun,  model.fun_multiple(data),  atol=1e-5, rtol=1e-5)
+            assert np.allclose(grad, model.grad_multiple(data), atol=1e-5, rtol=1e-5)
+        assert client.health()["nrequest"] == len(datas)
+
+        server.shutdown()
+        server.server_close()
+        server.evaluator.close()
+
+
+unittest.main()
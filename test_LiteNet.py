@@ -2,6 +2,11 @@ import tensorflow as tf
 from LiteNet import *
 import unittest
 import numpy as np
+from Utils import chol_update, pivoted_cholesky, ridge_leverage, leverage_sample, kmeans_pp, Prefetcher, batch_evaluate, \
+                  effective_sample_size
+from NumpyLite import NumpyLite, NumpyNetwork
+from LiteServer import BatchEvaluator, make_server, LiteClient
+import tempfile, os, threading, gc, weakref
 import time
 
 
@@ -1040,6 +1045,566 @@ class test_LiteModel(unittest.TestCase):
         assert np.all(np.isfinite(hess_data))
         assert np.allclose(hess_data, hess_real, atol=1e-6, rtol=1e-4), np.linalg.norm(hess_real-hess_data)/np.linalg.norm(hess_real)
 
+class LiteModelFixture(unittest.TestCase):
+    '''
+    random data, points and alpha, with a LiteModel with base measure on the kernel 
+    of make_kernel, and the same model with the statistics summed over chunks of 3 data
+    '''
+
+    ndata  = 7
+    ndim_in = (3,)
+    npoint = 4
+    # length of alpha, npoint unless the kernel has explicit features
+    nalpha = None
+
+    def make_kernel(self):
+        raise(NotImplementedError)
+
+    def setUp(self):
+
+        tf.reset_default_graph()
+        np.random.seed(1)
+
+        self.data   =   np.random.randn(self.ndata , *self.ndim_in).astype(FDTYPE)
+        self.points =   np.random.randn(self.npoint, *self.ndim_in).astype(FDTYPE)
+        self.alpha_value = np.random.randn(self.nalpha or self.npoint).astype(FDTYPE)
+
+        self.data_tensor    =   tf.constant(self.data)
+        self.points_tensor  =   tf.constant(self.points)
+
+        self.kernel = self.make_kernel()
+        self.alpha  = tf.constant(self.alpha_value)
+
+        self.model = LiteModel(self.kernel, alpha=self.alpha, points=self.points_tensor, base=True)
+        self.chunk_model = LiteModel(self.kernel, alpha=self.alpha, points=self.points_tensor, base=True, chunk_size=3)
+        self.chunk_model.base = self.model.base
+
+        self.sess = tf.InteractiveSession()
+        self.sess.run(tf.global_variables_initializer())
+
+    def tearDown(self):
+        self.sess.close()
+
+    def set_log_lams(self, **log_lams):
+        # the regularisers of every model in the graph, most of them are 10**-1000 = 0 by default
+        for v in tf.global_variables():
+            for name, value in log_lams.items():
+                if v.op.name.endswith("log_" + name):
+                    self.sess.run(v.assign(value))
+
+class test_LiteModelStatistics(LiteModelFixture):
+
+    ndim_out = (4,)
+
+    def make_kernel(self):
+
+        network = LinearSoftNetwork(self.ndim_in, self.ndim_out, init_weight_std = 1.0)
+        kernel  = CompositeKernel(GaussianKernel(1.0), network)
+        return MixtureKernel([kernel, GaussianKernel(1.0)], [0.5, 0.5])
+
+    def test_reduced_statistics(self):
+
+        full    = self.model._score_statistics(self.data_tensor, take_mean=False)[:-1]
+        reduced = self.model._score_statistics(self.data_tensor, take_mean=True)[:-1]
+        chunked = self.chunk_model._score_statistics(self.data_tensor, take_mean=True)[:-1]
+
+        full, reduced, chunked = self.sess.run([full, reduced, chunked])
+        # average the per-data statistics over the data axis
+        full = [np.mean(s, -1) if s.ndim > 1 else np.mean(s) for s in full]
+
+        for f, r, c in zip(full, reduced, chunked):
+            assert np.allclose(f, r, atol=1e-5, rtol=1e-4), np.max(np.abs(f-r))
+            assert np.allclose(r, c, atol=1e-5, rtol=1e-4), np.max(np.abs(r-c))
+
+    def test_individual_score(self):
+
+        score   = self.model.individual_score(self.data_tensor)[0]
+        chunked = self.chunk_model.individual_score(self.data_tensor)[0]
+        score, chunked = self.sess.run([score, chunked])
+
+        f = self.model.evaluate_fun(self.data_tensor)
+        g = tf.gradients(f, self.data_tensor)[0]
+        h = self.model.evaluate_hess(self.data_tensor)
+        score_real = tf.trace(h) + 0.5 * tf.reduce_sum(tf.square(g), -1)
+        score_real = self.sess.run(score_real)
+
+        assert score.shape == (self.ndata,)
+        assert np.allclose(score, score_real, atol=1e-5, rtol=1e-4), np.max(np.abs(score-score_real))
+        assert np.allclose(chunked, score, atol=1e-5, rtol=1e-4), np.max(np.abs(chunked-score))
+
+    def test_opt_alpha_from_sums(self):
+
+        alpha = self.model.opt_alpha(self.data_tensor)[0]
+
+        sums_1 = self.model.statistic_sums(self.data_tensor[:3])[:-1]
+        sums_2 = self.model.statistic_sums(self.data_tensor[3:])[:-1]
+        sums   = [s1 + s2 for s1, s2 in zip(sums_1, sums_2)]
+        alpha_sums = self.model.opt_alpha_from_sums(sums, self.ndata)
+
+        alpha, alpha_sums = self.sess.run([alpha, alpha_sums])
+        assert np.allclose(alpha, alpha_sums, atol=1e-5, rtol=1e-4), np.max(np.abs(alpha-alpha_sums))
+
+    def test_opt_alpha_from_kde_sums(self):
+
+        self.set_log_lams(lam_kde=0.0)
+        kde = tf.constant(np.random.randn(self.ndata).astype(FDTYPE))
+        alpha = self.model.opt_alpha(self.data_tensor, kde)[0]
+
+        sums, kde_sums = [], []
+        for chunk in [slice(0, 3), slice(3, None)]:
+            sums.append(self.model.statistic_sums(self.data_tensor[chunk])[:-1])
+            kde_sums.append(self.model.kde_sums(self.data_tensor[chunk], kde[chunk]))
+        sums     = [s1 + s2 for s1, s2 in zip(*sums)]
+        kde_sums = [s1 + s2 for s1, s2 in zip(*kde_sums)]
+        alpha_sums = self.model.opt_alpha_from_sums(sums, self.ndata, kde_sums=kde_sums)
+
+        alpha, alpha_sums = self.sess.run([alpha, alpha_sums])
+        assert np.allclose(alpha, alpha_sums, atol=1e-5, rtol=1e-4), np.max(np.abs(alpha-alpha_sums))
+
+    def test_alpha_path(self):
+
+        lams = np.array([1e-2, 1e-1, 1.0, 10.0], dtype=FDTYPE)
+        valid_data = tf.constant(np.random.randn(self.ndata, *self.ndim_in).astype(FDTYPE))
+
+        alphas, scores = self.model.alpha_path(lams, self.data_tensor, valid_data)[:2]
+        H, G2, _, GqG = self.model._score_statistics(self.data_tensor)[:4]
+        alphas, scores, H, G2, GqG = self.sess.run([alphas, scores, H, G2, GqG])
+
+        assert alphas.shape == (len(lams), self.npoint)
+        for li, lam in enumerate(lams):
+            alpha_real = np.linalg.solve(G2 + lam * np.eye(self.npoint), -(H + GqG))
+            assert np.allclose(alphas[li], alpha_real, atol=1e-4, rtol=1e-3), np.max(np.abs(alphas[li]-alpha_real))
+
+            score_real = self.model.score(valid_data, alpha=tf.constant(alphas[li]))[0]
+            score_real = self.sess.run(score_real)
+            assert np.allclose(scores[li], score_real, atol=1e-4, rtol=1e-3), (scores[li], score_real)
+
+        # lam_norm along with lam_alpha, without validation
+        alphas, scores = self.model.alpha_path(lams, self.data_tensor, norm_path=True)[:2]
+        assert scores is None
+        alphas, K = self.sess.run([alphas, self.model.K])
+        for li, lam in enumerate(lams):
+            alpha_real = np.linalg.solve(G2 + lam * (K + np.eye(self.npoint)), -(H + GqG))
+            assert np.allclose(alphas[li], alpha_real, atol=1e-4, rtol=1e-3), np.max(np.abs(alphas[li]-alpha_real))
+
+    def test_memoise(self):
+
+        composite, gaussian = self.kernel.kernels
+        assert composite._net_forward(self.points_tensor) is composite._net_forward(self.points_tensor)
+        assert gaussian.get_gram_matrix(self.points_tensor, self.data_tensor) is \
+               gaussian.get_gram_matrix(self.points_tensor, self.data_tensor)
+
+        # the network features of the points are already built by set_points
+        nop = len(tf.get_default_graph().get_operations())
+        composite._net_forward(self.points_tensor)
+        assert len(tf.get_default_graph().get_operations()) == nop
+
+        # built again under a device scope and not cached
+        gram = gaussian.get_gram_matrix(self.points_tensor, self.data_tensor)
+        with tf.device("/cpu:0"), no_memoise():
+            gram_cpu = gaussian.get_gram_matrix(self.points_tensor, self.data_tensor)
+        assert gram_cpu is not gram
+        assert gram_cpu.device.endswith("CPU:0")
+        assert gram is gaussian.get_gram_matrix(self.points_tensor, self.data_tensor)
+
+        # the cache of the graph is reset when a model is built
+        LiteModel(self.kernel, points=self.points_tensor)
+        assert gram is not gaussian.get_gram_matrix(self.points_tensor, self.data_tensor)
+
+    def test_memoise_graph_freed(self):
+
+        # the memoised outputs are kept on their graph and do not keep it alive
+        graph = tf.Graph()
+        with graph.as_default():
+            points = tf.constant(self.points)
+            kernel = GaussianKernel(1.0)
+            kernel.get_gram_matrix(points, points)
+            assert len(memo_cache(graph)) > 0
+        graph_ref, kernel_ref = weakref.ref(graph), weakref.ref(kernel)
+        del graph, points, kernel
+        gc.collect()
+        assert graph_ref() is None and kernel_ref() is None
+
+    def test_statistic_factors(self):
+
+        nfirst = 3
+        sums_all   = self.model.statistic_sums(self.data_tensor)[:-1]
+        sums_first = self.model.statistic_sums(self.data_tensor[:nfirst])[:-1]
+        quad_all, lin_all     = self.model.alpha_system_sums(sums_all, self.ndata)
+        quad_first, lin_first = self.model.alpha_system_sums(sums_first, nfirst)
+        V, dlin = self.model.statistic_factors(self.data_tensor[nfirst:])
+
+        quad_all, lin_all, quad_first, lin_first, V, dlin, lam_alpha = self.sess.run(
+            [quad_all, lin_all, quad_first, lin_first, V, dlin, self.model.lam_alpha])
+
+        # the regulariser is not part of the update
+        quad_update = quad_first + V.dot(V.T) + (self.ndata - nfirst) * lam_alpha * np.eye(self.npoint)
+        assert np.allclose(quad_all, quad_update, atol=1e-5, rtol=1e-4), np.max(np.abs(quad_all-quad_update))
+        assert np.allclose(lin_all, lin_first + dlin, atol=1e-5, rtol=1e-4), np.max(np.abs(lin_all-lin_first-dlin))
+
+        L = chol_update(np.linalg.cholesky(quad_first), V)
+        assert np.allclose(L.dot(L.T), quad_first + V.dot(V.T))
+
+    def test_kde(self):
+
+        self.set_log_lams(lam_kde=0.0)
+        kde = np.random.randn(self.ndata).astype(FDTYPE)
+        H, G2, H2, GqG, qG2, qH, HqH, qH2 = self.model._score_statistics(self.data_tensor)[:-1]
+        quad, lin = self.model._alpha_system(H, G2, H2, GqG, HqH)
+        quad_kde, lin_kde = self.model._alpha_system(H, G2, H2, GqG, HqH, self.data_tensor, tf.constant(kde))
+        loss = self.model.kde_loss(self.data_tensor, tf.constant(kde))
+        gram = self.model.evaluate_gram(self.points_tensor, self.data_tensor)
+        q0   = self.model.base.get_fun(self.data_tensor)
+
+        quad, lin, quad_kde, lin_kde, loss, gram, q0, lam_kde = self.sess.run(
+            [quad, lin, quad_kde, lin_kde, loss, gram, q0, self.model.lam_kde])
+
+        # explicit sums over all pairs of data
+        delta = gram[:,:,None] - gram[:,None,:]
+        kde_delta = (kde - q0)[:,None] - (kde - q0)[None,:]
+        npair = self.ndata**2
+        quad_real = quad + lam_kde * np.einsum("mij,nij->mn", delta, delta) / npair
+        lin_real  = lin  + lam_kde * np.einsum("mij,ij->m", delta, kde_delta) / npair
+        loss_real = np.mean(np.square(np.einsum("i,ijk->jk", self.alpha_value, delta) - kde_delta))
+
+        assert np.allclose(quad_kde, quad_real, atol=1e-5, rtol=1e-4), np.max(np.abs(quad_kde-quad_real))
+        assert np.allclose(lin_kde, lin_real, atol=1e-5, rtol=1e-4), np.max(np.abs(lin_kde-lin_real))
+        assert np.allclose(loss, loss_real, atol=1e-5, rtol=1e-4), (loss, loss_real)
+
+    def test_cg_alpha(self):
+
+        kde = tf.constant(np.random.randn(self.ndata).astype(FDTYPE))
+        cg_model = LiteModel(self.kernel, alpha=self.alpha, points=self.points_tensor, base=True, cg_iter=50, cg_tol=1e-7)
+        cg_model.base = self.model.base
+        # the matvecs of the chunked model are summed over chunks of data
+        cg_chunk_model = LiteModel(self.kernel, alpha=self.alpha, points=self.points_tensor, base=True, 
+                                   cg_iter=50, cg_tol=1e-7, chunk_size=3)
+        cg_chunk_model.base = self.model.base
+        alpha_var = tf.Variable(self.alpha_value)
+        self.sess.run(tf.global_variables_initializer())
+        # every term of the system is used
+        self.set_log_lams(lam_norm=-1.0, lam_curve=-1.0, lam_kde=0.0)
+
+        for k, cg_model in [(None, cg_model), (kde, cg_model), (None, cg_chunk_model), (kde, cg_chunk_model)]:
+            alpha    = self.model.opt_alpha(self.data_tensor, kde=k)[0]
+            alpha_cg = cg_model.opt_alpha(self.data_tensor, kde=k)[0]
+            # gradients through the solve
+            w = tf.constant(np.random.randn(self.npoint).astype(FDTYPE))
+            lams     = [self.model.lam_norm, self.model.lam_alpha, self.model.lam_curve, self.model.lam_kde]
+            lams_cg  = [cg_model.lam_norm, cg_model.lam_alpha, cg_model.lam_curve, cg_model.lam_kde]
+            grads    = tf.gradients(tf.reduce_sum(alpha * w),    [self.data_tensor, self.points_tensor] + lams)
+            grads_cg = tf.gradients(tf.reduce_sum(alpha_cg * w), [self.data_tensor, self.points_tensor] + lams_cg)
+            assert [g is None for g in grads] == [g is None for g in grads_cg]
+            grads_cg = [g for g in grads_cg if g is not None]
+            grads    = [g for g in grads if g is not None]
+
+            alpha, alpha_cg, grads, grads_cg = self.sess.run([alpha, alpha_cg, grads, grads_cg])
+            assert np.allclose(alpha, alpha_cg, atol=1e-4, rtol=1e-3), np.max(np.abs(alpha-alpha_cg))
+            for g, g_cg in zip(grads, grads_cg):
+                assert np.allclose(g, g_cg, atol=1e-3, rtol=1e-2), np.max(np.abs(g-g_cg))
+
+            # no statistics are built, the score comes from one pass over the data
+            assert cg_model.opt_alpha(self.data_tensor, kde=k)[1] is None
+            score    = self.model.opt_score(self.data_tensor, alpha_var, kde=k)[1]
+            score_cg = cg_model.opt_score(self.data_tensor, alpha_var, kde=k)[1]
+            score, score_cg = self.sess.run([score, score_cg])
+            assert np.allclose(score, score_cg, atol=1e-4, rtol=1e-3), (score, score_cg)
+
+        # warm started from the last solve, one iteration is enough
+        cg_model.cg_iter = 1
+        alpha_cg = cg_model.opt_alpha(self.data_tensor, kde=kde)[0]
+        assert np.allclose(alpha, self.sess.run(alpha_cg), atol=1e-4, rtol=1e-3)
+
+    def test_spd_solve(self):
+
+        H, G2, H2, GqG, qG2, qH, HqH, qH2 = self.model._score_statistics(self.data_tensor)[:-1]
+        quad, lin = self.model._alpha_system(H, G2, H2, GqG, HqH)
+        w = tf.constant(np.random.randn(self.npoint).astype(FDTYPE))
+
+        alpha     = tf.matrix_solve(quad, lin[:,None])[:,0]
+        alpha_spd = spd_solve(quad, lin)
+        grads     = tf.gradients(tf.reduce_sum(alpha * w),     [quad, lin, self.data_tensor, self.points_tensor])
+        grads_spd = tf.gradients(tf.reduce_sum(alpha_spd * w), [quad, lin, self.data_tensor, self.points_tensor])
+
+        alpha, alpha_spd, grads, grads_spd = self.sess.run([alpha, alpha_spd, grads, grads_spd])
+        assert np.allclose(alpha, alpha_spd, atol=1e-4, rtol=1e-3), np.max(np.abs(alpha-alpha_spd))
+        for g, g_spd in zip(grads, grads_spd):
+            assert np.allclose(g, g_spd, atol=1e-3, rtol=1e-3), np.max(np.abs(g-g_spd))
+
+    def test_cross_validate(self):
+
+        nfold = 3
+        lam_alphas = np.array([1e-2, 1.0], dtype=FDTYPE)
+        lam_curves = np.array([0.0, 0.1, 1.0], dtype=FDTYPE)
+        scores, fold_scores = self.model.cross_validate(lam_alphas, lam_curves, self.data_tensor, nfold)[:2]
+        scores, fold_scores, K, lam_norm = self.sess.run([scores, fold_scores, self.model.K, self.model.lam_norm])
+        assert scores.shape == (len(lam_alphas), len(lam_curves))
+
+        bounds = [self.ndata * i // nfold for i in range(nfold+1)]
+        for k in range(nfold):
+            fold = self.data[bounds[k]:bounds[k+1]]
+            rest = np.concatenate([self.data[:bounds[k]], self.data[bounds[k+1]:]])
+            H, G2, H2, GqG, qG2, qH, HqH, qH2 = self.model._score_statistics(tf.constant(rest))[:-1]
+            H, G2, H2, GqG, HqH = self.sess.run([H, G2, H2, GqG, HqH])
+            for ai, la in enumerate(lam_alphas):
+                for ci, lc in enumerate(lam_curves):
+                    quad = G2 + lam_norm * K + la * np.eye(self.npoint) + lc * H2
+                    alpha = np.linalg.solve(quad, -(H + GqG + lc * HqH)).astype(FDTYPE)
+                    score = self.sess.run(self.model.score(tf.constant(fold), alpha=tf.constant(alpha))[0])
+                    assert np.allclose(fold_scores[k, ai, ci], score, atol=1e-4, rtol=1e-3), (fold_scores[k, ai, ci], score)
+
+        scores_real = np.tensordot(np.diff(bounds), fold_scores, [[0],[0]]) / self.ndata
+        assert np.allclose(scores, scores_real)
+
+class test_GaussianLiteModel(LiteModelFixture):
+
+    def make_kernel(self):
+        return MixtureKernel([GaussianKernel(0.5), GaussianKernel(-0.3)], [0.4, 0.6])
+
+    def test_statistics(self):
+
+        # closed form statistics against those through the kernel derivatives
+        full    = self.model._score_statistics(self.data_tensor, take_mean=False)[:-1]
+        reduced = self.model._score_statistics(self.data_tensor, take_mean=True)[:-1]
+        chunked = self.chunk_model._score_statistics(self.data_tensor, take_mean=True)[:-1]
+
+        full, reduced, chunked = self.sess.run([full, reduced, chunked])
+        full = [np.mean(s, -1) if s.ndim > 1 else np.mean(s) for s in full]
+
+        for f, r, c in zip(full, reduced, chunked):
+            assert np.allclose(f, r, atol=1e-5, rtol=1e-4), np.max(np.abs(f-r))
+            assert np.allclose(r, c, atol=1e-5, rtol=1e-4), np.max(np.abs(r-c))
+
+    def test_score_and_grad(self):
+
+        score = self.model.individual_score(self.data_tensor)[0]
+        grad, fun = self.model.evaluate_grad_fun(self.data_tensor)
+        g = self.model.evaluate_grad(self.data_tensor)
+
+        f = self.model.evaluate_fun(self.data_tensor)
+        grad_real = tf.gradients(f, self.data_tensor)[0]
+        h = self.model.evaluate_hess(self.data_tensor)
+        score_real = tf.trace(h) + 0.5 * tf.reduce_sum(tf.square(grad_real), -1)
+
+        outs  = [score, grad, fun, g]
+        reals = [score_real, grad_real, f, grad_real]
+        outs, reals = self.sess.run([outs, reals])
+
+        for o, r in zip(outs, reals):
+            assert np.allclose(o, r, atol=1e-5, rtol=1e-4), np.max(np.abs(o-r))
+
+class test_RandomFourierKernel(LiteModelFixture):
+
+    ndim_out = (4,)
+    nfeat = 50
+    # alpha weighs the features of both kernels
+    nalpha = 2 * nfeat
+
+    def make_kernel(self):
+
+        network = LinearSoftNetwork(self.ndim_in, self.ndim_out, init_weight_std = 1.0)
+        kernel  = CompositeKernel(RandomFourierKernel(self.ndim_out[0], 1.0, nfeat=self.nfeat), network)
+        return MixtureKernel([kernel, RandomFourierKernel(self.ndim_in[0], 1.0, nfeat=self.nfeat)], [0.5, 0.5])
+
+    def test_gram_approx(self):
+
+        X = tf.constant(np.random.randn(5, 2).astype(FDTYPE))
+        rff = RandomFourierKernel(2, 1.0, nfeat=20000)
+        gram_rff  = rff.get_gram_matrix(X, X)
+        gram_real = GaussianKernel(1.0).get_gram_matrix(X, X)
+        self.sess.run(tf.global_variables_initializer())
+        gram_rff, gram_real = self.sess.run([gram_rff, gram_real])
+
+        assert np.allclose(gram_rff, gram_real, atol=0.05), np.max(np.abs(gram_rff-gram_real))
+
+    def test_statistics(self):
+
+        # statistics through the features against those through the kernel derivatives
+        full    = self.model._score_statistics(self.data_tensor, take_mean=False)[:-1]
+        reduced = self.model._score_statistics(self.data_tensor, take_mean=True)[:-1]
+
+        full, reduced = self.sess.run([full, reduced])
+        full = [np.mean(s, -1) if s.ndim > 1 else np.mean(s) for s in full]
+
+        for f, r in zip(full, reduced):
+            assert np.allclose(f, r, atol=1e-5, rtol=1e-4), np.max(np.abs(f-r))
+
+    def test_opt_alpha(self):
+
+        # the system is solved for the feature weights, nfeat x nfeat
+        alpha = self.model.opt_alpha(self.data_tensor)[0]
+        H, G2, _, GqG = self.model._score_statistics(self.data_tensor)[:4]
+        alpha, H, G2, GqG, lam_norm, lam_alpha = self.sess.run(
+            [alpha, H, G2, GqG, self.model.lam_norm, self.model.lam_alpha])
+
+        assert alpha.shape == (self.nalpha,)
+        alpha_real = np.linalg.solve(G2 + (lam_norm + lam_alpha) * np.eye(self.nalpha), -(H + GqG))
+        assert np.allclose(alpha, alpha_real, atol=1e-4, rtol=1e-3), np.max(np.abs(alpha-alpha_real))
+
+    def test_evaluate(self):
+
+        hess, grad, fun = self.model.evaluate_hess_grad_fun(self.data_tensor)
+        h, g, k = self.kernel.get_feature_hess_grad(self.data_tensor)
+        k = tf.transpose(k)
+        qh, qg, qf = self.model.base.get_hess_grad_fun(self.data_tensor)
+        hess_real = tf.tensordot(self.alpha, h, [[0],[0]]) + qh
+        grad_real = tf.tensordot(self.alpha, g, [[0],[0]]) + qg
+        fun_real  = tf.tensordot(self.alpha, k, [[0],[0]]) + qf
+
+        outs = [fun, grad, hess, 
+                self.model.evaluate_fun(self.data_tensor),
+                self.model.evaluate_grad(self.data_tensor),
+                self.model.evaluate_hess(self.data_tensor)]
+        reals = [fun_real, grad_real, hess_real] * 2
+        outs, reals = self.sess.run([outs, reals])
+
+        for o, r in zip(outs, reals):
+            assert np.allclose(o, r, atol=1e-5, rtol=1e-4), np.max(np.abs(o-r))
+
+class test_NumpyLite(LiteModelFixture):
+
+    ndim_h  = (4,)
+    ndim_out = (2,)
+    npoint = 5
+
+    def make_kernel(self):
+
+        layers = [LinearSoftNetwork(self.ndim_in, self.ndim_h), LinearSoftNetwork(self.ndim_h, self.ndim_h, scope="fc2")]
+        self.network = DeepNetwork(layers, ndim_out = self.ndim_out, add_skip=True)
+        self.sigmas  = [GaussianKernel(0.3), GaussianKernel(-0.2)]
+        return MixtureKernel([CompositeKernel(self.sigmas[0], self.network), self.sigmas[1]], [0.7, 0.3])
+
+    def numpy_network(self):
+
+        layers = [ self.sess.run([l.param["W"], l.param["b"]]) for l in self.network.layers ]
+        skip   = self.sess.run([self.network.skip_layer.param[k] for k in ["W0", "W1", "b"]])
+        return NumpyNetwork(layers, skip)
+
+    def test_network(self):
+
+        hess, grad, out, _ = self.network.get_hess_grad_data(self.data_tensor)
+        hess, grad, out = self.sess.run([hess, grad, out])
+
+        S, J, h = self.numpy_network().get_hess_grad(self.data)
+
+        for o, r in zip([h, J, S], [out, np.transpose(grad, [1,0,2]), np.transpose(hess, [1,0,2,3])]):
+            assert np.allclose(o, r, atol=1e-5, rtol=1e-4), np.max(np.abs(o-r))
+
+    def test_evaluate(self):
+
+        network = self.numpy_network()
+        params = dict(points = self.points, alpha = self.alpha_value, nkernel = 2, nlayer = 2, base = True,
+                      min_log_pdf = -np.inf, prop_0 = 0.7, prop_1 = 0.3,
+                      base_mu = self.sess.run(self.model.base.mu), base_sigma = self.sess.run(self.model.base.sigma))
+        for i in range(2):
+            params["sigma_%d" % i] = self.sess.run(self.sigmas[i].sigma)
+            params["W_0_%d" % i], params["b_0_%d" % i] = network.layers[i]
+        params["W0_0_skip"], params["W1_0_skip"], params["b_0_skip"] = network.skip
+
+        file_name = tempfile.mktemp(suffix=".npz")
+        np.savez(file_name, **params)
+        numpy_model = NumpyLite(file_name)
+        # in FDTYPE, as the nuts workers run it
+        single_model = NumpyLite(file_name, FDTYPE)
+        os.remove(file_name)
+
+        reals = self.sess.run(self.model.evaluate_hess_grad_fun(self.data_tensor))
+        outs  = [numpy_model.hess_multiple(self.data, batch_size=3), 
+                 numpy_model.grad_multiple(self.data, batch_size=3), 
+                 numpy_model.fun_multiple(self.data, batch_size=3)]
+
+        for o, r in zip(outs, reals):
+            assert np.allclose(o, r, atol=1e-4, rtol=1e-4), np.max(np.abs(o-r))
+        assert np.allclose(numpy_model.log_pdf(self.data[0]), reals[2][0], atol=1e-4, rtol=1e-4)
+
+        outs = single_model.evaluate(self.data, ["hess", "grad", "fun"], batch_size=3)
+        for o, r in zip(outs, reals):
+            assert o.dtype == FDTYPE
+            assert np.allclose(o, r, atol=1e-4, rtol=1e-4), np.max(np.abs(o-r))
+        f, g = single_model.log_pdf_and_grad(self.data[0])
+        assert np.allclose(f, reals[2][0], atol=1e-4, rtol=1e-4) and np.allclose(g, reals[1][0], atol=1e-4, rtol=1e-4)
+
+class test_LiteServer(unittest.TestCase):
+
+    D = 3
+    npoint = 6
+
+    def setUp(self):
+
+        np.random.seed(1)
+        params = dict(points = np.random.randn(self.npoint, self.D), alpha = np.random.randn(self.npoint), 
+                      nkernel = 1, nlayer = 0, base = False, min_log_pdf = -np.inf, prop_0 = 1.0, sigma_0 = 2.0)
+        file_name = tempfile.mktemp(suffix=".npz")
+        np.savez(file_name, **params)
+        self.model = NumpyLite(file_name)
+        os.remove(file_name)
+
+        self.datas   = [np.random.randn(n, self.D) for n in [1, 4, 2, 7, 3, 5]]
+        self.outputs = [["fun"], ["grad", "fun"], ["hess"], ["grad"], ["fun"], ["hess", "grad"]]
+
+    def run_threads(self, evaluate, datas, outputs):
+
+        results = [None] * len(datas)
+        def work(i):
+            try:
+                results[i] = evaluate(datas[i], outputs[i])
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(len(datas))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def check(self, results):
+
+        for data, outputs, values in zip(self.datas, self.outputs, results):
+            reals = self.model.evaluate(data, outputs)
+            for o, r in zip(values, reals):
+                assert np.allclose(o, r, atol=1e-5, rtol=1e-4), np.max(np.abs(o-r))
+
+    def test_batch(self):
+
+        evaluator = BatchEvaluator(self.model, max_batch=100, max_latency=0.5)
+        datas   = self.datas + [np.random.randn(2, self.D+1)]
+        outputs = self.outputs + [["fun"]]
+        results = self.run_threads(evaluator.evaluate, datas, outputs)
+
+        self.check(results[:-1])
+        assert isinstance(results[-1], ValueError)
+
+        health = evaluator.health()
+        evaluator.close()
+        assert health["nrequest"] == len(datas) and health["nerror"] == 1
+        assert health["nrow"] == sum([d.shape[0] for d in datas])
+        assert health["nbatch"] < health["nrequest"], health["nbatch"]
+        assert evaluator.health()["status"] == "stopped"
+
+    def test_max_batch(self):
+
+        evaluator = BatchEvaluator(self.model, max_batch=8, max_latency=0.5)
+        self.check(self.run_threads(evaluator.evaluate, self.datas, self.outputs))
+        health = evaluator.health()
+        evaluator.close()
+        assert health["nbatch"] >= sum([d.shape[0] for d in self.datas]) / 8.0
+
+    def test_server(self):
+
+        server = make_server(self.model, ("localhost", 0), max_latency=0.05)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        client = LiteClient(server.server_address)
+        self.check(self.run_threads(client.evaluate, self.datas, self.outputs))
+        assert client.health()["nrequest"] == len(self.datas)
+        self.assertRaises(RuntimeError, client.evaluate, np.zeros((2, self.D+1)))
+
+        server.shutdown()
+        server.server_close()
+        server.evaluator.close()
+
 ###########################
 ###########################
 ### OTHER STUFF ########### 
@@ -1047,6 +1612,126 @@ class test_LiteModel(unittest.TestCase):
 ###########################
 
 
+class test_Utils(unittest.TestCase):
+
+    def counter(self):
+        # function returning how many times it was called
+        calls = []
+        def fun():
+            calls.append(1)
+            return len(calls)
+        return fun, calls
+
+    def test_prefetcher(self):
+
+        fun, calls = self.counter()
+        with Prefetcher(fun, 2, nitem=5) as prefetcher:
+            assert [prefetcher.next() for _ in range(5)] == [1, 2, 3, 4, 5]
+            self.assertRaises(StopIteration, prefetcher.next)
+        assert len(calls) == 5
+
+        # stopped early, at most depth + 1 results are drawn ahead and dropped
+        fun, calls = self.counter()
+        with Prefetcher(fun, 2) as prefetcher:
+            assert [prefetcher.next() for _ in range(3)] == [1, 2, 3]
+            time.sleep(0.2)
+        assert 3 <= len(calls) <= 3 + 2 + 1
+
+        fun, calls = self.counter()
+        with Prefetcher(fun, 0) as prefetcher:
+            assert [prefetcher.next() for _ in range(3)] == [1, 2, 3]
+        assert len(calls) == 3
+
+    def test_batch_evaluate(self):
+
+        data = np.random.randn(10, 3).astype(FDTYPE)
+        batches = []
+        def run(batch):
+            batches.append(batch.shape[0])
+            return [batch * 2, batch.sum(1).astype("int32")]
+
+        # the last batch has the remainder of the rows
+        double, total = batch_evaluate(run, data, 4)
+        assert batches == [4, 4, 2]
+        assert np.array_equal(double, data * 2) and double.dtype == data.dtype
+        assert np.array_equal(total, data.sum(1).astype("int32")) and total.dtype == np.int32
+
+        double, total = batch_evaluate(run, data[:0], 4)
+        assert double.shape == (0, 3) and total.shape == (0,)
+        assert double.dtype == data.dtype and total.dtype == np.int32
+
+    def test_pivoted_cholesky(self):
+
+        np.random.seed(1)
+        ndata = 7
+        X = np.random.randn(ndata, 3)
+        # gaussian gram matrix with different variances
+        scale = np.random.uniform(0.5, 1.5, ndata)
+        K = scale[:,None] * np.exp(-0.5 * np.sum((X[:,None] - X[None])**2, -1)) * scale[None,:]
+
+        pivots, L = pivoted_cholesky(np.diag(K), lambda i: K[:,i], 4)
+        # exact on the rows and columns of the pivots, residual variance left elsewhere
+        assert len(set(pivots)) == 4
+        assert np.allclose(L.T.dot(L)[pivots][:,pivots], K[pivots][:,pivots])
+        assert np.all(np.diag(K) - np.sum(L**2, 0) > -1e-8)
+        assert pivots[0] == np.argmax(np.diag(K))
+
+        pivots, L = pivoted_cholesky(np.diag(K), lambda i: K[:,i], ndata)
+        assert np.allclose(L.T.dot(L), K)
+        lev = ridge_leverage(L, 1e-2)
+        assert np.allclose(lev, np.diag(K.dot(np.linalg.inv(K + 1e-2 * np.eye(ndata)))))
+
+        # a gram matrix of rank 2 stops after 2 pivots
+        V = np.random.randn(2, ndata)
+        pivots, L = pivoted_cholesky(np.sum(V**2, 0), lambda i: V.T.dot(V[:,i]), 4)
+        assert len(pivots) == 2 and np.allclose(L.T.dot(L), V.T.dot(V))
+
+    def test_leverage_sample(self):
+
+        rng = np.random.RandomState(0)
+        ndata = 7
+        # a gram matrix of rank 2 where only 3 rows have any leverage
+        V = np.zeros((2, ndata))
+        V[:,:3] = rng.randn(2, 3)
+        pivots, L = pivoted_cholesky(np.sum(V**2, 0), lambda i: V.T.dot(V[:,i]), 5)
+        assert len(pivots) == 2
+
+        idx = leverage_sample(L, 1e-3, 5, rng)
+        assert len(set(idx)) == 5
+        # the rows with leverage come first
+        assert set(idx[:3]) == set(range(3))
+
+    def test_kmeans_pp(self):
+
+        rng = np.random.RandomState(0)
+        # three far apart clusters, one seed lands in each
+        centres = np.array([[0.0, 0.0], [100.0, 0.0], [0.0, 100.0]])
+        data = np.concatenate([c + rng.randn(50, 2) for c in centres])
+        idx = kmeans_pp(data, 3, rng)
+        assert sorted(idx // 50) == [0, 1, 2]
+
+        # fewer distinct rows than seeds
+        data = np.repeat(centres[:2], 5, 0)
+        idx = kmeans_pp(data, 4, rng)
+        assert len(idx) == 4 and len(set(map(tuple, data[idx]))) == 2
+
+    def test_effective_sample_size(self):
+
+        np.random.seed(1)
+        n = 2000
+        # independent, strongly correlated AR(1) and constant columns
+        ar = np.zeros(n)
+        for i in range(1, n):
+            ar[i] = 0.9 * ar[i-1] + np.random.randn()
+        x = np.stack([np.random.randn(n), ar, np.full(n, 0.3)], 1)
+
+        ess = effective_sample_size(x)
+        assert np.all(np.isfinite(ess))
+        assert 0.8 * n < ess[0] < 1.2 * n
+        # (1 - 0.9) / (1 + 0.9) of n
+        assert 0.5 * n / 19 < ess[1] < 2.0 * n / 19
+        assert ess[2] == n
+
 
 @unittest.skip('does not work yet')
 class test_ConvNetwork(unittest.TestCase):